@@ -27,6 +27,7 @@ setup(
     url='https://github.com/praekeltfoundation/vumi-messenger',
     packages=[
         'vxmessenger',
+        'vxmessenger.benchmarks',
     ],
     package_dir={'vxmessenger':
                  'vxmessenger'},
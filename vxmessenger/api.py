@@ -1,20 +1,88 @@
+import json
+import random
 import sys
+from collections import Counter, deque
+from urllib import unquote
+from urlparse import parse_qs
 
 from klein import Klein
 
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.endpoints import serverFromString
+from twisted.internet.task import deferLater
 from twisted.web.server import Site
 
 import click
 
 
+def parse_latency(spec):
+    """
+    Parse a latency distribution and return a function that samples a
+    latency in seconds from it, given a ``random.Random``. Distributions are
+    given as ``fixed:SECONDS``, ``uniform:LOW,HIGH``, ``exponential:MEAN``
+    or ``lognormal:MEDIAN,SIGMA``.
+    """
+    kind, _, params = spec.partition(':')
+    try:
+        params = [float(p) for p in params.split(',')] if params else []
+        if kind == 'fixed':
+            [seconds] = params
+            return lambda rng: seconds
+        if kind == 'uniform':
+            [low, high] = params
+            return lambda rng: rng.uniform(low, high)
+        if kind == 'exponential':
+            [mean] = params
+            return lambda rng: rng.expovariate(1 / mean) if mean else 0
+        if kind == 'lognormal':
+            [median, sigma] = params
+            return lambda rng: median * rng.lognormvariate(0, sigma)
+    except ValueError:
+        pass
+    raise ValueError('Invalid latency distribution: %r' % (spec,))
+
+
 class ApiService(object):
+    """
+    A local stand-in for the parts of the Graph API that the transport uses.
+
+    Responses are delayed by a latency sampled from ``latency``. Each call,
+    including each request in a batch, fails with a random error at
+    ``error_rate``, is throttled at ``throttle_rate`` and, within a batch, is
+    left uncompleted (``null``) at ``none_rate``. If ``rate_limit`` is set,
+    requests are refused once more than that many calls have been made
+    within ``rate_window`` seconds. Every response carries an
+    ``X-App-Usage`` header reporting usage of the rate limit. Given the same
+    ``seed`` and the same requests in the same order, the same responses
+    are returned.
+    """
     app = Klein()
 
-    def __init__(self):
-        pass
+    ERRORS = [
+        (100, 2018001, 'No matching user found'),
+        (551, 1545041, 'This person isn\'t available right now.'),
+        (10, 2018065, 'This message is sent outside of allowed window.'),
+        (2, None, 'An unexpected error has occurred. '
+                  'Please retry your request later.'),
+    ]
+    THROTTLED = (613, None, 'Calls to this api have exceeded the rate limit.')
+    RATE_LIMITED = (4, None, 'Application request limit reached')
+    UNSUPPORTED = (100, 33, 'Unsupported request.')
+
+    def __init__(self, latency='fixed:0', error_rate=0, none_rate=0,
+                 throttle_rate=0, rate_limit=0, rate_window=60, seed=None,
+                 clock=reactor):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.none_rate = none_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.calls = deque()
+        self.stats = Counter()
 
     @app.route('/api')
     def items(self, request):
@@ -24,6 +92,169 @@ class ApiService(object):
         log.msg('Received data: %r' % (request.content.read(),))
         return 'hello'
 
+    @app.route('/', methods=['POST'])
+    def batch(self, request):
+        batch = json.loads(request.args.get('batch', ['[]'])[0])
+        code, body = self.handle_batch(batch)
+        return self.respond(request, code, body)
+
+    def handle_batch(self, batch):
+        """
+        Handle the requests in a batch API call, returning the response
+        code and body.
+        """
+        self.stats['batches'] += 1
+        if self.add_calls(len(batch)):
+            return 400, self.error(self.RATE_LIMITED)
+
+        results = []
+        for item in batch:
+            self.stats['batch_requests'] += 1
+            outcome = self.outcome(batch=True)
+            if outcome is None:
+                self.stats['none'] += 1
+                results.append(None)
+                continue
+            if outcome is True:
+                code, body = self.call(
+                    item.get('method', 'GET'), item['relative_url'],
+                    parse_qs(item.get('body', '')))
+            else:
+                code, body = 400, self.error(outcome)
+            results.append({'code': code, 'body': json.dumps(body)})
+        return 200, results
+
+    @app.route('/<version>/<path:path>', methods=['GET', 'POST'])
+    def graph(self, request, version, path):
+        self.stats['requests'] += 1
+        if self.add_calls(1):
+            return self.respond(request, 400, self.error(self.RATE_LIMITED))
+
+        outcome = self.outcome(batch=False)
+        if outcome is not True:
+            return self.respond(request, 400, self.error(outcome))
+
+        params = dict(request.args)
+        content_type = request.getHeader('Content-Type') or ''
+        if content_type.startswith('application/json'):
+            for k, v in json.loads(request.content.read()).items():
+                params[k] = [
+                    v if isinstance(v, basestring) else json.dumps(v)]
+        code, body = self.call(
+            request.method, '%s/%s' % (version, path), params)
+        return self.respond(request, code, body)
+
+    def add_calls(self, count):
+        """
+        Record ``count`` calls, returning ``True`` if they exceed the rate
+        limit.
+        """
+        now = self.clock.seconds()
+        while self.calls and self.calls[0] <= now - self.rate_window:
+            self.calls.popleft()
+        if self.rate_limit and len(self.calls) + count > self.rate_limit:
+            self.stats['rate_limited'] += 1
+            return True
+        self.calls.extend([now] * count)
+        return False
+
+    def usage(self):
+        if not self.rate_limit:
+            percent = 0
+        else:
+            percent = min(100, len(self.calls) * 100 // self.rate_limit)
+        return {
+            'call_count': percent,
+            'total_cputime': percent,
+            'total_time': percent,
+        }
+
+    def outcome(self, batch):
+        """
+        Decide what happens to a call. Returns ``True`` if it succeeds,
+        ``None`` if it isn't completed, or the error to return.
+        """
+        n = self.random.random()
+        if batch:
+            if n < self.none_rate:
+                return None
+            n -= self.none_rate
+        if n < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return self.THROTTLED
+        n -= self.throttle_rate
+        if n < self.error_rate:
+            self.stats['errors'] += 1
+            return self.random.choice(self.ERRORS)
+        return True
+
+    def error(self, error):
+        code, subcode, message = error
+        body = {
+            'message': message,
+            'type': 'OAuthException',
+            'code': code,
+            'fbtrace_id': self.random_id(11),
+        }
+        if subcode is not None:
+            body['error_subcode'] = subcode
+        return {'error': body}
+
+    def random_id(self, length=16):
+        return ''.join(
+            self.random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+            for _ in range(length))
+
+    def respond(self, request, code, body):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('X-App-Usage', json.dumps(self.usage()))
+        return deferLater(
+            self.clock, self.latency(self.random), json.dumps, body)
+
+    def call(self, method, url, params):
+        """
+        Handle a single Graph API call, returning the response code and
+        body.
+        """
+        path = unquote(url.split('?', 1)[0]).strip('/').split('/')
+        if path and path[0].startswith('v'):
+            path = path[1:]
+
+        if method == 'POST' and path == ['me', 'messages']:
+            return self.send_message(params)
+        if method == 'POST' and path == ['me', 'message_attachments']:
+            return 200, {'attachment_id': str(self.random.getrandbits(52))}
+        settings = ('thread_settings', 'messenger_profile')
+        if method == 'POST' and len(path) == 2 and path[1] in settings:
+            self.stats['thread_settings'] += 1
+            return 200, {'result': 'success'}
+        if method == 'GET' and len(path) == 1:
+            return self.get_profile(path[0])
+        return 400, self.error(self.UNSUPPORTED)
+
+    def send_message(self, params):
+        recipient = json.loads(params.get('recipient', ['{}'])[0])
+        if 'id' not in recipient:
+            return 400, self.error(
+                (100, None, 'The parameter recipient is required'))
+        self.stats['messages'] += 1
+        if 'sender_action' in params:
+            return 200, {'recipient_id': recipient['id']}
+        return 200, {
+            'recipient_id': recipient['id'],
+            'message_id': 'mid.$%s' % (self.random_id(32),),
+        }
+
+    def get_profile(self, user_id):
+        self.stats['profiles'] += 1
+        return 200, {
+            'id': user_id,
+            'first_name': 'First %s' % (user_id,),
+            'last_name': 'Last %s' % (user_id,),
+            'profile_pic': 'https://example.com/%s.jpg' % (user_id,),
+        }
+
 
 @click.command()
 @click.option('--endpoint', default='tcp:8051',
@@ -32,10 +263,30 @@ class ApiService(object):
               help='Where to log output to.',
               type=click.File('a'),
               default=sys.stdout)
-def cli(endpoint, logfile):
+@click.option('--latency', default='fixed:0',
+              help='The response latency distribution, e.g. fixed:0.1, '
+                   'uniform:0.05,0.5, exponential:0.2 or lognormal:0.1,0.8.')
+@click.option('--error-rate', default=0.0, type=float,
+              help='The fraction of calls that fail with an error.')
+@click.option('--none-rate', default=0.0, type=float,
+              help='The fraction of batched calls that are not completed.')
+@click.option('--throttle-rate', default=0.0, type=float,
+              help='The fraction of calls that are throttled.')
+@click.option('--rate-limit', default=0, type=int,
+              help='The maximum number of calls per rate window.')
+@click.option('--rate-window', default=60.0, type=float,
+              help='The rate limit window in seconds.')
+@click.option('--seed', default=None, type=int,
+              help='Seed for the random number generator.')
+def cli(endpoint, logfile, latency, error_rate, none_rate, throttle_rate,
+        rate_limit, rate_window, seed):
     log.startLogging(logfile)
+    service = ApiService(
+        latency=latency, error_rate=error_rate, none_rate=none_rate,
+        throttle_rate=throttle_rate, rate_limit=rate_limit,
+        rate_window=rate_window, seed=seed)
     endpoint = serverFromString(reactor, str(endpoint))
-    endpoint.listen(Site(ApiService().app.resource()))
+    endpoint.listen(Site(service.app.resource()))
     reactor.run()
 
 
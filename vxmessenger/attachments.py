@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from twisted.web import http
+from twisted.web.client import PotentialDataLoss, ResponseDone
+from twisted.web.resource import Resource, NoResource
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.static import File
+
+
+class AttachmentTooLarge(Exception):
+    """An attachment's body is larger than the store accepts."""
+
+
+class AttachmentStore(object):
+    """A content-addressed store of attachments on local disk.
+
+    Attachment content is stored once per SHA-256 digest under ``blobs/``,
+    and each attachment key has a small reference file under ``refs/``
+    naming its blob and content type. Blobs are evicted in least recently
+    used order once they take up more than ``max_bytes``, along with the
+    references to them.
+
+    ``put`` and ``get`` may be called from several threads at once. The
+    index of blobs is guarded by a lock, which is not held while hashing
+    content or writing blobs.
+    """
+
+    def __init__(self, path, max_bytes, max_file_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.blobs_path = os.path.join(path, 'blobs')
+        self.refs_path = os.path.join(path, 'refs')
+        for directory in (self.blobs_path, self.refs_path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        self.evictions = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()
+        self._refs = {}
+        self._keys = {}
+        blobs = [
+            (os.stat(self.blob_path(digest)), digest)
+            for digest in os.listdir(self.blobs_path)]
+        for stat, digest in sorted(blobs, key=lambda b: b[0].st_mtime):
+            self._blobs[digest] = stat.st_size
+            self._refs[digest] = set()
+            self.size += stat.st_size
+        for key in os.listdir(self.refs_path):
+            ref = self.read_ref(key)
+            if ref is None or ref['digest'] not in self._blobs:
+                self._remove(self.ref_path(key))
+            else:
+                self._refs[ref['digest']].add(key)
+                self._keys[key] = ref['digest']
+        with self._lock:
+            self.evict()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_path, digest)
+
+    def ref_path(self, key):
+        return os.path.join(self.refs_path, key)
+
+    def read_ref(self, key):
+        try:
+            with open(self.ref_path(key), 'rb') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        os.rename(tmp_path, path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def put(self, key, content, content_type=None):
+        """
+        Store ``content`` under ``key``. Returns the content's digest, or
+        ``None`` if it is larger than ``max_file_bytes``.
+        """
+        if len(content) > self.max_file_bytes:
+            return None
+
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            stored = digest in self._blobs
+        if not stored:
+            # Identical content written by two threads at once ends up in
+            # the same file either way, as each write is an atomic rename.
+            self._write(self.blob_path(digest), content)
+
+        with self._lock:
+            if digest in self._blobs:
+                self._touch(digest)
+            else:
+                if stored:
+                    # Evicted since we checked
+                    self._write(self.blob_path(digest), content)
+                self._blobs[digest] = len(content)
+                self.size += len(content)
+            old_digest = self._keys.get(key)
+            if old_digest is not None:
+                self._refs.get(old_digest, set()).discard(key)
+            self._write(self.ref_path(key), json.dumps({
+                'digest': digest,
+                'content_type': content_type,
+            }))
+            self._keys[key] = digest
+            self._refs.setdefault(digest, set()).add(key)
+            self.evict()
+        return digest
+
+    def get(self, key):
+        """
+        Return the blob path and content type of the attachment stored
+        under ``key``, or ``None`` if there isn't one.
+        """
+        ref = self.read_ref(key)
+        if ref is None:
+            return None
+        with self._lock:
+            if ref['digest'] not in self._blobs:
+                return None
+            self._touch(ref['digest'])
+        return self.blob_path(ref['digest']), ref['content_type']
+
+    def _touch(self, digest):
+        self._blobs[digest] = self._blobs.pop(digest)
+        try:
+            os.utime(self.blob_path(digest), None)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Evict blobs until the store fits. Must be called with the lock."""
+        while self.size > self.max_bytes and self._blobs:
+            digest, size = self._blobs.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            self._remove(self.blob_path(digest))
+            for key in self._refs.pop(digest, ()):
+                del self._keys[key]
+                self._remove(self.ref_path(key))
+
+
+class _LimitedBodyReader(Protocol):
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.length = 0
+        self.chunks = []
+        self.finished = Deferred(self.cancel)
+
+    def cancel(self, d):
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.length += len(data)
+        if self.length > self.max_length:
+            self.transport.stopProducing()
+            self.finished.errback(AttachmentTooLarge(
+                'Attachment is larger than %d bytes' % (self.max_length,)))
+            return
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+
+def read_body(response, max_length):
+    """
+    Read the body of ``response``, failing with ``AttachmentTooLarge`` and
+    dropping the connection as soon as more than ``max_length`` bytes have
+    arrived, rather than reading the rest.
+    """
+    reader = _LimitedBodyReader(max_length)
+    response.deliverBody(reader)
+    return reader.finished
+
+
+class AttachmentResource(Resource):
+    """
+    Serves the attachments in an ``AttachmentStore`` by key. The store is
+    looked up in a thread, as it reads from disk.
+    """
+    isLeaf = True
+
+    def __init__(self, store):
+        Resource.__init__(self)
+        self.store = store
+
+    def render_GET(self, request):
+        if len(request.postpath) != 1:
+            return NoResource().render(request)
+        [key] = request.postpath
+        if not key or key.startswith('.') or os.sep in key:
+            return NoResource().render(request)
+        d = deferToThread(self.store.get, key)
+        d.addCallback(self.render_blob, request)
+        d.addErrback(self.render_error, request)
+        return NOT_DONE_YET
+
+    def render_blob(self, blob, request):
+        if blob is None:
+            resource = NoResource()
+        else:
+            path, content_type = blob
+            content_type = content_type or 'application/octet-stream'
+            resource = File(path, defaultType=content_type.encode('ascii'))
+        body = resource.render(request)
+        if body is not NOT_DONE_YET:
+            request.write(body)
+            request.finish()
+
+    def render_error(self, failure, request):
+        log.err(failure, 'Unable to serve attachment')
+        if not request.finished:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.finish()
@@ -0,0 +1,62 @@
+"""
+Run the benchmark suite.
+
+    $ python -m vxmessenger.benchmarks --output results.json
+    $ python -m vxmessenger.benchmarks --baseline results.json
+
+With ``--baseline``, exits with a non-zero status if any benchmark is worse
+than in the baseline results by more than ``--tolerance``.
+"""
+import json
+import sys
+
+import click
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import react
+
+from vxmessenger.benchmarks import bench_codec, bench_transport
+from vxmessenger.benchmarks.results import (
+    report, write_report, regressions)
+
+
+@click.command()
+@click.option('--output', type=click.File('w'),
+              help='Where to write the results as JSON.')
+@click.option('--baseline', type=click.File('r'),
+              help='Results to compare against.')
+@click.option('--tolerance', default=0.2, type=float,
+              help='How much worse than the baseline a result may be.')
+@click.option('--scale', default=1.0, type=float,
+              help='Multiplier for the number of iterations.')
+@click.option('--only', type=click.Choice(['codec', 'transport']),
+              help='Only run one group of benchmarks.')
+def cli(output, baseline, tolerance, scale, only):  # pragma: nocover
+    baseline = json.load(baseline) if baseline is not None else None
+
+    @inlineCallbacks
+    def main(reactor):
+        results = []
+        if only in (None, 'codec'):
+            results.extend(bench_codec.run(scale))
+        if only in (None, 'transport'):
+            results.extend((yield bench_transport.run(scale)))
+
+        for r in results:
+            click.echo('%-50s %12.2f %s' % (r['name'], r['value'], r['unit']))
+        if output is not None:
+            write_report(report(results), output)
+
+        if baseline is not None:
+            worse = regressions(baseline, results, tolerance)
+            for r, b, change in worse:
+                click.echo('REGRESSION %s: %.2f %s -> %.2f %s (%+.0f%%)' % (
+                    r['name'], b['value'], b['unit'], r['value'], r['unit'],
+                    change * 100))
+            if worse:
+                sys.exit(1)
+
+    react(main)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    cli()
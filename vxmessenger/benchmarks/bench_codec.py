@@ -0,0 +1,54 @@
+"""
+Compare the available JSON codecs on the payloads the transport encodes and
+decodes for every message.
+
+    $ python -m vxmessenger.benchmarks.bench_codec
+"""
+import timeit
+
+from vxmessenger import codec
+from vxmessenger.benchmarks import payloads
+from vxmessenger.benchmarks.results import result
+
+
+def cases():
+    """Yield ``(name, obj)`` for each payload shape."""
+    yield 'inbound_text', payloads.inbound_text()
+    yield 'inbound_text_x10', payloads.inbound_text(10)
+    yield 'inbound_postback', payloads.inbound_postback()
+    yield 'outbound_template', payloads.outbound_template()
+    yield 'queued_request', payloads.queued_request()
+    yield 'batch_response', payloads.batch_response()
+
+
+def time_call(f, number):
+    """The best time per call to ``f`` in microseconds."""
+    return min(timeit.repeat(f, number=number, repeat=3)) / number * 1e6
+
+
+def run(scale=1):
+    """
+    Return a list of results, one for each codec, operation and payload,
+    with times in microseconds per call.
+    """
+    number = max(1, int(2000 * scale))
+    results = []
+    for c in codec.available_codecs():
+        for name, obj in cases():
+            data = c.dumps(obj)
+            results.append(result(
+                'codec.%s.dumps.%s' % (c.name, name),
+                time_call(lambda: c.dumps(obj), number), 'us/op', number))
+            results.append(result(
+                'codec.%s.loads.%s' % (c.name, name),
+                time_call(lambda: c.loads(data), number), 'us/op', number))
+    return results
+
+
+def main():  # pragma: nocover
+    for r in run():
+        print '%-50s %12.2f %s' % (r['name'], r['value'], r['unit'])
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
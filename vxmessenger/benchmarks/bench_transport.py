@@ -0,0 +1,180 @@
+"""
+Time the transport's hot paths against in-memory Redis and AMQP stand-ins.
+
+    $ python -m vxmessenger.benchmarks.bench_transport
+"""
+import time
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.web.http_headers import Headers
+
+from vumi.persist import fake_redis
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxmessenger import codec
+from vxmessenger.benchmarks import payloads
+from vxmessenger.benchmarks.results import result
+from vxmessenger.transport import MessengerTransport, Page
+
+
+class FakeResponse(object):
+
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+        self.headers = Headers()
+
+    def content(self):
+        return succeed(self.body)
+
+
+class BenchmarkTransport(MessengerTransport):
+    """A transport that never talks to the Graph API."""
+
+    def request(self, method, url, data, **kw):
+        return succeed(FakeResponse(200, '{}'))
+
+
+def bench_page_from_fp(scale=1):
+    """Parse synthetic webhook corpora of each event mix."""
+    results = []
+    for mix in sorted(payloads.EVENT_MIXES):
+        corpus = payloads.webhook_corpus(
+            mix, requests=max(1, int(500 * scale)), events_per_request=4)
+        events = 0
+        start = time.time()
+        for body in corpus:
+            pages, errors = Page.from_fp(StringIO(body))
+            events += len(pages) + len(errors)
+        elapsed = time.time() - start
+        results.append(result(
+            'page_from_fp.%s' % (mix,), events / elapsed, 'events/s',
+            len(corpus)))
+    return results
+
+
+@inlineCallbacks
+def bench_handle_outbound_message(helper, transport, scale=1):
+    """Build and enqueue outbound text and template messages."""
+    results = []
+    n = max(1, int(1000 * scale))
+    template = payloads.outbound_template()['message']
+    for name, kw in [
+            ('text', {'content': 'Hello, world!'}),
+            ('template', {'content': None, 'helper_metadata': {
+                'messenger': template}})]:
+        messages = [
+            helper.make_outbound(to_addr='USER_%d' % (i,), **kw)
+            for i in range(n)]
+        start = time.time()
+        for message in messages:
+            yield transport.handle_outbound_message(message)
+        elapsed = time.time() - start
+        yield transport.redis.delete(transport.REQ_QUEUE_KEY)
+        transport.queue_len = 0
+        results.append(result(
+            'handle_outbound_message.%s' % (name,), elapsed / n * 1e6,
+            'us/op', n))
+    returnValue(results)
+
+
+@inlineCallbacks
+def fill_request_queue(transport, batch_size, round):
+    msg = payloads.outbound_template()
+    for i in range(batch_size):
+        msg['recipient']['id'] = 'USER_%d_%d' % (round, i)
+        yield transport.add_request(payloads.queued_request(msg))
+
+
+@inlineCallbacks
+def bench_dispatch_requests(transport, scale=1):
+    """Assemble batches from the request queue, without the response."""
+    rounds = max(1, int(50 * scale))
+    batch_size = transport.batch_size
+    batch_response = FakeResponse(200, '[]')
+    transport.send_batch = lambda batch: succeed(batch_response)
+
+    def handle_batch_response(response, sent_at=None):
+        transport.pending_requests = []
+        return succeed(None)
+
+    transport.handle_batch_response = handle_batch_response
+
+    elapsed = 0
+    for r in range(rounds):
+        yield fill_request_queue(transport, batch_size, r)
+        start = time.time()
+        yield transport._dispatch_requests()
+        elapsed += time.time() - start
+
+    del transport.send_batch
+    del transport.handle_batch_response
+    returnValue([result(
+        'dispatch_requests', elapsed / rounds * 1e6, 'us/batch', rounds)])
+
+
+@inlineCallbacks
+def bench_handle_batch_response(transport, scale=1):
+    """Process successful batch responses, publishing acks."""
+    rounds = max(1, int(50 * scale))
+    batch_size = transport.batch_size
+    response = FakeResponse(
+        200, codec.dumps(payloads.batch_response(batch_size)))
+    elapsed = 0
+    for r in range(rounds):
+        transport.pending_requests = [{
+            'message_id': 'message-%d-%d' % (r, i),
+            'recipient': 'USER_%d_%d' % (r, i),
+        } for i in range(batch_size)]
+        start = time.time()
+        yield transport.handle_batch_response(response)
+        elapsed += time.time() - start
+    returnValue([result(
+        'handle_batch_response', elapsed / rounds * 1e6, 'us/batch', rounds)])
+
+
+@inlineCallbacks
+def run(scale=1):
+    """Run the transport benchmarks and return their results."""
+    results = bench_page_from_fp(scale)
+
+    # The fake Redis adds latency to each call to catch tests that don't
+    # wait for its results, which would swamp what is being measured here.
+    fake_redis_wait = fake_redis.FAKE_REDIS_WAIT
+    fake_redis.FAKE_REDIS_WAIT = 0
+    helper = TransportHelper(BenchmarkTransport)
+    helper.setup()
+    try:
+        transport = yield helper.get_transport({
+            'web_port': 0,
+            'web_path': '/api',
+            'access_token': 'TOKEN',
+            'outbound_url': 'https://graph.facebook.com/v2.6/me/messages',
+        })
+        # Dispatch batches from the benchmarks only
+        transport._request_loop.stop()
+
+        results.extend((yield bench_handle_outbound_message(
+            helper, transport, scale)))
+        results.extend((yield bench_dispatch_requests(transport, scale)))
+        results.extend((yield bench_handle_batch_response(transport, scale)))
+    finally:
+        yield helper.cleanup()
+        fake_redis.FAKE_REDIS_WAIT = fake_redis_wait
+    returnValue(results)
+
+
+def main():  # pragma: nocover
+    from twisted.internet.task import react
+
+    @inlineCallbacks
+    def _main(reactor):
+        for r in (yield run()):
+            print '%-50s %12.2f %s' % (r['name'], r['value'], r['unit'])
+
+    react(_main)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
@@ -0,0 +1,334 @@
+"""
+Drive a whole channel with inbound webhooks and outbound messages and
+report throughput, ack latency, queue depth and CPU use.
+
+The transport runs against vumi's fake Redis and fake AMQP broker, and the
+local Graph API simulator in ``vxmessenger.api``, all in this process.
+
+    $ python -m vxmessenger.benchmarks.load --inbound-rate 50 \\
+        --outbound-rate 200 --duration 30 --batch-size 10,50 \\
+        --batch-wait 0.1,0.5 --output load.json
+"""
+import itertools
+import json
+import resource
+import time
+
+import click
+import treq
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+
+from vumi.persist import fake_redis
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxmessenger.api import ApiService
+from vxmessenger.benchmarks import payloads
+from vxmessenger.benchmarks.results import percentiles, report, write_report
+from vxmessenger.transport import MessengerTransport
+
+
+class LoadTransport(MessengerTransport):
+    """A transport that tells the load driver about acks and nacks."""
+
+    driver = None
+
+    def publish_ack(self, user_message_id, sent_message_id, **kw):
+        self.driver.outbound_done(user_message_id, 'ack')
+        return super(LoadTransport, self).publish_ack(
+            user_message_id, sent_message_id, **kw)
+
+    def publish_nack(self, user_message_id, reason, **kw):
+        self.driver.outbound_done(user_message_id, 'nack')
+        return super(LoadTransport, self).publish_nack(
+            user_message_id, reason, **kw)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Rate(object):
+    """Calls ``f`` ``rate`` times a second, in ticks of ``interval``."""
+
+    def __init__(self, rate, f, interval=0.01):
+        self.rate = rate
+        self.f = f
+        self.interval = interval
+        self.owed = 0.0
+        self.loop = LoopingCall(self.tick)
+
+    def tick(self):
+        self.owed += self.rate * self.interval
+        while self.owed >= 1:
+            self.owed -= 1
+            self.f()
+
+    def start(self):
+        if self.rate > 0:
+            self.loop.start(self.interval)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+
+class LoadDriver(object):
+
+    def __init__(self, helper, transport, url, pool, inbound_rate,
+                 outbound_rate, users=1000):
+        self.helper = helper
+        self.transport = transport
+        self.url = url
+        self.pool = pool
+        self.users = users
+        self.counter = itertools.count()
+        self.pending = {}
+        self.ack_latencies = []
+        self.webhook_latencies = []
+        self.counts = dict.fromkeys(
+            ['inbound', 'inbound_failed', 'outbound', 'ack', 'nack'], 0)
+        self.queue_depth = []
+        self.inbound = Rate(inbound_rate, self.send_inbound)
+        self.outbound = Rate(outbound_rate, self.send_outbound)
+        self.sampler = LoopingCall(self.sample)
+
+    def send_inbound(self):
+        i = next(self.counter)
+        self.post_inbound(json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': [payloads.messaging_event('text', i)],
+            }],
+        }))
+
+    def post_inbound(self, body):
+        start = time.time()
+        self.counts['inbound'] += 1
+        d = treq.post(self.url, body, pool=self.pool)
+        d.addCallback(lambda response: treq.content(response).addCallback(
+            lambda _: response.code))
+        d.addBoth(self.inbound_done, start)
+
+    def inbound_done(self, code, start):
+        if code != 200:
+            self.counts['inbound_failed'] += 1
+        else:
+            self.webhook_latencies.append(time.time() - start)
+
+    def send_outbound(self):
+        i = next(self.counter)
+        self.dispatch_outbound(self.helper.make_outbound(
+            'Message %d' % (i,), to_addr='USER_%d' % (i % self.users,)))
+
+    def dispatch_outbound(self, msg):
+        self.pending[msg['message_id']] = time.time()
+        self.counts['outbound'] += 1
+        self.helper.dispatch_outbound(msg)
+
+    def outbound_done(self, message_id, event_type):
+        start = self.pending.pop(message_id, None)
+        if start is None:
+            return
+        self.counts[event_type] += 1
+        if event_type == 'ack':
+            self.ack_latencies.append(time.time() - start)
+
+    def sample(self):
+        self.queue_depth.append(self.transport.queue_len)
+
+    @inlineCallbacks
+    def drive(self, duration):
+        self.inbound.start()
+        self.outbound.start()
+        yield deferLater(reactor, duration, lambda: None)
+        self.inbound.stop()
+        self.outbound.stop()
+
+    @inlineCallbacks
+    def run(self, duration, drain):
+        self.sampler.start(1)
+        cpu_start = cpu_seconds()
+        start = time.time()
+        yield self.drive(duration)
+
+        deadline = time.time() + drain
+        while self.pending and time.time() < deadline:
+            yield deferLater(reactor, 0.05, lambda: None)
+        elapsed = time.time() - start
+        cpu = cpu_seconds() - cpu_start
+        self.sampler.stop()
+
+        messages = self.counts['inbound'] + self.counts['outbound']
+        returnValue({
+            'duration': elapsed,
+            'counts': dict(self.counts, unfinished=len(self.pending)),
+            'throughput': {
+                'inbound_per_s': self.counts['inbound'] / elapsed,
+                'acks_per_s': self.counts['ack'] / elapsed,
+            },
+            'ack_latency': percentiles(self.ack_latencies),
+            'webhook_latency': percentiles(self.webhook_latencies),
+            'queue_depth': self.queue_depth,
+            'cpu_seconds': cpu,
+            'cpu_ms_per_message': cpu * 1000 / messages if messages else 0,
+        })
+
+
+class Channel(object):
+    """
+    A transport running against vumi's fake Redis and fake AMQP broker and
+    a local Graph API simulator, all in this process.
+    """
+
+    def __init__(self, batch_size, batch_wait, latency='fixed:0',
+                 error_rate=0, none_rate=0, seed=0):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.service = ApiService(
+            latency=latency, error_rate=error_rate, none_rate=none_rate,
+            seed=seed)
+
+    @inlineCallbacks
+    def start(self):
+        endpoint = serverFromString(reactor, 'tcp:0:interface=127.0.0.1')
+        self.listener = yield endpoint.listen(
+            Site(self.service.app.resource()))
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+
+        self.fake_redis_wait = fake_redis.FAKE_REDIS_WAIT
+        fake_redis.FAKE_REDIS_WAIT = 0
+        self.helper = TransportHelper(LoadTransport)
+        self.helper.setup()
+        self.transport = yield self.helper.get_transport({
+            'web_port': 0,
+            'web_path': '/api',
+            'access_token': 'TOKEN',
+            'outbound_url': 'http://127.0.0.1:%d/v2.6/me/messages' % (
+                self.listener.getHost().port,),
+            'request_batch_size': self.batch_size,
+            'request_batch_wait_time': self.batch_wait,
+        })
+        self.url = self.transport.get_transport_url('/api')
+
+    @inlineCallbacks
+    def stop(self):
+        yield self.helper.cleanup()
+        fake_redis.FAKE_REDIS_WAIT = self.fake_redis_wait
+        yield self.pool.closeCachedConnections()
+        yield self.listener.stopListening()
+
+    def add_details(self, result):
+        result.update({
+            'request_batch_size': self.batch_size,
+            'request_batch_wait_time': self.batch_wait,
+            'graph_api': dict(self.service.stats),
+        })
+        return result
+
+
+@inlineCallbacks
+def run_load(inbound_rate, outbound_rate, duration, batch_size, batch_wait,
+             latency='fixed:0', error_rate=0, none_rate=0, drain=10,
+             seed=0):
+    """
+    Run a channel with ``batch_size`` and ``batch_wait`` under load for
+    ``duration`` seconds, then wait up to ``drain`` seconds for outstanding
+    outbound messages, and return a report of what happened.
+    """
+    channel = Channel(
+        batch_size, batch_wait, latency=latency, error_rate=error_rate,
+        none_rate=none_rate, seed=seed)
+    yield channel.start()
+    try:
+        driver = LoadDriver(
+            channel.helper, channel.transport, channel.url, channel.pool,
+            inbound_rate, outbound_rate)
+        channel.transport.driver = driver
+        result = yield driver.run(duration, drain)
+    finally:
+        yield channel.stop()
+
+    result.update({
+        'inbound_rate': inbound_rate,
+        'outbound_rate': outbound_rate,
+    })
+    returnValue(channel.add_details(result))
+
+
+def summary(result):
+    return (
+        'batch_size=%(request_batch_size)-4s '
+        'batch_wait=%(request_batch_wait_time)-5s '
+        'acks/s=%(acks)8.1f '
+        'ack p50/p99=%(p50)6.0f/%(p99)6.0fms '
+        'queue max=%(queue)-6s cpu/msg=%(cpu).2fms' % {
+            'request_batch_size': result['request_batch_size'],
+            'request_batch_wait_time': result['request_batch_wait_time'],
+            'acks': result['throughput']['acks_per_s'],
+            'p50': result['ack_latency']['p50'] * 1000,
+            'p99': result['ack_latency']['p99'] * 1000,
+            'queue': max(result['queue_depth'] or [0]),
+            'cpu': result['cpu_ms_per_message'],
+        })
+
+
+def parse_list(f):
+    def parse(ctx, param, value):
+        try:
+            return [f(v) for v in value.split(',')]
+        except ValueError:
+            raise click.BadParameter('must be a comma separated list')
+    return parse
+
+
+@click.command()
+@click.option('--inbound-rate', default=50.0, type=float,
+              help='Inbound webhook requests per second.')
+@click.option('--outbound-rate', default=100.0, type=float,
+              help='Outbound messages per second.')
+@click.option('--duration', default=10.0, type=float,
+              help='How long to apply load for, in seconds.')
+@click.option('--drain', default=10.0, type=float,
+              help='How long to wait for outstanding messages afterwards.')
+@click.option('--batch-size', default='50', callback=parse_list(int),
+              help='Comma separated request_batch_size values to sweep.')
+@click.option('--batch-wait', default='0.1', callback=parse_list(float),
+              help='Comma separated request_batch_wait_time values to sweep.')
+@click.option('--latency', default='fixed:0.05',
+              help='The Graph API latency distribution.')
+@click.option('--error-rate', default=0.0, type=float,
+              help='The fraction of Graph API calls that fail.')
+@click.option('--none-rate', default=0.0, type=float,
+              help='The fraction of batched calls that are not completed.')
+@click.option('--output', type=click.File('w'),
+              help='Where to write the full results as JSON.')
+def cli(inbound_rate, outbound_rate, duration, drain, batch_size, batch_wait,
+        latency, error_rate, none_rate, output):  # pragma: nocover
+    from twisted.internet.task import react
+
+    @inlineCallbacks
+    def main(reactor):
+        results = []
+        for size, wait in itertools.product(batch_size, batch_wait):
+            result = yield run_load(
+                inbound_rate, outbound_rate, duration, size, wait,
+                latency=latency, error_rate=error_rate, none_rate=none_rate,
+                drain=drain)
+            click.echo(summary(result))
+            results.append(result)
+        if output is not None:
+            write_report(report(results), output)
+
+    react(main)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    cli()
@@ -0,0 +1,193 @@
+"""
+Payloads shaped like the ones the transport handles in production, for use
+in benchmarks.
+"""
+import json
+import random
+from urllib import urlencode
+
+
+def inbound_text(n=1):
+    """A webhook request carrying ``n`` text messages."""
+    return {
+        'object': 'page',
+        'entry': [{
+            'id': 'PAGE_ID',
+            'time': 1457764198246,
+            'messaging': [{
+                'sender': {'id': '1234567890%d' % (i,)},
+                'recipient': {'id': 'PAGE_ID'},
+                'timestamp': 1457764197627 + i,
+                'message': {
+                    'mid': 'mid.1457764197618:41d102a3e1ae206a38%d' % (i,),
+                    'seq': 73 + i,
+                    'text': u'Hello, world! \u2603',
+                },
+            } for i in range(n)],
+        }],
+    }
+
+
+def inbound_postback():
+    """A webhook request carrying a postback with a JSON payload."""
+    return {
+        'object': 'page',
+        'entry': [{
+            'id': 'PAGE_ID',
+            'time': 1457764198246,
+            'messaging': [{
+                'sender': {'id': '1234567890'},
+                'recipient': {'id': 'PAGE_ID'},
+                'timestamp': 1457764197627,
+                'postback': {
+                    'payload': '{"content":"1","in_reply_to":"%s"}' % (
+                        'a' * 32,),
+                },
+            }],
+        }],
+    }
+
+
+def outbound_template():
+    """A Send API generic template message with quick replies."""
+    return {
+        'recipient': {'id': '1234567890'},
+        'message': {
+            'attachment': {
+                'type': 'template',
+                'payload': {
+                    'template_type': 'generic',
+                    'elements': [{
+                        'title': 'Element %d' % (i,),
+                        'subtitle': 'A subtitle',
+                        'image_url': 'https://example.com/image.jpg',
+                        'buttons': [{
+                            'type': 'postback',
+                            'title': 'Choose',
+                            'payload': '{"content":"%d"}' % (i,),
+                        }, {
+                            'type': 'web_url',
+                            'title': 'Website',
+                            'url': 'https://example.com/%d' % (i,),
+                        }],
+                    } for i in range(3)],
+                },
+            },
+            'quick_replies': [{
+                'content_type': 'text',
+                'title': 'Option %d' % (i,),
+                'payload': '{"content":"%d"}' % (i,),
+            } for i in range(5)],
+        },
+    }
+
+
+def queued_request(msg=None):
+    """A request as the transport stores it in the Redis request queue."""
+    msg = msg or outbound_template()
+    return {
+        'message_id': 'a' * 32,
+        'recipient': msg['recipient']['id'],
+        'method': 'POST',
+        'relative_url': 'v2.6/me/messages',
+        'body': urlencode({
+            k: json.dumps(v, separators=(',', ':'))
+            for k, v in msg.items()
+        }),
+    }
+
+
+def batch_response(n=50):
+    """A batch API response for ``n`` successful sends."""
+    return [{
+        'code': 200,
+        'body': json.dumps({
+            'recipient_id': '1234567890%d' % (i,),
+            'message_id': 'mid.1457764197618:41d102a3e1ae206a38%d' % (i,),
+        }),
+    } for i in range(n)]
+
+
+def messaging_event(event_type, i):
+    """A single webhook messaging event of ``event_type``."""
+    event = {
+        'sender': {'id': '1234567890%d' % (i % 1000,)},
+        'recipient': {'id': 'PAGE_ID'},
+        'timestamp': 1457764197627 + i,
+    }
+    mid = 'mid.1457764197618:41d102a3e1ae206a38%d' % (i,)
+    if event_type == 'text':
+        event['message'] = {'mid': mid, 'seq': i, 'text': u'Hello \u2603'}
+    elif event_type == 'quick_reply':
+        event['message'] = {
+            'mid': mid,
+            'seq': i,
+            'text': 'Option 1',
+            'quick_reply': {'payload': '{"content":"1"}'},
+        }
+    elif event_type == 'postback':
+        event['postback'] = {
+            'payload': '{"content":"1","in_reply_to":"%s"}' % ('a' * 32,),
+        }
+    elif event_type == 'attachment':
+        event['message'] = {
+            'mid': mid,
+            'seq': i,
+            'attachments': [{
+                'type': 'image',
+                'payload': {'url': 'https://scontent.xx.fbcdn.net/%d.jpg' % (
+                    i,)},
+            }],
+        }
+    elif event_type in ('delivery', 'read'):
+        event[event_type] = {'watermark': 1457764197627 + i, 'seq': i}
+        if event_type == 'delivery':
+            event[event_type]['mids'] = [mid]
+    else:
+        raise ValueError('Unknown event type %r' % (event_type,))
+    return event
+
+
+# Proportions of each event type in the synthetic corpora
+EVENT_MIXES = {
+    'text': {'text': 1},
+    'interactive': {'postback': 1, 'quick_reply': 1},
+    'receipts': {'delivery': 1, 'read': 1},
+    'production': {
+        'text': 55, 'postback': 10, 'quick_reply': 10, 'attachment': 5,
+        'delivery': 12, 'read': 8,
+    },
+}
+
+
+def webhook_corpus(mix, requests, events_per_request=1, seed=0):
+    """
+    Return ``requests`` webhook request bodies, each carrying
+    ``events_per_request`` events drawn from ``EVENT_MIXES[mix]``.
+    """
+    rng = random.Random(seed)
+    weights = sorted(EVENT_MIXES[mix].items())
+    total = sum(w for _, w in weights)
+
+    def pick():
+        n = rng.uniform(0, total)
+        for event_type, w in weights:
+            n -= w
+            if n <= 0:
+                return event_type
+        return weights[-1][0]
+
+    corpus = []
+    for r in range(requests):
+        events = [
+            messaging_event(pick(), r * events_per_request + e)
+            for e in range(events_per_request)]
+        corpus.append(json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': events,
+            }],
+        }))
+    return corpus
@@ -0,0 +1,129 @@
+"""
+Replay traffic recorded with the transport's ``capture_path`` option into a
+channel running against the local Graph API simulator, at the recorded pace
+or faster, and report throughput, ack latency, queue depth and CPU use.
+
+    $ python -m vxmessenger.benchmarks.replay capture.jsonl.gz --speed 10 \\
+        --batch-size 50 --batch-wait 0.1 --output replay.json
+"""
+import time
+
+import click
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+
+from vumi.message import TransportUserMessage
+
+from vxmessenger.benchmarks.load import Channel, LoadDriver, summary
+from vxmessenger.benchmarks.results import report, write_report
+from vxmessenger.capture import read_capture
+
+
+class ReplayDriver(LoadDriver):
+    """
+    Sends the inbound webhook requests and outbound messages in ``records``
+    at ``speed`` times the pace they were recorded at. A ``speed`` of 0
+    sends them as fast as possible.
+    """
+
+    def __init__(self, helper, transport, url, pool, records, speed=1):
+        super(ReplayDriver, self).__init__(
+            helper, transport, url, pool, inbound_rate=0, outbound_rate=0)
+        self.records = records
+        self.speed = speed
+
+    def replay(self, record):
+        if record['type'] == 'inbound':
+            self.post_inbound(record['body'].encode('utf-8'))
+        elif record['type'] == 'outbound':
+            self.dispatch_outbound(
+                TransportUserMessage.from_json(record['message']))
+
+    @inlineCallbacks
+    def drive(self, duration=None):
+        start = time.time()
+        first = None
+        for record in self.records:
+            if first is None:
+                first = record['timestamp']
+            elapsed = record['timestamp'] - first
+            if duration is not None and elapsed > duration:
+                break
+            if self.speed:
+                delay = start + elapsed / self.speed - time.time()
+                if delay > 0:
+                    yield deferLater(reactor, delay, lambda: None)
+            self.replay(record)
+
+
+@inlineCallbacks
+def run_replay(path, speed, batch_size, batch_wait, duration=None,
+               latency='fixed:0', error_rate=0, none_rate=0, drain=10,
+               seed=0):
+    """
+    Replay the capture at ``path`` into a channel with ``batch_size`` and
+    ``batch_wait``, stopping after ``duration`` seconds of recorded traffic
+    if given, then wait up to ``drain`` seconds for outstanding outbound
+    messages, and return a report of what happened.
+    """
+    channel = Channel(
+        batch_size, batch_wait, latency=latency, error_rate=error_rate,
+        none_rate=none_rate, seed=seed)
+    yield channel.start()
+    try:
+        driver = ReplayDriver(
+            channel.helper, channel.transport, channel.url, channel.pool,
+            read_capture(path), speed)
+        channel.transport.driver = driver
+        result = yield driver.run(duration, drain)
+    finally:
+        yield channel.stop()
+
+    result.update({
+        'capture': path,
+        'speed': speed,
+    })
+    returnValue(channel.add_details(result))
+
+
+@click.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--speed', default=1.0, type=float,
+              help='How many times faster than recorded to replay, or 0 '
+                   'to replay as fast as possible.')
+@click.option('--duration', default=None, type=float,
+              help='Only replay this many seconds of recorded traffic.')
+@click.option('--drain', default=10.0, type=float,
+              help='How long to wait for outstanding messages afterwards.')
+@click.option('--batch-size', default=50, type=int,
+              help='The request_batch_size to use.')
+@click.option('--batch-wait', default=0.1, type=float,
+              help='The request_batch_wait_time to use.')
+@click.option('--latency', default='fixed:0.05',
+              help='The Graph API latency distribution.')
+@click.option('--error-rate', default=0.0, type=float,
+              help='The fraction of Graph API calls that fail.')
+@click.option('--none-rate', default=0.0, type=float,
+              help='The fraction of batched calls that are not completed.')
+@click.option('--output', type=click.File('w'),
+              help='Where to write the full results as JSON.')
+def cli(path, speed, duration, drain, batch_size, batch_wait, latency,
+        error_rate, none_rate, output):  # pragma: nocover
+    from twisted.internet.task import react
+
+    @inlineCallbacks
+    def main(reactor):
+        result = yield run_replay(
+            path, speed, batch_size, batch_wait, duration=duration,
+            latency=latency, error_rate=error_rate, none_rate=none_rate,
+            drain=drain)
+        click.echo(summary(result))
+        if output is not None:
+            write_report(report([result]), output)
+
+    react(main)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    cli()
@@ -0,0 +1,77 @@
+"""
+Benchmark results and comparing them against a baseline.
+
+Results are dicts with the benchmark's ``name``, its ``value`` in ``unit``
+and the number of ``iterations`` it was measured over. Rates (units ending
+in ``/s``) are better when higher, all other units are times and are better
+when lower.
+"""
+import json
+import math
+import platform
+import time
+
+from vxmessenger import codec
+
+
+def result(name, value, unit, iterations):
+    return {
+        'name': name,
+        'value': value,
+        'unit': unit,
+        'iterations': iterations,
+    }
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Return the ``points`` percentiles of ``values`` as ``{'p50': ...}``,
+    along with the ``max``, using the nearest rank method.
+    """
+    values = sorted(values)
+    result = {}
+    for point in points:
+        if values:
+            rank = max(0, int(math.ceil(point / 100.0 * len(values))) - 1)
+            result['p%d' % (point,)] = values[rank]
+        else:
+            result['p%d' % (point,)] = 0
+    result['max'] = values[-1] if values else 0
+    return result
+
+
+def report(results):
+    """Wrap ``results`` with details of the environment they came from."""
+    return {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'codec': codec.name(),
+        'results': results,
+    }
+
+
+def write_report(report, fp):
+    json.dump(
+        report, fp, indent=2, sort_keys=True, separators=(',', ': '))
+    fp.write('\n')
+
+
+def regressions(baseline, results, tolerance):
+    """
+    Return ``(result, baseline_result, change)`` for each result that is
+    worse than the result of the same name in the ``baseline`` report by
+    more than ``tolerance`` (a fraction, so 0.2 is 20%).
+    """
+    baseline = dict((r['name'], r) for r in baseline['results'])
+    worse = []
+    for r in results:
+        b = baseline.get(r['name'])
+        if b is None or b['unit'] != r['unit'] or not b['value']:
+            continue
+        change = (r['value'] - b['value']) / float(b['value'])
+        if r['unit'].endswith('/s'):
+            change = -change
+        if change > tolerance:
+            worse.append((r, b, change))
+    return worse
@@ -0,0 +1,328 @@
+"""
+Predict how a channel's dispatch settings cope with a given load, by running
+the transport's outbound dispatch code against a virtual clock.
+
+Outbound messages arrive at random at the given rate, to recipients drawn
+from the given distribution, and are handled by one or more transport
+workers sharing a request queue. Graph API calls are answered by the
+simulator in ``vxmessenger.api`` after a latency drawn from the given
+distribution. Nothing waits for real time to pass, so minutes of traffic are
+simulated in seconds.
+
+    $ python -m vxmessenger.benchmarks.simulate --rate 200 --duration 300 \\
+        --recipients zipf:1.2 --batch-size 10,50 --batch-wait 0.1,0.5 \\
+        --workers 1,2 --latency lognormal:0.15,0.6
+"""
+import itertools
+import random
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+import click
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, maybeDeferred, returnValue, succeed)
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import MessageHelper
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxmessenger import codec
+from vxmessenger.api import ApiService
+from vxmessenger.benchmarks.bench_transport import FakeResponse
+from vxmessenger.benchmarks.load import parse_list
+from vxmessenger.benchmarks.results import percentiles, report, write_report
+from vxmessenger.transport import MessengerTransport
+
+
+class SimulatedTransport(MessengerTransport):
+    """A transport whose Graph API calls and published events are simulated."""
+
+    simulation = None
+
+    def request(self, method, url, data, **kw):
+        return self.simulation.graph_request(data)
+
+    def publish_ack(self, user_message_id, sent_message_id, **kw):
+        self.simulation.outbound_done(user_message_id, 'ack')
+        return succeed(None)
+
+    def publish_nack(self, user_message_id, reason, **kw):
+        self.simulation.outbound_done(user_message_id, 'nack')
+        return succeed(None)
+
+    def add_status(self, **kw):
+        return succeed(None)
+
+
+def parse_recipients(spec, users):
+    """
+    Parse a recipient distribution and return a function that picks one of
+    ``users`` recipients, given a ``random.Random``. Distributions are given
+    as ``uniform``, or ``zipf:EXPONENT`` where the few busiest recipients
+    get most of the messages.
+    """
+    kind, _, param = spec.partition(':')
+    if kind == 'uniform' and not param:
+        return lambda rng: 'USER_%d' % (rng.randrange(users),)
+    if kind == 'zipf':
+        try:
+            exponent = float(param)
+        except ValueError:
+            pass
+        else:
+            cumulative = []
+            total = 0
+            for k in range(1, users + 1):
+                total += 1.0 / (k ** exponent)
+                cumulative.append(total)
+            return lambda rng: 'USER_%d' % (
+                bisect_left(cumulative, rng.random() * total),)
+    raise ValueError('Invalid recipient distribution: %r' % (spec,))
+
+
+class Simulation(object):
+    """
+    Sends outbound messages to ``transports`` at ``rate`` a second for
+    ``duration`` seconds of virtual time, and records what happens to them.
+    """
+
+    def __init__(self, transports, clock, service, rate, duration,
+                 recipients, seed=0):
+        self.transports = transports
+        self.clock = clock
+        self.service = service
+        self.rate = rate
+        self.duration = duration
+        self.recipients = recipients
+        self.random = random.Random(seed)
+        self.msg_helper = MessageHelper()
+        self.workers = itertools.cycle(transports)
+        self.pending = {}
+        self.latencies = defaultdict(list)
+        self.counts = dict.fromkeys(['outbound', 'ack', 'nack'], 0)
+        self.queue_depth = []
+
+    def graph_request(self, data):
+        code, body = self.service.handle_batch(codec.loads(data['batch']))
+        d = Deferred()
+        self.clock.callLater(
+            self.service.latency(self.service.random), d.callback,
+            FakeResponse(code, codec.dumps(body)))
+        return d
+
+    def schedule_arrival(self):
+        if self.rate:
+            self.clock.callLater(
+                self.random.expovariate(self.rate), self.arrive)
+
+    def arrive(self):
+        if self.clock.seconds() > self.duration:
+            return
+        recipient = self.recipients(self.random)
+        msg = self.msg_helper.make_outbound('Hello', to_addr=recipient)
+        self.pending[msg['message_id']] = (recipient, self.clock.seconds())
+        self.counts['outbound'] += 1
+        next(self.workers).handle_outbound_message(msg)
+        self.schedule_arrival()
+
+    def outbound_done(self, message_id, event_type):
+        pending = self.pending.pop(message_id, None)
+        if pending is None:
+            return
+        recipient, start = pending
+        self.counts[event_type] += 1
+        if event_type == 'ack':
+            self.latencies[recipient].append(self.clock.seconds() - start)
+
+    def sample(self):
+        transport = self.transports[0]
+        d = maybeDeferred(transport.redis.llen, transport.REQ_QUEUE_KEY)
+        d.addCallback(self.queue_depth.append)
+        if self.clock.seconds() < self.duration or self.pending:
+            self.clock.callLater(1, self.sample)
+
+    def run(self, drain):
+        """
+        Run the simulation until ``drain`` seconds of virtual time after the
+        last arrival, or until every message has been acked or nacked.
+        """
+        self.schedule_arrival()
+        self.sample()
+        end = self.duration + drain
+        while self.clock.seconds() < end:
+            if self.clock.seconds() > self.duration and not self.pending:
+                break
+            calls = self.clock.getDelayedCalls()
+            if not calls:
+                break
+            next_call = min(min(call.getTime() for call in calls), end)
+            self.clock.advance(max(0, next_call - self.clock.seconds()))
+
+    def result(self):
+        latencies = sorted(
+            itertools.chain.from_iterable(self.latencies.values()))
+        busiest = sorted(
+            self.latencies.items(), key=lambda item: len(item[1]),
+            reverse=True)
+        depth = self.queue_depth or [0]
+        return {
+            'virtual_seconds': self.clock.seconds(),
+            'counts': dict(self.counts, unfinished=len(self.pending)),
+            'throughput': {
+                'offered_per_s': self.rate,
+                'acks_per_s': self.counts['ack'] / self.clock.seconds(),
+            },
+            'ack_latency': percentiles(latencies),
+            'busiest_recipients': [{
+                'recipient': recipient,
+                'messages': len(recipient_latencies),
+                'ack_latency': percentiles(sorted(recipient_latencies)),
+            } for recipient, recipient_latencies in busiest[:5]],
+            'queue_depth': {
+                'max': max(depth),
+                'end': depth[-1],
+                'growth_per_s': (
+                    float(depth[-1] - depth[0]) / max(1, len(depth) - 1)),
+            },
+        }
+
+
+@inlineCallbacks
+def run_simulation(rate, duration, batch_size, batch_wait, workers=1,
+                   users=1000, recipients='uniform', latency='fixed:0.1',
+                   error_rate=0, none_rate=0, drain=60, seed=0):
+    """
+    Simulate ``duration`` seconds of outbound traffic at ``rate`` messages
+    a second through ``workers`` transport workers configured with
+    ``batch_size`` and ``batch_wait``, and return a report of what happened.
+    """
+    clock = Clock()
+    service = ApiService(
+        latency=latency, error_rate=error_rate, none_rate=none_rate,
+        seed=seed, clock=clock)
+    helper = TransportHelper(SimulatedTransport)
+    helper.setup()
+    try:
+        transports = []
+        for i in range(workers):
+            transport = yield helper.get_transport({
+                'web_port': 0,
+                'web_path': '/api',
+                'access_token': 'TOKEN',
+                'outbound_url': 'https://graph.facebook.com/v2.6/me/messages',
+                'request_batch_size': batch_size,
+                'request_batch_wait_time': batch_wait,
+            })
+            transports.append(transport)
+
+        # Share the first worker's Redis, and answer its calls immediately
+        # rather than after a real delay, so that the simulation only moves
+        # forward when the virtual clock does.
+        redis = transports[0].redis
+        client = redis._client
+        client._delay_operation = lambda func, args, kw: maybeDeferred(
+            func, client, *args, **kw)
+        simulation = Simulation(
+            transports, clock, service, rate, duration,
+            parse_recipients(recipients, users), seed=seed)
+        for transport in transports:
+            transport.simulation = simulation
+            transport.redis = redis
+            transport.clock = clock
+            transport._request_loop.stop()
+            transport._request_loop.clock = clock
+            transport._start_request_loop(transport._request_loop)
+
+        start = time.time()
+        simulation.run(drain)
+        result = simulation.result()
+        result['wall_seconds'] = time.time() - start
+        for transport in transports:
+            if transport._request_loop.running:
+                transport._request_loop.stop()
+    finally:
+        yield helper.cleanup()
+
+    result.update({
+        'request_batch_size': batch_size,
+        'request_batch_wait_time': batch_wait,
+        'workers': workers,
+        'recipients': recipients,
+        'graph_api': dict(service.stats),
+    })
+    returnValue(result)
+
+
+def summary(result):
+    return (
+        'batch_size=%(request_batch_size)-4s '
+        'batch_wait=%(request_batch_wait_time)-5s '
+        'workers=%(workers)-3s '
+        'acks/s=%(acks)8.1f '
+        'ack p50/p99=%(p50)7.0f/%(p99)7.0fms '
+        'queue max=%(queue)-7s growth=%(growth).1f/s' % {
+            'request_batch_size': result['request_batch_size'],
+            'request_batch_wait_time': result['request_batch_wait_time'],
+            'workers': result['workers'],
+            'acks': result['throughput']['acks_per_s'],
+            'p50': result['ack_latency']['p50'] * 1000,
+            'p99': result['ack_latency']['p99'] * 1000,
+            'queue': result['queue_depth']['max'],
+            'growth': result['queue_depth']['growth_per_s'],
+        })
+
+
+@click.command()
+@click.option('--rate', default=100.0, type=float,
+              help='Outbound messages per second.')
+@click.option('--duration', default=60.0, type=float,
+              help='How many seconds of traffic to simulate.')
+@click.option('--drain', default=60.0, type=float,
+              help='How long to wait for outstanding messages afterwards.')
+@click.option('--users', default=1000, type=int,
+              help='How many recipients to send messages to.')
+@click.option('--recipients', default='uniform',
+              help='How messages are spread over recipients, uniform or '
+                   'zipf:EXPONENT.')
+@click.option('--batch-size', default='50', callback=parse_list(int),
+              help='Comma separated request_batch_size values to sweep.')
+@click.option('--batch-wait', default='0.1', callback=parse_list(float),
+              help='Comma separated request_batch_wait_time values to sweep.')
+@click.option('--workers', default='1', callback=parse_list(int),
+              help='Comma separated numbers of transport workers to sweep.')
+@click.option('--latency', default='fixed:0.1',
+              help='The Graph API latency distribution.')
+@click.option('--error-rate', default=0.0, type=float,
+              help='The fraction of Graph API calls that fail.')
+@click.option('--none-rate', default=0.0, type=float,
+              help='The fraction of batched calls that are not completed.')
+@click.option('--seed', default=0, type=int,
+              help='Seed for the random number generators.')
+@click.option('--output', type=click.File('w'),
+              help='Where to write the full results as JSON.')
+def cli(rate, duration, drain, users, recipients, batch_size, batch_wait,
+        workers, latency, error_rate, none_rate, seed,
+        output):  # pragma: nocover
+    from twisted.internet.task import react
+
+    @inlineCallbacks
+    def main(reactor):
+        results = []
+        for size, wait, n in itertools.product(
+                batch_size, batch_wait, workers):
+            result = yield run_simulation(
+                rate, duration, size, wait, workers=n, users=users,
+                recipients=recipients, latency=latency,
+                error_rate=error_rate, none_rate=none_rate, drain=drain,
+                seed=seed)
+            click.echo(summary(result))
+            results.append(result)
+        if output is not None:
+            write_report(report(results), output)
+
+    react(main)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    cli()
@@ -0,0 +1,117 @@
+import hashlib
+import math
+import struct
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A bounded in-process cache with per-entry expiry.
+
+    Entries are evicted in least recently used order once ``size`` entries
+    are held. Expiry is checked against ``clock.seconds()`` on lookup.
+    """
+
+    def __init__(self, size, clock):
+        self.size = size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """Return the cached value for ``key`` or ``None`` on a miss."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock.seconds():
+                self._entries[key] = entry
+                if count:
+                    self.hits += 1
+                return value
+        if count:
+            self.misses += 1
+        return None
+
+    def set(self, key, value, ttl):
+        if self.size <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock.seconds() + ttl, value)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class BloomFilter(object):
+    """An in-process Bloom filter whose entries expire.
+
+    Two generations of bits are kept and the older one is discarded every
+    ``ttl`` seconds, so entries are remembered for at least ``ttl`` seconds.
+    Membership tests may return false positives at roughly ``error_rate``
+    once ``capacity`` keys have been added to a generation, but never false
+    negatives for keys added within the last ``ttl`` seconds.
+    """
+
+    def __init__(self, capacity, ttl, clock, error_rate=0.001):
+        self.ttl = ttl
+        self.clock = clock
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            self.num_bits * math.log(2) / capacity)))
+        self._current = self._new_generation()
+        self._previous = self._new_generation()
+        self._rotated = clock.seconds()
+
+    def _new_generation(self):
+        return bytearray((self.num_bits + 7) // 8)
+
+    def _rotate(self):
+        now = self.clock.seconds()
+        if now - self._rotated < self.ttl:
+            return
+        if now - self._rotated < 2 * self.ttl:
+            self._previous = self._current
+        else:
+            self._previous = self._new_generation()
+        self._current = self._new_generation()
+        self._rotated = now
+
+    def _offsets(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def _contains(self, bits, offsets):
+        return all(bits[o >> 3] & (1 << (o & 7)) for o in offsets)
+
+    def __contains__(self, key):
+        self._rotate()
+        offsets = self._offsets(key)
+        return any(self._contains(bits, offsets)
+                   for bits in (self._current, self._previous))
+
+    def add(self, key):
+        self._rotate()
+        for o in self._offsets(key):
+            self._current[o >> 3] |= 1 << (o & 7)
@@ -0,0 +1,67 @@
+"""
+Recording of the traffic a transport handles, so that it can be replayed
+later with ``vxmessenger.benchmarks.replay``.
+
+Captures are gzipped files with a JSON record per line. Inbound records hold
+the raw webhook request body and outbound records the vumi message, both
+with the time they were received.
+"""
+import gzip
+
+from vxmessenger import codec
+
+
+class CaptureWriter(object):
+    """
+    Appends records to the capture at ``path``, flushing them to disk
+    every ``flush_every`` records.
+    """
+
+    def __init__(self, path, clock, flush_every=100):
+        self.path = path
+        self.clock = clock
+        self.flush_every = flush_every
+        self.unflushed = 0
+        self.file = gzip.open(path, 'ab')
+
+    def write(self, record):
+        record['timestamp'] = self.clock.seconds()
+        self.file.write(codec.dumps(record))
+        self.file.write('\n')
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def inbound(self, body):
+        self.write({'type': 'inbound', 'body': body})
+
+    def outbound(self, message):
+        self.write({'type': 'outbound', 'message': message.to_json()})
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """
+    Yield the records in the capture at ``path`` in order. Captures that
+    are still being written to, or were not closed, are read up to the last
+    record flushed to disk.
+    """
+    f = gzip.open(path, 'rb')
+    try:
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, EOFError):
+                return
+            if not line:
+                return
+            if line.strip():
+                yield codec.loads(line)
+    finally:
+        f.close()
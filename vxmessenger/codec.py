@@ -0,0 +1,69 @@
+"""
+The JSON codec used by the transport.
+
+``ujson`` is used when it is installed, and the standard library's ``json``
+module otherwise. Both produce compact output and raise ``ValueError`` for
+invalid input.
+"""
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JSONCodec(object):
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UJSONCodec(object):
+    name = 'ujson'
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+def available_codecs():
+    codecs = [JSONCodec()]
+    if ujson is not None:
+        codecs.insert(0, UJSONCodec())
+    return codecs
+
+
+def use(name):
+    """Switch the codec used by ``dumps`` and ``loads`` to ``name``."""
+    global _codec
+    for codec in available_codecs():
+        if codec.name == name:
+            _codec = codec
+            return codec
+    raise ValueError('JSON codec %r is not available' % (name,))
+
+
+def name():
+    return _codec.name
+
+
+def dumps(obj):
+    return _codec.dumps(obj)
+
+
+def loads(data):
+    return _codec.loads(data)
+
+
+def load(fp):
+    return _codec.loads(fp.read())
+
+
+_codec = available_codecs()[0]
@@ -0,0 +1,178 @@
+"""
+Metrics kept in process and exported in the Prometheus text format.
+
+Values are either updated as things happen (``Counter.inc``, ``Gauge.set``,
+``Histogram.observe``) or read when the metrics are rendered from a function
+given when the metric is created. Collectors registered with
+``MetricsRegistry.add_collector`` are run before rendering, to update
+metrics that need asynchronous lookups such as Redis queue lengths.
+"""
+from bisect import bisect_left
+
+from twisted.internet.defer import gatherResults, maybeDeferred
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (k, unicode(v).encode('utf-8').replace(
+            '\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in sorted(labels.items())),)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(label, '') for label in self.labels)
+
+    def values(self):
+        """
+        Return a list of ``(labels, value)`` pairs. If the metric has a
+        function, it returns either a single value or, for labelled
+        metrics, a dict mapping label value tuples to values.
+        """
+        if self.func is None:
+            values = self._values
+        else:
+            values = self.func()
+            if not self.labels:
+                values = {(): values}
+        return [(dict(zip(self.labels, key)), value)
+                for key, value in sorted(values.items())]
+
+    def samples(self):
+        for labels, value in self.values():
+            yield self.name, labels, value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = sorted(buckets) + [float('inf')]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * len(self.buckets), [0, 0])
+        counts, totals = self._values[key]
+        counts[bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def samples(self):
+        for labels, (counts, (total, count)) in self.values():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '%s_bucket' % (self.name,), dict(labels, le=bound), (
+                    cumulative)
+            yield '%s_sum' % (self.name,), labels, total
+            yield '%s_count' % (self.name,), labels, count
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, prefix='', labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.metrics = []
+        self.collectors = []
+
+    def _add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), func=None):
+        return self._add(Counter(name, help, labels, func))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._add(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def add_collector(self, f):
+        self.collectors.append(f)
+
+    def collect(self):
+        return gatherResults(
+            [maybeDeferred(f) for f in self.collectors], consumeErrors=True)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                labels = dict(self.labels, **labels)
+                if 'le' in labels:
+                    labels['le'] = format_value(labels['le'])
+                lines.append('%s%s %s' % (
+                    name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(Resource):
+    """Serves the metrics in a ``MetricsRegistry``."""
+
+    isLeaf = True
+    CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        d = self.registry.collect()
+        d.addCallback(lambda _: self.registry.render())
+        d.addCallback(self._finish, request)
+        d.addErrback(self._error, request)
+        return NOT_DONE_YET
+
+    def _finish(self, body, request):
+        request.setHeader('Content-Type', self.CONTENT_TYPE)
+        request.write(body)
+        request.finish()
+
+    def _error(self, failure, request):
+        request.setResponseCode(500)
+        request.write('Unable to collect metrics: %s\n' % (
+            failure.getErrorMessage(),))
+        request.finish()
@@ -0,0 +1,183 @@
+"""
+Tools for finding out where the reactor thread spends its time in a running
+transport.
+"""
+import cProfile
+import os
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.web import http
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from vxmessenger import codec
+
+
+class ReactorLagMonitor(object):
+    """
+    Measures how late the reactor runs a call scheduled every ``interval``
+    seconds, passing the lag to ``on_lag``.
+
+    A watchdog thread checks that the call has run within
+    ``stall_threshold`` seconds of when it was due. If it hasn't, the stack
+    of the reactor thread is captured, and passed to ``on_stall`` along with
+    the lag once the reactor runs the call again.
+    """
+
+    def __init__(self, interval, stall_threshold, on_lag, on_stall,
+                 clock=reactor, time=time.time):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.on_lag = on_lag
+        self.on_stall = on_stall
+        self.clock = clock
+        self.time = time
+        self.last_beat = None
+        self.stall_stack = None
+        self._call = None
+        self._stopped = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self.thread_id = thread.get_ident()
+        self.last_beat = self.time()
+        self._call = self.clock.callLater(self.interval, self.beat)
+        if self.stall_threshold:
+            self._watchdog = threading.Thread(
+                target=self.watch, name='ReactorLagMonitor')
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._stopped.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def beat(self):
+        now = self.time()
+        lag = max(0, now - self.last_beat - self.interval)
+        self.last_beat = now
+        self.on_lag(lag)
+
+        stack, self.stall_stack = self.stall_stack, None
+        if stack is not None:
+            self.on_stall(lag, stack)
+        self._call = self.clock.callLater(self.interval, self.beat)
+
+    def watch(self):
+        while not self._stopped.wait(self.stall_threshold / 2.0):
+            self.check()
+
+    def check(self):
+        """
+        Capture the reactor thread's stack if the reactor is stalled.
+        Called from the watchdog thread.
+        """
+        if self.stall_stack is not None:
+            return
+        overdue = self.time() - self.last_beat - self.interval
+        if overdue < self.stall_threshold:
+            return
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            self.stall_stack = ''.join(traceback.format_stack(frame))
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while one is being captured."""
+
+
+class Profiler(object):
+    """
+    Captures CPU profiles of the reactor thread for a fixed time, and writes
+    them to ``path`` in the format read by ``pstats``.
+    """
+
+    def __init__(self, path, name='vxmessenger', clock=reactor):
+        self.path = path
+        self.name = name
+        self.clock = clock
+        self.running = False
+
+    def profile(self, seconds):
+        """
+        Profile for ``seconds`` seconds. Fires with the name of the file the
+        profile was written to.
+        """
+        if self.running:
+            raise ProfilerBusy()
+        self.running = True
+        filename = os.path.join(self.path, '%s-%d.prof' % (
+            self.name, int(time.time())))
+        profile = cProfile.Profile()
+        profile.enable()
+        d = Deferred()
+        self.clock.callLater(seconds, self._finish, profile, filename, d)
+        return d
+
+    def _finish(self, profile, filename, d):
+        profile.disable()
+        self.running = False
+        try:
+            profile.dump_stats(filename)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(filename)
+
+
+class ProfileResource(Resource):
+    """
+    Captures a profile with a ``Profiler`` when POSTed to, for the number
+    of seconds given in the ``seconds`` parameter, and responds with the
+    name of the file it was written to.
+    """
+
+    isLeaf = True
+    DEFAULT_SECONDS = 30
+    MAX_SECONDS = 600
+
+    def __init__(self, profiler):
+        Resource.__init__(self)
+        self.profiler = profiler
+
+    def respond(self, request, code, body):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        request.write(codec.dumps(body))
+        request.finish()
+
+    def render_POST(self, request):
+        try:
+            seconds = float(request.args.get(
+                'seconds', [self.DEFAULT_SECONDS])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= self.MAX_SECONDS:
+            request.setResponseCode(http.BAD_REQUEST)
+            return codec.dumps({
+                'error': 'seconds must be between 0 and %d' % (
+                    self.MAX_SECONDS,),
+            })
+
+        try:
+            d = self.profiler.profile(seconds)
+        except ProfilerBusy:
+            request.setResponseCode(http.CONFLICT)
+            return codec.dumps({'error': 'A profile is already running'})
+
+        d.addCallback(lambda path: self.respond(
+            request, http.OK, {'path': path}))
+        d.addErrback(lambda f: self.respond(
+            request, http.INTERNAL_SERVER_ERROR,
+            {'error': f.getErrorMessage()}))
+        return NOT_DONE_YET
@@ -0,0 +1,237 @@
+import json
+from urllib import urlencode
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.endpoints import serverFromString
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+from twisted.web.test.requesthelper import DummyRequest
+
+import treq
+
+from vxmessenger.api import ApiService, parse_latency
+
+
+class TestParseLatency(TestCase):
+
+    def test_fixed(self):
+        self.assertEqual(parse_latency('fixed:0.5')(None), 0.5)
+
+    def test_distributions(self):
+        import random
+        rng = random.Random(0)
+        for spec in ['uniform:0.1,0.2', 'exponential:0.1',
+                     'lognormal:0.1,0.5']:
+            sample = parse_latency(spec)
+            self.assertTrue(all(sample(rng) >= 0 for _ in range(100)))
+        uniform = parse_latency('uniform:0.1,0.2')
+        self.assertTrue(all(
+            0.1 <= uniform(rng) <= 0.2 for _ in range(100)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_latency, 'fixed')
+        self.assertRaises(ValueError, parse_latency, 'uniform:1')
+        self.assertRaises(ValueError, parse_latency, 'gamma:1,2')
+
+
+class TestApiService(TestCase):
+
+    def setUp(self):
+        # cleanup stuff for treq's global http request pool
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.addCleanup(self.pool.closeCachedConnections)
+
+    @inlineCallbacks
+    def start_service(self, **kw):
+        service = ApiService(**kw)
+        endpoint = serverFromString(reactor, 'tcp:0')
+        listener = yield endpoint.listen(Site(service.app.resource()))
+        self.addCleanup(listener.loseConnection)
+        self.url = 'http://127.0.0.1:%s' % (listener.getHost().port,)
+        returnValue(service)
+
+    def mk_message(self, user_id):
+        return {
+            'method': 'POST',
+            'relative_url': 'v2.6/me/messages',
+            'body': urlencode({
+                'recipient': json.dumps({'id': user_id}),
+                'message': json.dumps({'text': 'hi'}),
+            }),
+        }
+
+    def mk_profile(self, user_id):
+        return {
+            'method': 'GET',
+            'relative_url': 'v2.6/%s?%s' % (user_id, urlencode({
+                'fields': 'first_name,last_name,profile_pic',
+            })),
+        }
+
+    @inlineCallbacks
+    def post_batch(self, batch):
+        response = yield treq.post(self.url, {
+            'access_token': 'TOKEN',
+            'include_headers': 'false',
+            'batch': json.dumps(batch),
+        }, pool=self.pool)
+        content = yield response.json()
+        returnValue((response, content))
+
+    @inlineCallbacks
+    def test_batch(self):
+        service = yield self.start_service(seed=0)
+        response, content = yield self.post_batch([
+            self.mk_message('USER_1'),
+            self.mk_profile('USER_2'),
+        ])
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            json.loads(response.headers.getRawHeaders('X-App-Usage')[0]),
+            {'call_count': 0, 'total_cputime': 0, 'total_time': 0})
+
+        [message, profile] = content
+        self.assertEqual(message['code'], 200)
+        body = json.loads(message['body'])
+        self.assertEqual(body['recipient_id'], 'USER_1')
+        self.assertTrue(body['message_id'].startswith('mid.'))
+        self.assertEqual(profile['code'], 200)
+        self.assertEqual(json.loads(profile['body']), {
+            'id': 'USER_2',
+            'first_name': 'First USER_2',
+            'last_name': 'Last USER_2',
+            'profile_pic': 'https://example.com/USER_2.jpg',
+        })
+        self.assertEqual(service.stats['batch_requests'], 2)
+
+    @inlineCallbacks
+    def test_batch_none_rate(self):
+        service = yield self.start_service(none_rate=1)
+        response, content = yield self.post_batch([
+            self.mk_message('USER_1'),
+            self.mk_message('USER_2'),
+        ])
+        self.assertEqual(content, [None, None])
+        self.assertEqual(service.stats['none'], 2)
+
+    @inlineCallbacks
+    def test_batch_error_rate(self):
+        yield self.start_service(error_rate=1, seed=0)
+        response, content = yield self.post_batch([
+            self.mk_message('USER_%d' % (i,)) for i in range(10)])
+        codes = set()
+        for result in content:
+            self.assertEqual(result['code'], 400)
+            codes.add(json.loads(result['body'])['error']['code'])
+        self.assertTrue(codes <= set(c for c, _, _ in ApiService.ERRORS))
+
+    @inlineCallbacks
+    def test_batch_throttle_rate(self):
+        yield self.start_service(throttle_rate=1)
+        response, [result] = yield self.post_batch([
+            self.mk_message('USER_1')])
+        self.assertEqual(json.loads(result['body'])['error']['code'], 613)
+
+    @inlineCallbacks
+    def test_rate_limit(self):
+        yield self.start_service(rate_limit=3)
+        response, content = yield self.post_batch([
+            self.mk_message('USER_1'), self.mk_message('USER_2')])
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            json.loads(response.headers.getRawHeaders('X-App-Usage')[0]),
+            {'call_count': 66, 'total_cputime': 66, 'total_time': 66})
+
+        response, content = yield self.post_batch([
+            self.mk_message('USER_1'), self.mk_message('USER_2')])
+        self.assertEqual(response.code, 400)
+        self.assertEqual(content['error']['code'], 4)
+
+    @inlineCallbacks
+    def test_seeded(self):
+        results = []
+        for _ in range(2):
+            yield self.start_service(error_rate=0.5, none_rate=0.2, seed=42)
+            response, content = yield self.post_batch([
+                self.mk_message('USER_%d' % (i,)) for i in range(20)])
+            results.append(content)
+        self.assertEqual(results[0], results[1])
+
+    @inlineCallbacks
+    def test_thread_settings(self):
+        service = yield self.start_service()
+        response = yield treq.post(
+            '%s/v2.6/PAGE_ID/thread_settings?access_token=TOKEN' % (
+                self.url,),
+            json.dumps({
+                'setting_type': 'call_to_actions',
+                'thread_state': 'new_thread',
+                'call_to_actions': [{'payload': 'GET_STARTED'}],
+            }),
+            headers={'Content-Type': ['application/json']},
+            pool=self.pool)
+        self.assertEqual(response.code, 200)
+        self.assertEqual((yield response.json()), {'result': 'success'})
+        self.assertEqual(service.stats['thread_settings'], 1)
+
+    @inlineCallbacks
+    def test_profile(self):
+        yield self.start_service()
+        response = yield treq.get(
+            '%s/v2.6/USER_ID?fields=first_name&access_token=TOKEN' % (
+                self.url,),
+            pool=self.pool)
+        self.assertEqual(response.code, 200)
+        self.assertEqual((yield response.json())['id'], 'USER_ID')
+
+    @inlineCallbacks
+    def test_messages(self):
+        yield self.start_service()
+        response = yield treq.post(
+            '%s/v2.6/me/messages?access_token=TOKEN' % (self.url,),
+            json.dumps({
+                'recipient': {'id': 'USER_ID'},
+                'message': {'text': 'hi'},
+            }),
+            headers={'Content-Type': ['application/json']},
+            pool=self.pool)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            (yield response.json())['recipient_id'], 'USER_ID')
+
+    @inlineCallbacks
+    def test_attachment_upload(self):
+        yield self.start_service()
+        response = yield treq.post(
+            '%s/v2.6/me/message_attachments?access_token=TOKEN' % (
+                self.url,),
+            json.dumps({'message': {'attachment': {
+                'type': 'image',
+                'payload': {'url': 'https://example.com/image.jpg',
+                            'is_reusable': True},
+            }}}),
+            headers={'Content-Type': ['application/json']},
+            pool=self.pool)
+        self.assertEqual(response.code, 200)
+        self.assertTrue((yield response.json())['attachment_id'])
+
+    @inlineCallbacks
+    def test_unsupported(self):
+        yield self.start_service()
+        response = yield treq.get(
+            '%s/v2.6/me/messages' % (self.url,), pool=self.pool)
+        self.assertEqual(response.code, 400)
+        self.assertEqual((yield response.json())['error']['code'], 100)
+
+    def test_latency(self):
+        clock = Clock()
+        service = ApiService(latency='fixed:2', clock=clock)
+        request = DummyRequest([''])
+        d = service.respond(request, 200, {'ok': True})
+        clock.advance(1.9)
+        self.assertNoResult(d)
+        clock.advance(0.1)
+        self.assertEqual(self.successResultOf(d), '{"ok": true}')
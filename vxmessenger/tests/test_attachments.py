@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import serverFromString
+from twisted.internet import reactor
+from twisted.trial.unittest import TestCase
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+
+import treq
+
+from vxmessenger.attachments import AttachmentStore, AttachmentResource
+
+
+class TestAttachmentStore(TestCase):
+
+    def mk_store(self, max_bytes=100, max_file_bytes=50):
+        return AttachmentStore(self.path, max_bytes, max_file_bytes)
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_put_get(self):
+        store = self.mk_store()
+        digest = store.put('key', 'content', 'text/plain')
+        self.assertEqual(digest, hashlib.sha256('content').hexdigest())
+        path, content_type = store.get('key')
+        self.assertEqual(open(path).read(), 'content')
+        self.assertEqual(content_type, 'text/plain')
+        self.assertEqual(store.size, 7)
+
+    def test_get_missing(self):
+        store = self.mk_store()
+        self.assertEqual(store.get('key'), None)
+
+    def test_content_addressed(self):
+        store = self.mk_store()
+        store.put('key1', 'content')
+        store.put('key2', 'content')
+        self.assertEqual(store.get('key1')[0], store.get('key2')[0])
+        self.assertEqual(store.size, 7)
+        self.assertEqual(len(os.listdir(store.blobs_path)), 1)
+
+    def test_too_large(self):
+        store = self.mk_store()
+        self.assertEqual(store.put('key', 'x' * 51), None)
+        self.assertEqual(store.get('key'), None)
+
+    def test_eviction(self):
+        store = self.mk_store()
+        store.put('key1', 'a' * 40)
+        store.put('key2', 'b' * 40)
+        store.get('key1')
+        store.put('key3', 'c' * 40)
+        self.assertEqual(store.get('key2'), None)
+        self.assertNotEqual(store.get('key1'), None)
+        self.assertNotEqual(store.get('key3'), None)
+        self.assertEqual(store.size, 80)
+        self.assertEqual(store.evictions, 1)
+
+    def test_eviction_removes_refs(self):
+        store = self.mk_store()
+        store.put('key1', 'a' * 40)
+        store.put('key2', 'a' * 40)
+        store.put('key3', 'b' * 40)
+        store.put('key4', 'c' * 40)
+        self.assertEqual(
+            sorted(os.listdir(store.refs_path)), ['key3', 'key4'])
+
+    def test_put_replaces_ref(self):
+        store = self.mk_store()
+        store.put('key1', 'a' * 40)
+        store.put('key1', 'b' * 40)
+        store.put('key2', 'c' * 40)
+        self.assertEqual(
+            store.read_ref('key1')['digest'],
+            hashlib.sha256('b' * 40).hexdigest())
+        store.put('key3', 'd' * 40)
+        self.assertEqual(
+            sorted(os.listdir(store.refs_path)), ['key2', 'key3'])
+        self.assertEqual(store.get('key1'), None)
+
+    def test_concurrent_puts(self):
+        store = self.mk_store(max_bytes=200, max_file_bytes=10)
+
+        def put(n):
+            for i in range(50):
+                store.put('key-%s-%s' % (n, i), '%s-%s' % (n, i))
+                store.get('key-%s-%s' % (n, i / 2))
+
+        threads = [threading.Thread(target=put, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sizes = [
+            os.stat(store.blob_path(digest)).st_size
+            for digest in os.listdir(store.blobs_path)]
+        self.assertEqual(store.size, sum(sizes))
+        self.assertTrue(store.size <= 200)
+        self.assertEqual(
+            sorted(store._blobs), sorted(os.listdir(store.blobs_path)))
+        for key in os.listdir(store.refs_path):
+            self.assertNotEqual(store.get(key), None)
+
+    def test_reload_removes_dangling_refs(self):
+        store = self.mk_store()
+        store.put('key', 'content')
+        os.remove(store.get('key')[0])
+        store = self.mk_store()
+        self.assertEqual(os.listdir(store.refs_path), [])
+
+    def test_reload(self):
+        store = self.mk_store()
+        store.put('key', 'content')
+        store = self.mk_store()
+        self.assertEqual(store.size, 7)
+        self.assertNotEqual(store.get('key'), None)
+
+
+class TestAttachmentResource(TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.store = AttachmentStore(self.mktemp(), 100, 50)
+        endpoint = serverFromString(reactor, 'tcp:0')
+        listener = yield endpoint.listen(
+            Site(AttachmentResource(self.store)))
+        self.url = 'http://127.0.0.1:%s' % (listener.getHost().port,)
+        self.addCleanup(listener.loseConnection)
+
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.addCleanup(self.pool.closeCachedConnections)
+
+    @inlineCallbacks
+    def test_get(self):
+        self.store.put('key', 'content', 'image/png')
+        response = yield treq.get('%s/key' % (self.url,), pool=self.pool)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'), ['image/png'])
+        self.assertEqual((yield response.content()), 'content')
+
+    @inlineCallbacks
+    def test_get_missing(self):
+        response = yield treq.get('%s/key' % (self.url,), pool=self.pool)
+        self.assertEqual(response.code, 404)
+        yield response.content()
+
+    @inlineCallbacks
+    def test_get_nested(self):
+        self.store.put('key', 'content', 'image/png')
+        response = yield treq.get('%s/key/foo' % (self.url,), pool=self.pool)
+        self.assertEqual(response.code, 404)
+        yield response.content()
+
+    @inlineCallbacks
+    def test_get_in_thread(self):
+        threads = []
+        get = self.store.get
+
+        def record_thread(key):
+            threads.append(threading.current_thread())
+            return get(key)
+
+        self.patch(self.store, 'get', record_thread)
+        self.store.put('key', 'content', 'image/png')
+        response = yield treq.get('%s/key' % (self.url,), pool=self.pool)
+        self.assertEqual((yield response.content()), 'content')
+        self.assertNotEqual(threads, [threading.current_thread()])
@@ -0,0 +1,170 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.tests.helpers import MessageHelper
+
+from vxmessenger.benchmarks import (
+    bench_codec, bench_transport, load, payloads, replay, simulate)
+from vxmessenger.benchmarks.results import (
+    result, report, regressions, percentiles)
+from vxmessenger.capture import CaptureWriter
+from vxmessenger.transport import Page
+
+
+class TestPayloads(TestCase):
+
+    def test_webhook_corpus(self):
+        corpus = payloads.webhook_corpus(
+            'production', requests=20, events_per_request=5)
+        self.assertEqual(len(corpus), 20)
+        self.assertEqual(
+            corpus, payloads.webhook_corpus(
+                'production', requests=20, events_per_request=5))
+        for body in corpus:
+            pages, errors = Page.from_data(payloads.json.loads(body))
+            self.assertEqual(len(pages), 5)
+            self.assertEqual(errors, [])
+
+
+class TestBenchmarks(TestCase):
+
+    def assert_results(self, results):
+        self.assertTrue(results)
+        for r in results:
+            self.assertEqual(
+                sorted(r), ['iterations', 'name', 'unit', 'value'])
+            self.assertTrue(r['value'] > 0)
+
+    def test_codec(self):
+        self.assert_results(bench_codec.run(scale=0.01))
+
+    @inlineCallbacks
+    def test_transport(self):
+        results = yield bench_transport.run(scale=0.01)
+        self.assert_results(results)
+        self.assertEqual(
+            [r['name'] for r in results if not r['name'].startswith('page')],
+            ['handle_outbound_message.text',
+             'handle_outbound_message.template',
+             'dispatch_requests',
+             'handle_batch_response'])
+
+
+class TestLoad(TestCase):
+
+    @inlineCallbacks
+    def test_run_load(self):
+        result = yield load.run_load(
+            inbound_rate=20, outbound_rate=40, duration=0.5, batch_size=10,
+            batch_wait=0.05, drain=5)
+        counts = result['counts']
+        self.assertTrue(counts['inbound'] > 0)
+        self.assertTrue(counts['outbound'] > 0)
+        self.assertEqual(counts['ack'], counts['outbound'])
+        self.assertEqual(counts['unfinished'], 0)
+        self.assertEqual(counts['inbound_failed'], 0)
+        self.assertEqual(
+            result['graph_api']['batch_requests'], counts['outbound'])
+        self.assertTrue(0 < result['ack_latency']['p50'])
+        self.assertEqual(result['request_batch_size'], 10)
+        self.assertTrue(result['cpu_ms_per_message'] > 0)
+
+
+class TestReplay(TestCase):
+
+    @inlineCallbacks
+    def test_run_replay(self):
+        clock = Clock()
+        path = self.mktemp()
+        writer = CaptureWriter(path, clock)
+        msg_helper = MessageHelper()
+        for i, body in enumerate(payloads.webhook_corpus('text', 5)):
+            writer.inbound(body)
+            writer.outbound(msg_helper.make_outbound(
+                'Message %d' % (i,), to_addr='USER_%d' % (i,)))
+            clock.advance(0.1)
+        writer.close()
+
+        result = yield replay.run_replay(
+            path, speed=2, batch_size=10, batch_wait=0.05, drain=5)
+        counts = result['counts']
+        self.assertEqual(counts['inbound'], 5)
+        self.assertEqual(counts['inbound_failed'], 0)
+        self.assertEqual(counts['outbound'], 5)
+        self.assertEqual(counts['ack'], 5)
+        self.assertEqual(result['speed'], 2)
+        self.assertTrue(0.2 < result['duration'])
+
+
+class TestSimulate(TestCase):
+
+    def test_parse_recipients(self):
+        import random
+        rng = random.Random(0)
+        uniform = simulate.parse_recipients('uniform', 10)
+        self.assertEqual(
+            set(uniform(rng) for _ in range(1000)),
+            set('USER_%d' % (i,) for i in range(10)))
+        zipf = simulate.parse_recipients('zipf:2', 10)
+        picks = [zipf(rng) for _ in range(1000)]
+        self.assertTrue(picks.count('USER_0') > picks.count('USER_9') * 10)
+        self.assertRaises(
+            ValueError, simulate.parse_recipients, 'zipf:x', 10)
+        self.assertRaises(
+            ValueError, simulate.parse_recipients, 'pareto', 10)
+
+    @inlineCallbacks
+    def test_run_simulation(self):
+        result = yield simulate.run_simulation(
+            rate=20, duration=30, batch_size=10, batch_wait=0.1,
+            latency='fixed:0.1', drain=10)
+        counts = result['counts']
+        self.assertTrue(counts['outbound'] > 0)
+        self.assertEqual(counts['ack'], counts['outbound'])
+        self.assertEqual(counts['unfinished'], 0)
+        self.assertTrue(30 <= result['virtual_seconds'] < 31)
+        self.assertTrue(0.1 <= result['ack_latency']['p50'] < 1)
+        self.assertTrue(result['queue_depth']['max'] < 20)
+        self.assertEqual(len(result['busiest_recipients']), 5)
+
+        again = yield simulate.run_simulation(
+            rate=20, duration=30, batch_size=10, batch_wait=0.1,
+            latency='fixed:0.1', drain=10)
+        self.assertEqual(again['ack_latency'], result['ack_latency'])
+
+    @inlineCallbacks
+    def test_run_simulation_overloaded(self):
+        result = yield simulate.run_simulation(
+            rate=100, duration=30, batch_size=10, batch_wait=0.1,
+            workers=2, latency='fixed:0.1', drain=0)
+        self.assertTrue(result['counts']['unfinished'] > 0)
+        self.assertTrue(result['queue_depth']['growth_per_s'] > 0)
+        self.assertEqual(result['workers'], 2)
+
+
+class TestResults(TestCase):
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles(range(1, 101)), {
+            'p50': 50, 'p90': 90, 'p99': 99, 'max': 100})
+        self.assertEqual(percentiles([3]), {
+            'p50': 3, 'p90': 3, 'p99': 3, 'max': 3})
+        self.assertEqual(percentiles([]), {
+            'p50': 0, 'p90': 0, 'p99': 0, 'max': 0})
+
+    def test_regressions(self):
+        baseline = report([
+            result('rate', 100, 'events/s', 1),
+            result('time', 100, 'us/op', 1),
+            result('ok', 100, 'us/op', 1),
+        ])
+        worse = regressions(baseline, [
+            result('rate', 70, 'events/s', 1),
+            result('time', 130, 'us/op', 1),
+            result('ok', 110, 'us/op', 1),
+            result('new', 100, 'us/op', 1),
+        ], 0.2)
+        self.assertEqual(
+            [(r['name'], round(change, 2)) for r, b, change in worse],
+            [('rate', 0.3), ('time', 0.3)])
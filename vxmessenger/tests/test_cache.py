@@ -0,0 +1,75 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxmessenger.cache import LRUCache, BloomFilter
+
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_get_miss(self):
+        cache = LRUCache(2, self.clock)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.misses, 1)
+
+    def test_get_hit(self):
+        cache = LRUCache(2, self.clock)
+        cache.set('foo', 'bar', 10)
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertEqual(cache.hits, 1)
+
+    def test_expiry(self):
+        cache = LRUCache(2, self.clock)
+        cache.set('foo', 'bar', 10)
+        self.clock.advance(10)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        cache = LRUCache(2, self.clock)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 10)
+        cache.get('a')
+        cache.set('c', 3, 10)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_zero_size(self):
+        cache = LRUCache(0, self.clock)
+        cache.set('a', 1, 10)
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestBloomFilter(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_add(self):
+        bloom = BloomFilter(100, 10, self.clock)
+        self.assertFalse('foo' in bloom)
+        bloom.add('foo')
+        self.assertTrue('foo' in bloom)
+        self.assertFalse('bar' in bloom)
+
+    def test_unicode(self):
+        bloom = BloomFilter(100, 10, self.clock)
+        bloom.add(u'f\xf6\xf6')
+        self.assertTrue(u'f\xf6\xf6' in bloom)
+
+    def test_expiry(self):
+        bloom = BloomFilter(100, 10, self.clock)
+        bloom.add('foo')
+        self.clock.advance(10)
+        self.assertTrue('foo' in bloom)
+        self.clock.advance(10)
+        self.assertFalse('foo' in bloom)
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000, 10, self.clock, error_rate=0.01)
+        self.assertEqual(bloom.num_bits, 9586)
+        self.assertEqual(bloom.num_hashes, 7)
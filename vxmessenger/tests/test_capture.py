@@ -0,0 +1,63 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import MessageHelper
+
+from vxmessenger.capture import CaptureWriter, read_capture
+
+
+class TestCapture(TestCase):
+
+    def test_round_trip(self):
+        clock = Clock()
+        path = self.mktemp()
+        msg = MessageHelper().make_outbound(u'hello \u2603')
+
+        writer = CaptureWriter(path, clock)
+        writer.inbound('{"object":"page"}')
+        clock.advance(1.5)
+        writer.outbound(msg)
+        writer.close()
+
+        [inbound, outbound] = list(read_capture(path))
+        self.assertEqual(inbound, {
+            'type': 'inbound',
+            'body': '{"object":"page"}',
+            'timestamp': 0,
+        })
+        self.assertEqual(outbound['type'], 'outbound')
+        self.assertEqual(outbound['timestamp'], 1.5)
+        self.assertEqual(
+            TransportUserMessage.from_json(outbound['message']), msg)
+
+    def test_append(self):
+        clock = Clock()
+        path = self.mktemp()
+        for body in ['a', 'b']:
+            writer = CaptureWriter(path, clock)
+            writer.inbound(body)
+            writer.close()
+        self.assertEqual(
+            [r['body'] for r in read_capture(path)], ['a', 'b'])
+
+    def test_flush(self):
+        clock = Clock()
+        path = self.mktemp()
+        writer = CaptureWriter(path, clock, flush_every=2)
+        writer.inbound('a')
+        self.assertEqual(writer.unflushed, 1)
+        writer.inbound('b')
+        self.assertEqual(writer.unflushed, 0)
+        writer.close()
+
+    def test_read_unclosed(self):
+        clock = Clock()
+        path = self.mktemp()
+        writer = CaptureWriter(path, clock)
+        self.addCleanup(writer.close)
+        for body in ['a', 'b', 'c']:
+            writer.inbound(body)
+        writer.flush()
+        self.assertEqual(
+            [r['body'] for r in read_capture(path)], ['a', 'b', 'c'])
@@ -0,0 +1,49 @@
+from twisted.trial.unittest import TestCase
+
+from vxmessenger import codec
+
+
+class CodecTestMixin(object):
+
+    def test_dumps_compact(self):
+        self.assertEqual(
+            self.impl.dumps({'b': 'https://example.com/'}),
+            '{"b":"https://example.com/"}')
+        self.assertEqual(self.impl.dumps([1, {}]), '[1,{}]')
+
+    def test_round_trip(self):
+        obj = {u'text': u'Hello \u2603', u'n': 1457764197627, u'f': 0.5,
+               u'l': [None, True, False], u'd': {}}
+        self.assertEqual(self.impl.loads(self.impl.dumps(obj)), obj)
+
+    def test_loads_utf8(self):
+        self.assertEqual(
+            self.impl.loads('{"text":"\xe2\x98\x83"}'), {'text': u'\u2603'})
+
+    def test_loads_invalid(self):
+        self.assertRaises(ValueError, self.impl.loads, '{"text":')
+
+
+class TestJSONCodec(CodecTestMixin, TestCase):
+    impl = codec.JSONCodec()
+
+
+class TestUJSONCodec(CodecTestMixin, TestCase):
+    if codec.ujson is None:
+        skip = 'ujson is not installed'
+    else:
+        impl = codec.UJSONCodec()
+
+
+class TestUse(TestCase):
+
+    def setUp(self):
+        self.addCleanup(codec.use, codec.name())
+
+    def test_use(self):
+        codec.use('json')
+        self.assertEqual(codec.name(), 'json')
+        self.assertEqual(codec.dumps({'a': 1}), '{"a":1}')
+
+    def test_use_unavailable(self):
+        self.assertRaises(ValueError, codec.use, 'nope')
@@ -0,0 +1,85 @@
+from twisted.internet.defer import succeed
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from vxmessenger.metrics import MetricsRegistry, MetricsResource
+
+
+class TestMetricsRegistry(TestCase):
+
+    def test_counter(self):
+        registry = MetricsRegistry('test_', {'transport': 'tx'})
+        counter = registry.counter('requests_total', 'Requests', ['code'])
+        counter.inc(code=200)
+        counter.inc(code=200)
+        counter.inc(3, code=400)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP test_requests_total Requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{code="200",transport="tx"} 2',
+            'test_requests_total{code="400",transport="tx"} 3',
+        ]) + '\n')
+
+    def test_gauge_func(self):
+        registry = MetricsRegistry()
+        registry.gauge('size', 'Size', func=lambda: 4)
+        registry.gauge(
+            'items', 'Items', ['kind'], func=lambda: {('a',): 1, ('b',): 2})
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP size Size',
+            '# TYPE size gauge',
+            'size 4',
+            '# HELP items Items',
+            '# TYPE items gauge',
+            'items{kind="a"} 1',
+            'items{kind="b"} 2',
+        ]) + '\n')
+
+    def test_label_escaping(self):
+        registry = MetricsRegistry()
+        registry.counter('c', 'C', ['l']).inc(l='a"b\\c\n')
+        self.assertIn(r'c{l="a\"b\\c\n"} 1', registry.render())
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('rtt', 'RTT', [0.1, 1])
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP rtt RTT',
+            '# TYPE rtt histogram',
+            'rtt_bucket{le="0.1"} 2',
+            'rtt_bucket{le="1"} 3',
+            'rtt_bucket{le="+Inf"} 4',
+            'rtt_sum 2.65',
+            'rtt_count 4',
+        ]) + '\n')
+
+    def test_collect(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge('depth', 'Depth')
+        registry.add_collector(lambda: succeed(gauge.set(7)))
+        self.successResultOf(registry.collect())
+        self.assertIn('depth 7', registry.render())
+
+
+class TestMetricsResource(TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.counter('c', 'C').inc()
+        request = DummyRequest([''])
+        MetricsResource(registry).render_GET(request)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('Content-Type'),
+            ['text/plain; version=0.0.4'])
+        self.assertIn('c 1', ''.join(request.written))
+
+    def test_render_collector_failure(self):
+        registry = MetricsRegistry()
+        registry.add_collector(lambda: 1 / 0)
+        request = DummyRequest([''])
+        MetricsResource(registry).render_GET(request)
+        self.assertEqual(request.responseCode, 500)
+        self.assertEqual(request.finished, 1)
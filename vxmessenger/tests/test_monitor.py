@@ -0,0 +1,129 @@
+import os
+import pstats
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from vxmessenger import codec
+from vxmessenger.monitor import (
+    Profiler, ProfilerBusy, ProfileResource, ReactorLagMonitor)
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestReactorLagMonitor(TestCase):
+
+    def mk_monitor(self, interval=1, stall_threshold=0):
+        self.clock = Clock()
+        self.time = FakeTime()
+        self.lags = []
+        self.stalls = []
+        monitor = ReactorLagMonitor(
+            interval, stall_threshold, self.lags.append,
+            lambda lag, stack: self.stalls.append((lag, stack)),
+            clock=self.clock, time=self.time)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        return monitor
+
+    def test_lag(self):
+        self.mk_monitor()
+        self.time.now = 1
+        self.clock.advance(1)
+        self.time.now = 2.5
+        self.clock.advance(1)
+        self.assertEqual(self.lags, [0, 0.5])
+        self.assertEqual(self.stalls, [])
+
+    def test_stall(self):
+        monitor = self.mk_monitor(stall_threshold=2)
+        self.time.now = 2.5
+        monitor.check()
+        self.assertEqual(monitor.stall_stack, None)
+
+        self.time.now = 3
+        monitor.check()
+        self.assertIn('test_stall', monitor.stall_stack)
+
+        self.time.now = 4
+        self.clock.advance(1)
+        [(lag, stack)] = self.stalls
+        self.assertEqual(lag, 3)
+        self.assertIn('test_stall', stack)
+        self.assertEqual(monitor.stall_stack, None)
+
+    def test_stop(self):
+        monitor = self.mk_monitor(stall_threshold=2)
+        self.assertTrue(monitor._watchdog.is_alive())
+        monitor.stop()
+        self.assertEqual(monitor._watchdog, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestProfiler(TestCase):
+
+    def test_profile(self):
+        clock = Clock()
+        profiler = Profiler(self.mktemp(), name='test', clock=clock)
+        os.makedirs(profiler.path)
+
+        d = profiler.profile(5)
+        self.assertTrue(profiler.running)
+        self.assertRaises(ProfilerBusy, profiler.profile, 5)
+        clock.advance(5)
+
+        path = self.successResultOf(d)
+        self.assertFalse(profiler.running)
+        self.assertTrue(os.path.basename(path).startswith('test-'))
+        pstats.Stats(path)
+
+    def test_profile_write_failure(self):
+        clock = Clock()
+        profiler = Profiler(self.mktemp(), clock=clock)
+        d = profiler.profile(1)
+        clock.advance(1)
+        self.failureResultOf(d, IOError)
+        self.assertFalse(profiler.running)
+
+
+class TestProfileResource(TestCase):
+
+    def mk_request(self, **args):
+        request = DummyRequest([''])
+        request.method = 'POST'
+        request.args = dict((k, [v]) for k, v in args.items())
+        return request
+
+    def test_profile(self):
+        clock = Clock()
+        profiler = Profiler(self.mktemp(), clock=clock)
+        os.makedirs(profiler.path)
+        resource = ProfileResource(profiler)
+
+        request = self.mk_request(seconds='2')
+        resource.render(request)
+        self.assertEqual(request.finished, 0)
+
+        busy = self.mk_request(seconds='2')
+        self.assertIn('already running', resource.render(busy))
+        self.assertEqual(busy.responseCode, 409)
+
+        clock.advance(2)
+        self.assertEqual(request.finished, 1)
+        body = codec.loads(''.join(request.written))
+        self.assertTrue(os.path.exists(body['path']))
+
+    def test_invalid_seconds(self):
+        resource = ProfileResource(Profiler(self.mktemp(), clock=Clock()))
+        for seconds in ['0', 'foo', '601']:
+            request = self.mk_request(seconds=seconds)
+            resource.render(request)
+            self.assertEqual(request.responseCode, 400)
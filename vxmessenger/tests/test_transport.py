@@ -1,30 +1,70 @@
+import hashlib
 import json
+import logging
+import os
+from StringIO import StringIO
 from urlparse import parse_qs
 
 import treq
 from twisted.internet import reactor
 from twisted.internet.defer import (inlineCallbacks, returnValue,
                                     DeferredQueue, Deferred)
-from twisted.internet.task import Clock
+from twisted.internet.task import Clock, deferLater
+from twisted.python.failure import Failure
 from twisted.web import http
-from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import HTTPConnectionPool, ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.web.test.requesthelper import DummyRequest
 
+from vumi.config import ConfigError
 from vumi.tests.helpers import VumiTestCase, MessageHelper
-from vumi.tests.utils import MockHttpServer
+from vumi.tests.utils import MockHttpServer, LogCatcher
 from vumi.transports.httprpc.tests.helpers import HttpRpcTransportHelper
 
-from vxmessenger.transport import MessengerTransport
+from vxmessenger.capture import read_capture
+from vxmessenger.transport import MessengerTransport, Page
+from vxmessenger.webhook import WebhookService
+
+
+class DummyBodyTransport(object):
+
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
 
 
 class DummyResponse(object):
 
-    def __init__(self, code, content):
+    def __init__(self, code, content, headers=None, length=None,
+                 chunk_size=None):
         self.code = code
-        self.content = content
+        self.body = content
+        self.headers = Headers(headers)
+        self.length = len(content) if length is None else length
+        self.chunk_size = chunk_size or max(len(content), 1)
+        self.transport = DummyBodyTransport()
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(self.transport)
+
+        def deliver():
+            for i in range(0, len(self.body), self.chunk_size):
+                if self.transport.stopped:
+                    return
+                protocol.dataReceived(self.body[i:i + self.chunk_size])
+            protocol.connectionLost(Failure(ResponseDone()))
+
+        reactor.callLater(0, deliver)
+
+    def content(self):
+        d = Deferred()
+        reactor.callLater(0, d.callback, self.body)
+        return d
 
     def json(self):
         d = Deferred()
-        reactor.callLater(0, d.callback, json.loads(self.content))
+        reactor.callLater(0, d.callback, json.loads(self.body))
         return d
 
 
@@ -143,6 +183,15 @@ class TestMessengerTransport(VumiTestCase):
 
         yield d
 
+    @inlineCallbacks
+    def test_dispatch_requests_taken_by_other_worker(self):
+        transport = yield self.mk_transport(access_token='access-token')
+        transport.queue_len = 2
+
+        yield transport.dispatch_requests()
+        self.assertEqual(transport.queue_len, 0)
+        self.assertEqual(transport.request_queue.pending, [])
+
     @inlineCallbacks
     def test_handle_batch_response_all_types(self):
         transport = yield self.mk_transport()
@@ -172,6 +221,296 @@ class TestMessengerTransport(VumiTestCase):
         request = yield transport.redis.lpop(transport.REQ_QUEUE_KEY)
         self.assertEqual(request, '{"message_id":"3"}')
 
+    @inlineCallbacks
+    def test_batch_metrics(self):
+        transport = yield self.mk_transport()
+        transport.pending_requests = [
+            {'message_id': '1'}, {'message_id': '2'}, {'message_id': '3'},
+        ]
+        response = DummyResponse(200, json.dumps([
+            {'code': 200, 'body': json.dumps({'message_id': '123'})},
+            {'code': 400, 'body': json.dumps({'error': {
+                'code': 100,
+                'error_subcode': 2018001,
+                'message': 'No matching user found',
+            }})},
+            None,
+        ]))
+        yield transport.handle_batch_response(response)
+
+        metrics = transport.metrics.render()
+        labels = 'transport="%s"' % (transport.transport_name,)
+        self.assertIn(
+            'vxmessenger_batch_results_total{code="200",%s} 1' % (labels,),
+            metrics)
+        self.assertIn(
+            'vxmessenger_batch_results_total{code="none",%s} 1' % (labels,),
+            metrics)
+        self.assertIn(
+            'vxmessenger_graph_errors_total{code="100",subcode="2018001",'
+            '%s} 1' % (labels,), metrics)
+        self.assertIn('vxmessenger_acks_total{%s} 1' % (labels,), metrics)
+        self.assertIn(
+            'vxmessenger_nacks_total{%s,type="no_matching_user_found"} 1' % (
+                labels,), metrics)
+
+    @inlineCallbacks
+    def test_request_queue_metrics(self):
+        transport = yield self.mk_transport(access_token='TOKEN')
+        stats = yield transport.get_request_queue_stats()
+        self.assertEqual(stats, {'depth': 0, 'age': 0})
+
+        yield self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_1', content='Hello')
+        self.clock.advance(0.5)
+        yield self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_2', content='Hello')
+
+        yield transport.metrics.collect()
+        metrics = transport.metrics.render()
+        labels = 'transport="%s"' % (transport.transport_name,)
+        self.assertIn(
+            'vxmessenger_outbound_queue_depth{%s} 2' % (labels,), metrics)
+        self.assertIn(
+            'vxmessenger_outbound_queue_oldest_age_seconds{%s} 0.5' % (
+                labels,), metrics)
+
+    @inlineCallbacks
+    def test_metrics_web_path(self):
+        transport = yield self.mk_transport(metrics_web_path='/metrics')
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'hi'))
+
+        response = yield treq.get(transport.get_transport_url('/metrics'))
+        self.assertEqual(response.code, http.OK)
+        content = yield response.content()
+        self.assertIn(
+            'vxmessenger_inbound_events_total{transport="%s",'
+            'type="message"} 1' % (transport.transport_name,), content)
+        self.assertIn('vxmessenger_webhook_latency_seconds_count', content)
+
+    @inlineCallbacks
+    def test_metrics_web_path_auth(self):
+        transport = yield self.mk_transport(
+            metrics_web_path='/metrics',
+            web_username='admin', web_password='secret')
+        url = transport.get_transport_url('/metrics')
+        response = yield treq.get(url)
+        self.assertEqual(response.code, http.UNAUTHORIZED)
+        yield response.content()
+
+        response = yield treq.get(url, auth=('admin', 'secret'))
+        self.assertEqual(response.code, http.OK)
+        self.assertIn('vxmessenger_', (yield response.content()))
+
+    @inlineCallbacks
+    def test_profile_web_path(self):
+        profile_dir = self.mktemp()
+        os.makedirs(profile_dir)
+        transport = yield self.mk_transport(
+            profile_web_path='/profile', profile_dir=profile_dir,
+            web_username='admin', web_password='secret')
+
+        url = transport.get_transport_url('/profile?seconds=1')
+        response = yield treq.post(url, '')
+        self.assertEqual(response.code, http.UNAUTHORIZED)
+        yield response.content()
+
+        d = treq.post(url, '', auth=('admin', 'secret'))
+        while not transport.profiler.running:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.clock.advance(1)
+        response = yield d
+        self.assertEqual(response.code, http.OK)
+        path = (yield response.json())['path']
+        self.assertEqual(os.path.dirname(path), profile_dir)
+        self.assertTrue(os.path.exists(path))
+
+    def test_profile_web_path_requires_auth(self):
+        err = self.assertRaises(
+            ConfigError, MessengerTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'web_path': '/api',
+                'web_port': 0,
+                'access_token': 'access-token',
+                'profile_web_path': '/profile',
+            })
+        self.assertIn('web_username', str(err))
+
+    @inlineCallbacks
+    def test_reactor_lag_monitor(self):
+        transport = yield self.mk_transport(reactor_lag_interval=0.01)
+        self.assertTrue(transport.lag_monitor._watchdog.is_alive())
+        yield deferLater(reactor, 0.05, lambda: None)
+        self.assertIn(
+            'vxmessenger_reactor_lag_seconds_count',
+            transport.metrics.render())
+
+        with LogCatcher(message='Reactor stalled') as lc:
+            transport.reactor_stalled(2, 'stack')
+        self.assertEqual(
+            lc.messages(), ['Reactor stalled for 2.000 seconds in:\nstack'])
+
+    @inlineCallbacks
+    def test_capture(self):
+        path = self.mktemp()
+        transport = yield self.mk_transport(
+            access_token='TOKEN', capture_path=path)
+        body = self.mk_text_event('mid.1', 'hi')
+        res = yield self.tx_helper.mk_request_raw(method='POST', data=body)
+        self.assertEqual(res.code, http.OK)
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        self.clock.advance(2)
+        yield transport.handle_outbound_message(
+            self.tx_helper.make_outbound('hello', to_addr='USER_ID'))
+        transport.capture.flush()
+
+        [inbound, outbound] = list(read_capture(path))
+        self.assertEqual(inbound['type'], 'inbound')
+        self.assertEqual(json.loads(inbound['body']), json.loads(body))
+        self.assertEqual(inbound['timestamp'], 0)
+        self.assertEqual(outbound['type'], 'outbound')
+        self.assertEqual(outbound['timestamp'], 2)
+        self.assertEqual(json.loads(outbound['message'])['content'], 'hello')
+
+    @inlineCallbacks
+    def test_outbound_trace(self):
+        transport = yield self.mk_transport(
+            access_token='TOKEN', trace_slow_threshold=2)
+
+        with LogCatcher(message='Slow outbound') as lc:
+            d = self.tx_helper.make_dispatch_outbound(
+                to_addr='USER_ID', content='Hello, world!')
+            request_d, args, kwargs = yield transport.request_queue.get()
+            self.clock.advance(3)
+            request_d.callback(DummyResponse(200, json.dumps([{
+                'code': 200,
+                'body': json.dumps({'message_id': 'MESSAGE_ID'}),
+            }])))
+            msg = yield d
+            yield self.assert_outbound_success(msg['message_id'], 'MESSAGE_ID')
+
+        [log] = lc.messages()
+        self.assertEqual(json.loads(log.split(': ', 1)[1]), {
+            'message_id': msg['message_id'],
+            'total': 3,
+            'stages': {
+                'queued': 0, 'dequeued': 0, 'sent': 0, 'responded': 3,
+                'acked': 0,
+            },
+        })
+
+        metrics = transport.metrics.render()
+        labels = 'direction="outbound",stage="%s",transport="%s"'
+        self.assertIn('vxmessenger_stage_seconds_sum{%s} 3' % (
+            labels % ('responded', transport.transport_name),), metrics)
+        self.assertIn('vxmessenger_stage_seconds_count{%s} 1' % (
+            labels % ('total', transport.transport_name),), metrics)
+
+    @inlineCallbacks
+    def test_outbound_trace_requeued(self):
+        transport = yield self.mk_transport()
+        transport.pending_requests = [{
+            'message_id': '1',
+            'trace': {'received': 0, 'queued': 0, 'dequeued': 1, 'sent': 1},
+        }]
+        self.clock.advance(5)
+        yield transport.handle_batch_response(
+            DummyResponse(200, json.dumps([None])))
+
+        request = yield transport.redis.lpop(transport.REQ_QUEUE_KEY)
+        self.assertEqual(json.loads(request)['trace']['queued'], 5)
+
+    @inlineCallbacks
+    def test_inbound_trace(self):
+        transport = yield self.mk_transport(inbound_buffer=True)
+        yield transport.buffer_inbound('1', self.mk_text_event('mid.1', 'a'))
+        self.clock.advance(2)
+
+        with LogCatcher(message='Slow inbound') as lc:
+            yield transport.drain_inbound_buffer()
+        self.assertEqual(lc.messages(), [])
+
+        metrics = transport.metrics.render()
+        labels = 'direction="inbound",stage="%s",transport="%s"'
+        self.assertIn('vxmessenger_stage_seconds_sum{%s} 2' % (
+            labels % ('dequeued', transport.transport_name),), metrics)
+        self.assertIn('vxmessenger_stage_seconds_sum{%s} 2' % (
+            labels % ('total', transport.transport_name),), metrics)
+
+    @inlineCallbacks
+    def test_unreachable_recipient_cached(self):
+        transport = yield self.mk_transport(unreachable_recipient_ttl=600)
+        transport.pending_requests = [
+            {'message_id': '1', 'recipient': 'USER_1'},
+            {'message_id': '2', 'recipient': 'USER_2'},
+            {'message_id': '3', 'recipient': 'USER_3'},
+            {'message_id': '4', 'recipient': 'USER_4'},
+        ]
+        response = DummyResponse(200, json.dumps([
+            {
+                'code': 400,
+                'body': json.dumps({'error': {
+                    'code': 100,
+                    'error_subcode': 2018001,
+                    'message': 'No matching user found',
+                }}),
+            },
+            {
+                'code': 400,
+                'body': json.dumps({'error': {
+                    'code': 551,
+                    'message': 'This person isn\'t available right now.',
+                }}),
+            },
+            {
+                'code': 400,
+                'body': json.dumps({'error': {
+                    'code': 100,
+                    'error_subcode': 2018109,
+                    'message': 'Attachment size exceeds allowable limit',
+                }}),
+            },
+            {
+                'code': 400,
+                'body': json.dumps({'error': {
+                    'code': 100,
+                    'message': '(#100) Invalid parameter',
+                }}),
+            },
+        ]))
+        yield transport.handle_batch_response(response)
+
+        unreachable = yield transport.get_unreachable_recipient('USER_1')
+        self.assertEqual(unreachable, {
+            'reason': 'No matching user found',
+            'fail_type': 'no_matching_user_found',
+        })
+        ttl = yield transport.redis.ttl(
+            transport.unreachable_recipient_key('USER_1'))
+        self.assertEqual(ttl, 600)
+        unreachable = yield transport.get_unreachable_recipient('USER_2')
+        self.assertEqual(unreachable['fail_type'], 'user_unavailable')
+        unreachable = yield transport.get_unreachable_recipient('USER_3')
+        self.assertEqual(unreachable, None)
+        unreachable = yield transport.get_unreachable_recipient('USER_4')
+        self.assertEqual(unreachable, None)
+
+    @inlineCallbacks
+    def test_outbound_unreachable_recipient(self):
+        transport = yield self.mk_transport(unreachable_recipient_ttl=600)
+        yield transport.add_unreachable_recipient(
+            'USER_ID', 'No matching user found', 'no_matching_user_found')
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID', content='Hello, world!')
+        yield self.assert_outbound_failure(
+            msg['message_id'], 'No matching user found',
+            'no_matching_user_found')
+        self.assertEqual(transport.queue_len, 0)
+        self.assertEqual(transport.unreachable_recipient_hits, 1)
+
     @inlineCallbacks
     def test_hub_challenge(self):
         yield self.mk_transport()
@@ -767,6 +1106,1366 @@ class TestMessengerTransport(VumiTestCase):
             }
         })
 
+    def mk_text_event(self, mid, text, sender='USER_ID', timestamp=None):
+        return json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': [{
+                    'sender': {'id': sender},
+                    'recipient': {'id': 'PAGE_ID'},
+                    'timestamp': timestamp or 1457764197627,
+                    'message': {
+                        'mid': mid,
+                        'seq': 73,
+                        'text': text,
+                    },
+                }],
+            }],
+        })
+
+    @inlineCallbacks
+    def test_inbound_user_profile_cached(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True)
+
+        d = self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'hi'))
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(200, json.dumps({
+            'first_name': 'first-name',
+        })))
+        yield d
+
+        res = yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.2', 'again'))
+        self.assertEqual(res.code, http.OK)
+        self.assertEqual(transport.request_queue.pending, [])
+
+        [msg1, msg2] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(msg2['helper_metadata'], {
+            'messenger': {
+                'mid': 'mid.2',
+                'first_name': 'first-name',
+            }
+        })
+        self.assertEqual(transport.profile_cache_stats(), {
+            'size': 1,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+            'redis_hits': 0,
+            'redis_misses': 1,
+        })
+
+    @inlineCallbacks
+    def test_user_profile_redis_cache(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True)
+        key = transport.profile_cache_key('USER_ID', 'PAGE_ID')
+        yield transport.redis.set(key, json.dumps({'first_name': 'cached'}))
+
+        profile = yield transport.get_user_profile('USER_ID', 'PAGE_ID')
+        self.assertEqual(profile, {'first_name': 'cached'})
+        self.assertEqual(transport.request_queue.pending, [])
+        self.assertEqual(transport.profile_redis_hits, 1)
+
+    @inlineCallbacks
+    def test_user_profile_redis_cache_remaining_ttl(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_cache_ttl=3600)
+        transport.profile_cache.clock = self.clock
+        key = transport.profile_cache_key('USER_ID', 'PAGE_ID')
+        yield transport.redis.setex(
+            key, 10, json.dumps({'first_name': 'cached'}))
+
+        profile = yield transport.get_user_profile('USER_ID', 'PAGE_ID')
+        self.assertEqual(profile, {'first_name': 'cached'})
+        self.assertEqual(transport.profile_cache.get(key), profile)
+        self.clock.advance(10)
+        self.assertEqual(transport.profile_cache.get(key), None)
+
+    @inlineCallbacks
+    def test_user_profile_error_cached(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True)
+
+        d = transport.get_user_profile('USER_ID', 'PAGE_ID')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(400, json.dumps({
+            'error': {'message': 'nope'},
+        })))
+        profile = yield d
+        self.assertEqual(profile, {})
+
+        key = transport.profile_cache_key('USER_ID', 'PAGE_ID')
+        ttl = yield transport.redis.ttl(key)
+        self.assertTrue(0 < ttl <= transport.profile_cache_error_ttl)
+
+        profile = yield transport.get_user_profile('USER_ID', 'PAGE_ID')
+        self.assertEqual(profile, {})
+        self.assertEqual(transport.request_queue.pending, [])
+
+    @inlineCallbacks
+    def test_user_profile_cache_disabled(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_cache_ttl=0)
+
+        for i in range(2):
+            d = transport.get_user_profile('USER_ID', 'PAGE_ID')
+            (request_d, args, kwargs) = yield transport.request_queue.get()
+            request_d.callback(DummyResponse(200, json.dumps({})))
+            yield d
+
+    @inlineCallbacks
+    def test_user_profile_graph_api_host(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            outbound_url='http://localhost:8051/v2.6/me/messages')
+
+        d = transport.get_user_profile('USER_ID', 'PAGE_ID')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        method, url, data = args
+        self.assertEqual(method, 'GET')
+        self.assertTrue(url.startswith('http://localhost:8051/v2.6/USER_ID?'))
+        request_d.callback(DummyResponse(200, json.dumps({})))
+        yield d
+
+    @inlineCallbacks
+    def test_user_profile_lookups_coalesced(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True)
+
+        d1 = transport.get_user_profile('USER_ID', 'PAGE_ID')
+        d2 = transport.get_user_profile('USER_ID', 'PAGE_ID')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        self.assertEqual(transport.request_queue.pending, [])
+        request_d.callback(DummyResponse(200, json.dumps({
+            'first_name': 'first-name',
+        })))
+
+        profile1 = yield d1
+        profile2 = yield d2
+        self.assertEqual(profile1, {'first_name': 'first-name'})
+        self.assertEqual(profile2, {'first_name': 'first-name'})
+        self.assertFalse(profile1 is profile2)
+        self.assertEqual(transport._profile_lookups, {})
+
+    @inlineCallbacks
+    def test_user_profile_lookups_batched(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_cache_ttl=0,
+            profile_batch_wait_time=1)
+
+        d1 = transport.get_user_profile('USER_1', 'PAGE_ID')
+        d2 = transport.get_user_profile('USER_2', 'PAGE_ID')
+        self.clock.advance(1)
+
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        method, url, data = args
+        self.assertEqual(method, 'POST')
+        self.assertEqual(url, 'https://graph.facebook.com')
+        self.assertEqual(data['access_token'], 'the-access-token')
+        self.assertEqual(json.loads(data['batch']), [{
+            'method': 'GET',
+            'relative_url': 'v2.6/USER_1?fields='
+                            'first_name%2Clast_name%2Cprofile_pic',
+        }, {
+            'method': 'GET',
+            'relative_url': 'v2.6/USER_2?fields='
+                            'first_name%2Clast_name%2Cprofile_pic',
+        }])
+
+        request_d.callback(DummyResponse(200, json.dumps([
+            {'code': 200, 'body': json.dumps({'first_name': 'one'})},
+            {'code': 400, 'body': json.dumps({'error': {}})},
+        ])))
+
+        profile1 = yield d1
+        profile2 = yield d2
+        self.assertEqual(profile1, {'first_name': 'one'})
+        self.assertEqual(profile2, {})
+
+    @inlineCallbacks
+    def test_user_profile_batch_only_answers_cached(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_batch_wait_time=1)
+
+        d1 = transport.get_user_profile('USER_1', 'PAGE_ID')
+        d2 = transport.get_user_profile('USER_2', 'PAGE_ID')
+        d3 = transport.get_user_profile('USER_3', 'PAGE_ID')
+        # Wait for the Redis cache misses
+        while len(transport._profile_batch) < 3:
+            yield deferLater(reactor, 0, lambda: None)
+        self.clock.advance(1)
+
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(200, json.dumps([
+            {'code': 200, 'body': json.dumps({'first_name': 'one'})},
+            {'code': 400, 'body': json.dumps({'error': {}})},
+            None,
+        ])))
+        self.assertEqual(
+            [(yield d1), (yield d2), (yield d3)],
+            [{'first_name': 'one'}, {}, {}])
+
+        cached = yield transport.redis.get(
+            transport.profile_cache_key('USER_1', 'PAGE_ID'))
+        self.assertEqual(json.loads(cached), {'first_name': 'one'})
+        cached = yield transport.redis.get(
+            transport.profile_cache_key('USER_2', 'PAGE_ID'))
+        self.assertEqual(json.loads(cached), {})
+        cached = yield transport.redis.get(
+            transport.profile_cache_key('USER_3', 'PAGE_ID'))
+        self.assertEqual(cached, None)
+        self.assertEqual(
+            transport.profile_cache.get(
+                transport.profile_cache_key('USER_3', 'PAGE_ID')),
+            None)
+
+    @inlineCallbacks
+    def test_user_profile_batch_failed(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_cache_ttl=0,
+            profile_batch_wait_time=1)
+
+        d = transport.get_user_profile('USER_1', 'PAGE_ID')
+        self.clock.advance(1)
+
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(500, 'fail'))
+        profile = yield d
+        self.assertEqual(profile, {})
+
+    @inlineCallbacks
+    def test_inbound_user_profile_timeout(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_lookup_timeout=2)
+
+        d = self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'hi'))
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        self.clock.advance(2)
+
+        res = yield d
+        self.assertEqual(res.code, http.OK)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['helper_metadata'], {
+            'messenger': {
+                'mid': 'mid.1',
+                'profile_pending': True,
+            }
+        })
+        self.assertEqual(transport.profile_lookup_timeouts, 1)
+        self.assertIn(
+            'vxmessenger_profile_lookup_timeouts_total{transport="%s"} 1' % (
+                transport.transport_name,),
+            transport.metrics.render())
+
+        # The lookup completes in the background and warms the cache
+        request_d.callback(DummyResponse(200, json.dumps({
+            'first_name': 'first-name',
+        })))
+        profile = yield transport.get_user_profile('USER_ID', 'PAGE_ID')
+        self.assertEqual(profile, {'first_name': 'first-name'})
+        self.assertEqual(transport.request_queue.pending, [])
+
+    @inlineCallbacks
+    def test_user_profile_within_budget(self):
+        transport = yield self.mk_transport(
+            access_token='the-access-token',
+            retrieve_profile=True,
+            profile_lookup_timeout=2)
+
+        d = transport.get_user_profile_within_budget('USER_ID', 'PAGE_ID')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(200, json.dumps({
+            'first_name': 'first-name',
+        })))
+        profile = yield d
+        self.assertEqual(profile, {'first_name': 'first-name'})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_inbound_buffered(self):
+        yield self.mk_transport(inbound_buffer=True)
+
+        res = yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'hi'))
+        self.assertEqual(res.code, http.OK)
+        self.assertEqual(json.loads(res.delivered_body), {})
+
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['from_addr'], 'USER_ID')
+        self.assertEqual(msg['content'], 'hi')
+        self.assertEqual(msg['transport_metadata'], {
+            'messenger': {
+                'mid': 'mid.1',
+            }
+        })
+
+    @inlineCallbacks
+    def test_inbound_from_webhook_ingress(self):
+        transport = yield self.mk_transport(
+            inbound_buffer=True, inbound_buffer_key='ingress:PAGE_ID')
+        ingress = WebhookService(
+            'token', redis=transport.redis, clock=self.clock)
+
+        request = DummyRequest([''])
+        request.method = 'POST'
+        request.content = StringIO(self.mk_text_event('mid.1', 'hi'))
+        yield ingress.receive(request)
+
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['from_addr'], 'USER_ID')
+        self.assertEqual(msg['content'], 'hi')
+
+    @inlineCallbacks
+    def test_inbound_buffer_stats(self):
+        transport = yield self.mk_transport()
+        stats = yield transport.get_inbound_buffer_stats()
+        self.assertEqual(stats, {'depth': 0, 'age': 0})
+
+        yield transport.buffer_inbound('1', self.mk_text_event('mid.1', 'a'))
+        self.clock.advance(5)
+        yield transport.buffer_inbound('2', self.mk_text_event('mid.2', 'b'))
+
+        stats = yield transport.get_inbound_buffer_stats()
+        self.assertEqual(stats, {'depth': 2, 'age': 5})
+
+    @inlineCallbacks
+    def test_drain_inbound_buffer(self):
+        transport = yield self.mk_transport()
+        yield transport.buffer_inbound('1', self.mk_text_event('mid.1', 'a'))
+        yield transport.buffer_inbound('2', self.mk_text_event('mid.2', 'b'))
+
+        yield transport.drain_inbound_buffer()
+        [msg1, msg2] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg1['content'], 'a')
+        self.assertEqual(msg2['content'], 'b')
+
+        depth = yield transport.redis.llen(transport.INBOUND_BUFFER_KEY)
+        self.assertEqual(depth, 0)
+        processing = yield transport.redis.llen(
+            transport.INBOUND_PROCESSING_KEY)
+        self.assertEqual(processing, 0)
+
+    @inlineCallbacks
+    def test_drain_inbound_buffer_publish_failed(self):
+        transport = yield self.mk_transport(inbound_buffer_max_attempts=2)
+        yield transport.buffer_inbound('1', self.mk_text_event('mid.1', 'a'))
+        yield transport.buffer_inbound('2', self.mk_text_event('mid.2', 'b'))
+
+        publish_page = transport.publish_page
+
+        def fail(*args, **kw):
+            raise Exception('AMQP is down')
+
+        transport.publish_page = fail
+        yield transport.drain_inbound_buffer()
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+        processing = yield transport.redis.llen(
+            transport.INBOUND_PROCESSING_KEY)
+        self.assertEqual(processing, 0)
+        buffered = yield transport.redis.lrange(
+            transport.INBOUND_BUFFER_KEY, 0, -1)
+        self.assertEqual(
+            [(r['message_id'], r.get('attempts')) for r in map(
+                json.loads, buffered)],
+            [('1', 1), ('2', None)])
+
+        transport.publish_page = publish_page
+        yield transport.drain_inbound_buffer()
+        [msg1, msg2] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg1['content'], 'b')
+        self.assertEqual(msg2['content'], 'a')
+
+    @inlineCallbacks
+    def test_drain_inbound_buffer_gives_up(self):
+        transport = yield self.mk_transport(inbound_buffer_max_attempts=2)
+        yield transport.buffer_inbound('1', self.mk_text_event('mid.1', 'a'))
+
+        def fail(*args, **kw):
+            raise Exception('AMQP is down')
+
+        transport.publish_page = fail
+        yield transport.drain_inbound_buffer()
+        yield transport.drain_inbound_buffer()
+
+        depth = yield transport.redis.llen(transport.INBOUND_BUFFER_KEY)
+        self.assertEqual(depth, 0)
+        [failed] = yield transport.redis.lrange(
+            transport.INBOUND_FAILED_KEY, 0, -1)
+        failed = json.loads(failed)
+        self.assertEqual(failed['message_id'], '1')
+        self.assertEqual(failed['attempts'], 2)
+
+    @inlineCallbacks
+    def test_recover_inbound_buffer(self):
+        transport = yield self.mk_transport()
+        redis = transport.redis
+        yield redis.sadd(transport.INBOUND_WORKERS_KEY, 'dead', 'alive')
+        yield redis.lpush(transport.inbound_processing_key('dead'), 'foo')
+        yield redis.lpush(transport.inbound_processing_key('alive'), 'bar')
+        yield redis.setex(transport.inbound_lease_key('alive'), 30, 0)
+        yield redis.lpush(transport.INBOUND_PROCESSING_KEY, 'baz')
+
+        yield transport.recover_inbound_buffer()
+        buffered = yield redis.lrange(transport.INBOUND_BUFFER_KEY, 0, -1)
+        self.assertEqual(buffered, ['foo'])
+        self.assertEqual(
+            (yield redis.smembers(transport.INBOUND_WORKERS_KEY)),
+            set(['alive']))
+
+    @inlineCallbacks
+    def test_inbound_buffer_lease(self):
+        transport = yield self.mk_transport(
+            inbound_buffer=True, inbound_buffer_lease_ttl=30)
+        redis = transport.redis
+        lease_key = transport.inbound_lease_key(transport.inbound_worker_id)
+        self.assertEqual((yield redis.ttl(lease_key)), 30)
+        self.assertEqual(
+            (yield redis.smembers(transport.INBOUND_WORKERS_KEY)),
+            set([transport.inbound_worker_id]))
+
+        yield transport.stopWorker()
+        self.assertFalse((yield redis.exists(lease_key)))
+
+    @inlineCallbacks
+    def test_inbound_duplicate(self):
+        transport = yield self.mk_transport()
+
+        for i in range(2):
+            res = yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.1', 'hi'))
+            self.assertEqual(res.code, http.OK)
+
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'hi')
+        self.assertEqual(transport.inbound_duplicates, 1)
+
+    @inlineCallbacks
+    def assert_redelivered_after_publish_failure(self, transport):
+        body = self.mk_text_event('mid.1', 'hi')
+        publish_page = transport.publish_page
+
+        def fail(*args, **kw):
+            raise Exception('AMQP is down')
+
+        transport.publish_page = fail
+        pages, errors = yield transport.parse_inbound(StringIO(body))
+        yield self.assertFailure(
+            transport.publish_pages('1', pages, errors), Exception)
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+        transport.publish_page = publish_page
+        res = yield self.tx_helper.mk_request_raw(method='POST', data=body)
+        self.assertEqual(res.code, http.OK)
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'hi')
+        self.assertEqual(transport.inbound_duplicates, 0)
+
+    @inlineCallbacks
+    def test_inbound_duplicate_after_publish_failure(self):
+        transport = yield self.mk_transport()
+        yield self.assert_redelivered_after_publish_failure(transport)
+
+    @inlineCallbacks
+    def test_inbound_duplicate_bloom_filter_after_publish_failure(self):
+        transport = yield self.mk_transport(dedupe_bloom_filter=True)
+        yield self.assert_redelivered_after_publish_failure(transport)
+
+    @inlineCallbacks
+    def test_inbound_duplicate_after_partial_publish_failure(self):
+        transport = yield self.mk_transport()
+        body = json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': [
+                    json.loads(self.mk_text_event(mid, content))[
+                        'entry'][0]['messaging'][0]
+                    for mid, content in [('mid.1', 'one'), ('mid.2', 'two')]
+                ],
+            }],
+        })
+        publish_page = transport.publish_page
+
+        def fail_second(message_id, page, helper_metadata):
+            if page.mid == 'mid.2':
+                raise Exception('AMQP is down')
+            return publish_page(message_id, page, helper_metadata)
+
+        transport.publish_page = fail_second
+        pages, errors = yield transport.parse_inbound(StringIO(body))
+        transport.start_page_traces(pages, {'received': 0})
+        yield self.assertFailure(
+            transport.publish_pages('1', pages, errors), Exception)
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'one')
+        self.tx_helper.clear_dispatched_inbound()
+
+        transport.publish_page = publish_page
+        res = yield self.tx_helper.mk_request_raw(method='POST', data=body)
+        self.assertEqual(res.code, http.OK)
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'two')
+        self.assertEqual(transport.inbound_duplicates, 1)
+
+    @inlineCallbacks
+    def test_mark_seen_restores_lost_expiry(self):
+        transport = yield self.mk_transport(dedupe_ttl=60)
+        yield transport.redis.set('dedupe:key', 1)
+
+        new = yield transport.mark_seen('dedupe:key')
+        self.assertFalse(new)
+        self.assertEqual((yield transport.redis.ttl('dedupe:key')), 60)
+
+    @inlineCallbacks
+    def test_inbound_duplicate_without_mid(self):
+        transport = yield self.mk_transport()
+
+        def mk_postback(timestamp):
+            return json.dumps({
+                'object': 'page',
+                'entry': [{
+                    'id': 'PAGE_ID',
+                    'time': 1457764198246,
+                    'messaging': [{
+                        'sender': {'id': 'USER_ID'},
+                        'recipient': {'id': 'PAGE_ID'},
+                        'timestamp': timestamp,
+                        'postback': {'payload': json.dumps({'content': '1'})},
+                    }],
+                }],
+            })
+
+        for timestamp in [1457764197627, 1457764197627, 1457764197628]:
+            yield self.tx_helper.mk_request_raw(
+                method='POST', data=mk_postback(timestamp))
+
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 2)
+        self.assertEqual(transport.inbound_duplicates, 1)
+
+    @inlineCallbacks
+    def test_inbound_duplicate_bloom_filter(self):
+        transport = yield self.mk_transport(dedupe_bloom_filter=True)
+
+        for i in range(2):
+            yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.1', 'hi'))
+
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+        self.assertEqual(transport.inbound_duplicates, 1)
+
+    @inlineCallbacks
+    def test_inbound_dedupe_disabled(self):
+        yield self.mk_transport(dedupe_ttl=0)
+
+        for i in range(2):
+            yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.1', 'hi'))
+
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 2)
+
+    def mk_receipt_event(self, receipt_type, watermark, mids=None):
+        receipt = {
+            'watermark': watermark,
+            'seq': 37,
+        }
+        if mids is not None:
+            receipt['mids'] = mids
+        return json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': [{
+                    'sender': {'id': 'USER_ID'},
+                    'recipient': {'id': 'PAGE_ID'},
+                    'timestamp': watermark + 10,
+                    receipt_type: receipt,
+                }],
+            }],
+        })
+
+    @inlineCallbacks
+    def test_inbound_delivery_and_read(self):
+        transport = yield self.mk_transport()
+        for i in range(1, 4):
+            self.clock.advance(1)
+            yield transport.handle_outbound_success(
+                'msg-%s' % (i,), 'mid.%s' % (i,), 'USER_ID')
+        self.tx_helper.clear_dispatched_events()
+
+        res = yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_receipt_event('delivery', 2500))
+        self.assertEqual(res.code, http.OK)
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+        [dr1, dr2] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(dr1['event_type'], 'delivery_report')
+        self.assertEqual(dr1['delivery_status'], 'delivered')
+        self.assertEqual(dr1['user_message_id'], 'msg-1')
+        self.assertEqual(dr1['transport_metadata'], {
+            'messenger': {
+                'mid': 'mid.1',
+                'receipt': 'delivery',
+                'watermark': 2500,
+            },
+        })
+        self.assertEqual(dr2['user_message_id'], 'msg-2')
+        self.tx_helper.clear_dispatched_events()
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_receipt_event('read', 5000))
+        [dr3] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(dr3['user_message_id'], 'msg-3')
+        self.assertEqual(dr3['transport_metadata']['messenger']['receipt'],
+                         'read')
+
+        remaining = yield transport.redis.zcard(
+            transport.sent_messages_key('USER_ID'))
+        self.assertEqual(remaining, 0)
+
+    @inlineCallbacks
+    def test_inbound_delivery_watermark_before_response(self):
+        transport = yield self.mk_transport(access_token='access-token')
+        yield transport.add_request({
+            'message_id': 'msg-1',
+            'method': 'POST',
+            'relative_url': 'v2.6/me/messages',
+            'body': 'recipient=%7B%22id%22%3A%22USER_ID%22%7D',
+            'recipient': 'USER_ID',
+        })
+
+        self.clock.advance(99.8)
+        d = transport.dispatch_requests()
+        request_d, args, kwargs = yield transport.request_queue.get()
+        # Facebook accepts the message at 99.9s, and we get its response at
+        # 100s.
+        self.clock.advance(0.2)
+        request_d.callback(DummyResponse(200, json.dumps([{
+            'code': 200,
+            'body': json.dumps({'message_id': 'mid.1'}),
+        }])))
+        yield d
+        self.tx_helper.clear_dispatched_events()
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_receipt_event('delivery', 99900))
+        [dr] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(dr['event_type'], 'delivery_report')
+        self.assertEqual(dr['user_message_id'], 'msg-1')
+
+    @inlineCallbacks
+    def test_inbound_delivery_mids(self):
+        transport = yield self.mk_transport()
+        self.clock.advance(10)
+        yield transport.handle_outbound_success(
+            'msg-1', 'mid.1:abc', 'USER_ID')
+        yield transport.handle_outbound_success(
+            'msg-2', 'mid.2:def', 'USER_ID')
+        self.tx_helper.clear_dispatched_events()
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST',
+            data=self.mk_receipt_event('delivery', 5000, mids=['mid.2:def']))
+        [dr] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(dr['user_message_id'], 'msg-2')
+        self.assertEqual(dr['transport_metadata']['messenger']['mid'],
+                         'mid.2:def')
+
+        remaining = yield transport.redis.zrange(
+            transport.sent_messages_key('USER_ID'), 0, -1)
+        self.assertEqual(remaining, ['msg-1:mid.1:abc'])
+
+    @inlineCallbacks
+    def test_sent_message_retention(self):
+        transport = yield self.mk_transport(sent_message_retention=60)
+        yield transport.handle_outbound_success('msg-1', 'mid.1', 'USER_ID')
+        ttl = yield transport.redis.ttl(transport.sent_messages_key('USER_ID'))
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_sent_message_retention_trims(self):
+        transport = yield self.mk_transport(sent_message_retention=60)
+        key = transport.sent_messages_key('USER_ID')
+        self.clock.advance(1000)
+        yield transport.add_sent_message('USER_ID', 'msg-1', 'mid.1')
+        self.clock.advance(30)
+        yield transport.add_sent_message('USER_ID', 'msg-2', 'mid.2')
+        self.clock.advance(40)
+        yield transport.add_sent_message('USER_ID', 'msg-3', 'mid.3')
+
+        sent = yield transport.redis.zrange(key, 0, -1)
+        self.assertEqual(sent, ['msg-2:mid.2', 'msg-3:mid.3'])
+
+    @inlineCallbacks
+    def test_inbound_delivery_disabled(self):
+        transport = yield self.mk_transport(sent_message_retention=0)
+        yield transport.handle_outbound_success('msg-1', 'mid.1', 'USER_ID')
+        self.tx_helper.clear_dispatched_events()
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_receipt_event('delivery', 2500))
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+    def mk_unsupported_events(self):
+        return json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': [{
+                    'sender': {'id': 'PAGE_ID'},
+                    'recipient': {'id': 'USER_ID'},
+                    'timestamp': 1457764197627,
+                    'message': {
+                        'is_echo': True,
+                        'mid': 'mid.echo',
+                        'text': 'hello, world!',
+                    },
+                }, {
+                    'sender': {'id': 'USER_ID'},
+                    'recipient': {'id': 'PAGE_ID'},
+                    'timestamp': 1457764197628,
+                    'reaction': {
+                        'mid': 'mid.1',
+                        'action': 'react',
+                        'reaction': 'love',
+                    },
+                }],
+            }],
+        })
+
+    def test_page_from_fp_unsupported(self):
+        pages, errors = Page.from_fp(StringIO(self.mk_unsupported_events()))
+        self.assertEqual(pages, [])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith('Not supporting: '))
+
+    @inlineCallbacks
+    def test_inbound_unsupported_counted(self):
+        transport = yield self.mk_transport()
+
+        res = yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_unsupported_events())
+        self.assertEqual(res.code, http.OK)
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+        self.assertEqual(transport.unsupported_event_counts, {
+            'echo': 1,
+            'reaction': 1,
+        })
+
+    @inlineCallbacks
+    def test_inbound_unsupported_policies(self):
+        transport = yield self.mk_transport(unsupported_events={
+            'echo': 'drop',
+            'reaction': 'forward',
+        })
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_unsupported_events())
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['from_addr'], 'USER_ID')
+        self.assertEqual(msg['content'], '')
+        self.assertEqual(msg['transport_metadata'], {
+            'messenger': {
+                'mid': None,
+                'reaction': {
+                    'mid': 'mid.1',
+                    'action': 'react',
+                    'reaction': 'love',
+                },
+            },
+        })
+        self.assertEqual(transport.unsupported_event_counts, {
+            'reaction': 1,
+        })
+
+    @inlineCallbacks
+    def test_log_path(self):
+        transport = yield self.mk_transport()
+        with LogCatcher(message='MessengerTransport') as lc:
+            transport.log_path('outbound', lambda: {'b': 'two', 'a': 1})
+        [log] = lc.logs
+        self.assertEqual(
+            log['message'], ('MessengerTransport outbound a=1 b="two"',))
+        self.assertEqual(log['logLevel'], logging.INFO)
+
+    @inlineCallbacks
+    def test_log_path_level(self):
+        transport = yield self.mk_transport(log_levels={
+            'inbound': 'debug',
+            'outbound': 'off',
+        })
+        calls = []
+
+        def describe():
+            calls.append(1)
+            return {}
+
+        with LogCatcher(message='MessengerTransport') as lc:
+            transport.log_path('inbound', describe)
+            transport.log_path('outbound', describe)
+        [log] = lc.logs
+        self.assertEqual(log['logLevel'], logging.DEBUG)
+        self.assertEqual(len(calls), 1)
+
+    def test_log_levels_invalid(self):
+        err = self.assertRaises(
+            ConfigError, MessengerTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'web_path': '/api',
+                'web_port': 0,
+                'access_token': 'access-token',
+                'log_levels': {'inbound': 'warn '},
+            })
+        self.assertIn("'warn '", str(err))
+
+    def test_unsupported_events_invalid(self):
+        err = self.assertRaises(
+            ConfigError, MessengerTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'web_path': '/api',
+                'web_port': 0,
+                'access_token': 'access-token',
+                'unsupported_events': {'echo': 'drop', 'default': 'ignore'},
+            })
+        self.assertIn("'ignore'", str(err))
+
+    @inlineCallbacks
+    def test_log_path_sampled(self):
+        transport = yield self.mk_transport(log_sample_rate=3)
+        calls = []
+
+        def describe():
+            calls.append(1)
+            return {}
+
+        with LogCatcher(message='MessengerTransport') as lc:
+            for i in range(7):
+                transport.log_path('inbound', describe)
+        self.assertEqual(len(lc.logs), 3)
+        self.assertEqual(len(calls), 3)
+
+    @inlineCallbacks
+    def test_log_redact_content(self):
+        yield self.mk_transport(log_redact_content=True)
+        with LogCatcher(message='MessengerTransport inbound') as lc:
+            yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.1', 'secret'))
+        [log] = lc.messages()
+        self.assertTrue('content="<redacted 6 chars>"' in log)
+        self.assertFalse('secret' in log)
+
+    def test_debounce_with_inbound_buffer(self):
+        err = self.assertRaises(
+            ConfigError, MessengerTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'web_path': '/api',
+                'web_port': 0,
+                'access_token': 'access-token',
+                'inbound_buffer': True,
+                'inbound_debounce_window': 2,
+            })
+        self.assertIn('inbound_buffer', str(err))
+
+    @inlineCallbacks
+    def test_inbound_debounce(self):
+        yield self.mk_transport(inbound_debounce_window=2)
+
+        for i, text in enumerate(['one', 'two', 'three']):
+            res = yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.%s' % i, text))
+            self.assertEqual(res.code, http.OK)
+            self.clock.advance(1)
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+        self.clock.advance(1)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['from_addr'], 'USER_ID')
+        self.assertEqual(msg['content'], 'one\ntwo\nthree')
+        self.assertEqual(msg['transport_metadata'], {
+            'messenger': {
+                'mid': 'mid.0',
+                'mids': ['mid.0', 'mid.1', 'mid.2'],
+            }
+        })
+
+    @inlineCallbacks
+    def test_inbound_debounce_publish_failed(self):
+        transport = yield self.mk_transport(inbound_debounce_window=2)
+        publish_page = transport.publish_page
+
+        def fail(*args, **kw):
+            raise Exception('AMQP is down')
+
+        transport.publish_page = fail
+        for i, text in enumerate(['one', 'two']):
+            yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.%s' % i, text))
+        yield self.assertFailure(
+            transport.flush_debounced(('PAGE_ID', 'USER_ID')), Exception)
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+        transport.publish_page = publish_page
+        for i, text in enumerate(['one', 'two']):
+            yield self.tx_helper.mk_request_raw(
+                method='POST', data=self.mk_text_event('mid.%s' % i, text))
+        self.clock.advance(2)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], 'one\ntwo')
+        self.assertEqual(transport.inbound_duplicates, 0)
+
+    @inlineCallbacks
+    def test_inbound_debounce_single_message(self):
+        yield self.mk_transport(inbound_debounce_window=2)
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'one'))
+        self.clock.advance(2)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], 'one')
+        self.assertEqual(msg['transport_metadata'], {
+            'messenger': {
+                'mid': 'mid.1',
+            }
+        })
+
+    @inlineCallbacks
+    def test_inbound_debounce_flushed_by_other_event(self):
+        yield self.mk_transport(inbound_debounce_window=2)
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'one'))
+        yield self.tx_helper.mk_request_raw(
+            method='POST',
+            data=json.dumps({
+                'object': 'page',
+                'entry': [{
+                    'id': 'PAGE_ID',
+                    'time': 1457764198246,
+                    'messaging': [{
+                        'sender': {'id': 'USER_ID'},
+                        'recipient': {'id': 'PAGE_ID'},
+                        'timestamp': 1457764198246,
+                        'postback': {'payload': json.dumps({'content': '1'})},
+                    }],
+                }],
+            }))
+
+        [msg1, msg2] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg1['content'], 'one')
+        self.assertEqual(msg2['content'], '1')
+
+    @inlineCallbacks
+    def test_inbound_debounce_limits(self):
+        transport = yield self.mk_transport(
+            inbound_debounce_window=2,
+            inbound_debounce_max_messages=2,
+            inbound_debounce_max_senders=1)
+
+        for mid, text, sender in [
+                ('mid.1', 'one', 'USER_1'),
+                ('mid.2', 'two', 'USER_1'),
+                ('mid.3', 'three', 'USER_2'),
+                ('mid.4', 'four', 'USER_3')]:
+            yield self.tx_helper.mk_request_raw(
+                method='POST',
+                data=self.mk_text_event(mid, text, sender=sender))
+
+        [msg1, msg2] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg1['content'], 'one\ntwo')
+        self.assertEqual(msg2['content'], 'three')
+        self.assertEqual(list(transport._debounced), [('PAGE_ID', 'USER_3')])
+
+        yield transport.flush_all_debounced()
+        [_, _, msg3] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg3['content'], 'four')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_outbound_payload_store(self):
+        transport = yield self.mk_transport(
+            access_token='access_token', payload_store_threshold=10)
+        payload = json.dumps({'content': 'yes', 'state': 'x' * 20})
+        quick_replies = [{
+            'content_type': 'text',
+            'title': 'Yes',
+            'payload': payload,
+        }, {
+            'content_type': 'text',
+            'title': 'No',
+            'payload': 'short',
+        }]
+
+        d = self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi',
+            helper_metadata={'messenger': {'quick_replies': quick_replies}})
+
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        method, url, data = args
+        req_body = parse_qs(json.loads(data['batch'])[0]['body'])
+        message = json.loads(req_body['message'][0])
+        [yes, no] = message['quick_replies']
+        self.assertTrue(yes['payload'].startswith('vxpayload:'))
+        self.assertEqual(no['payload'], 'short')
+
+        stored = yield transport.redis.get(
+            transport.payload_key(yes['payload']))
+        self.assertEqual(stored, payload)
+        ttl = yield transport.redis.ttl(transport.payload_key(yes['payload']))
+        self.assertTrue(0 < ttl <= transport.payload_store_ttl)
+
+        request_d.callback(DummyResponse(200, json.dumps([{
+            'code': 200,
+            'body': json.dumps({'message_id': 'MESSAGE_ID'}),
+        }])))
+        msg = yield d
+        self.assertEqual(
+            msg['helper_metadata']['messenger']['quick_replies'],
+            quick_replies)
+        yield self.assert_outbound_success(msg['message_id'], 'MESSAGE_ID')
+
+    @inlineCallbacks
+    def test_payload_store_only_postbacks(self):
+        transport = yield self.mk_transport(payload_store_threshold=10)
+        long_payload = 'x' * 20
+        msg = {
+            'attachment': {
+                'type': 'template',
+                'payload': {
+                    'template_type': 'button',
+                    'text': 'Call us?',
+                    'buttons': [{
+                        'type': 'postback',
+                        'title': 'Later',
+                        'payload': long_payload,
+                    }, {
+                        'type': 'phone_number',
+                        'title': 'Call',
+                        'payload': '+2782' + '1' * 20,
+                    }],
+                },
+            },
+        }
+
+        swapped, stored = transport.store_payloads(msg)
+        [postback, phone_number] = (
+            swapped['attachment']['payload']['buttons'])
+        self.assertTrue(postback['payload'].startswith('vxpayload:'))
+        self.assertEqual(phone_number['payload'], '+2782' + '1' * 20)
+        self.assertEqual(stored, {postback['payload']: long_payload})
+
+    def mk_postback_event(self, payload):
+        return json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': 'PAGE_ID',
+                'time': 1457764198246,
+                'messaging': [{
+                    'sender': {'id': 'USER_ID'},
+                    'recipient': {'id': 'PAGE_ID'},
+                    'timestamp': 1457764198246,
+                    'postback': {'payload': payload},
+                }],
+            }],
+        })
+
+    @inlineCallbacks
+    def test_inbound_payload_restored(self):
+        transport = yield self.mk_transport(payload_store_threshold=10)
+        msg, payloads = transport.store_payloads({
+            'type': 'postback',
+            'payload': json.dumps({'content': 'yes', 'state': 'x' * 20}),
+        })
+        [(token, payload)] = payloads.items()
+        yield transport.redis.set(transport.payload_key(token), payload)
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_postback_event(token))
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'yes')
+        self.assertEqual(msg['transport_metadata'], {
+            'messenger': {
+                'mid': None,
+                'state': 'x' * 20,
+            }
+        })
+
+    @inlineCallbacks
+    def test_inbound_payload_expired(self):
+        yield self.mk_transport()
+
+        with LogCatcher(message='has expired') as lc:
+            yield self.tx_helper.mk_request_raw(
+                method='POST',
+                data=self.mk_postback_event('vxpayload:abc'))
+        self.assertEqual(len(lc.logs), 1)
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        self.assertEqual(msg['content'], '')
+
+    @inlineCallbacks
+    def test_inbound_attachments_cached(self):
+        transport = yield self.mk_transport(
+            attachment_store_path=self.mktemp(),
+            attachment_url='http://localhost/attachments/')
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST',
+            data=json.dumps({
+                'object': 'page',
+                'entry': [{
+                    'id': 'PAGE_ID',
+                    'time': 1457764198246,
+                    'messaging': [{
+                        'sender': {'id': 'USER_ID'},
+                        'recipient': {'id': 'PAGE_ID'},
+                        'timestamp': 1457764197627,
+                        'message': {
+                            'mid': 'mid.1',
+                            'attachments': [{
+                                'type': 'image',
+                                'payload': {'url': 'IMAGE_URL'},
+                            }],
+                        },
+                    }],
+                }],
+            }))
+
+        [msg] = self.tx_helper.get_dispatched_inbound()
+        key = hashlib.sha1('mid.1:0').hexdigest()
+        self.assertEqual(msg['transport_metadata'], {
+            'messenger': {
+                'mid': 'mid.1',
+                'attachments': [{
+                    'type': 'image',
+                    'payload': {
+                        'url': 'http://localhost/attachments/%s' % (key,),
+                        'source_url': 'IMAGE_URL',
+                    },
+                }],
+            },
+        })
+
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        self.assertEqual(args, ('GET', 'IMAGE_URL', ''))
+        request_d.callback(DummyResponse(404, ''))
+        self.assertEqual(transport.attachment_stats, {'failed': 1})
+
+    @inlineCallbacks
+    def test_fetch_attachment(self):
+        transport = yield self.mk_transport(
+            attachment_store_path=self.mktemp(),
+            attachment_url='http://localhost/attachments')
+
+        d = transport.fetch_attachment('key', 'IMAGE_URL')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(
+            200, 'image data', headers={'Content-Type': ['image/png']}))
+        yield d
+
+        path, content_type = transport.attachment_store.get('key')
+        self.assertEqual(open(path).read(), 'image data')
+        self.assertEqual(content_type, 'image/png')
+        self.assertEqual(transport.attachment_stats, {'fetched': 1})
+
+    @inlineCallbacks
+    def test_fetch_attachment_too_large(self):
+        transport = yield self.mk_transport(
+            attachment_store_path=self.mktemp(),
+            attachment_url='http://localhost/attachments',
+            attachment_max_bytes=10)
+
+        d = transport.fetch_attachment('key1', 'IMAGE_URL_1')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        response = DummyResponse(200, 'x' * 11)
+        request_d.callback(response)
+        yield d
+        self.assertEqual(response.transport.stopped, False)
+
+        d = transport.fetch_attachment('key2', 'IMAGE_URL_2')
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        response = DummyResponse(
+            200, 'x' * 20, length=object(), chunk_size=4)
+        request_d.callback(response)
+        yield d
+        self.assertEqual(response.transport.stopped, True)
+
+        self.assertEqual(transport.attachment_stats, {'too_large': 2})
+        self.assertEqual(transport.attachment_store.get('key2'), None)
+
+    @inlineCallbacks
+    def test_fetch_attachment_timeout(self):
+        transport = yield self.mk_transport(
+            attachment_store_path=self.mktemp(),
+            attachment_url='http://localhost/attachments',
+            attachment_fetch_concurrency=1,
+            attachment_fetch_timeout=30)
+        transport.attachment_fetches.run(
+            transport.fetch_attachment, 'key1', 'IMAGE_URL_1').addErrback(
+                transport._attachment_fetch_failed, 'IMAGE_URL_1')
+        transport.attachment_fetches.run(
+            transport.fetch_attachment, 'key2', 'IMAGE_URL_2')
+
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        self.assertEqual(args, ('GET', 'IMAGE_URL_1', ''))
+        self.assertEqual(transport.request_queue.pending, [])
+
+        self.clock.advance(30)
+        self.assertTrue(request_d.called)
+        self.assertEqual(transport.attachment_stats, {'failed': 1})
+        (request_d, args, kwargs) = yield transport.request_queue.get()
+        self.assertEqual(args, ('GET', 'IMAGE_URL_2', ''))
+
+    def mk_messaging_window_started(self, transport, started):
+        return transport.redis.set(
+            transport.messaging_window_started_key(), started)
+
+    @inlineCallbacks
+    def test_outbound_outside_messaging_window(self):
+        transport = yield self.mk_transport(
+            access_token='TOKEN', messaging_window=86400)
+        yield self.mk_messaging_window_started(transport, -86400)
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID', content='Hello, world!')
+        yield self.assert_outbound_failure(
+            msg['message_id'],
+            'Outside of the messaging window and no tag given',
+            'outside_messaging_window')
+        self.assertEqual(transport.request_queue.pending, [])
+        self.assertEqual(transport.messaging_window_rejections, 1)
+
+    @inlineCallbacks
+    def test_outbound_messaging_window_cold_start(self):
+        transport = yield self.mk_transport(
+            access_token='TOKEN', messaging_window=86400)
+        self.assertNotEqual(
+            (yield transport.redis.get(
+                transport.messaging_window_started_key())),
+            None)
+        yield self.mk_messaging_window_started(transport, 0)
+        self.clock.advance(86399)
+
+        d = self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID', content='Hello, world!')
+        request_d, args, kwargs = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(200, json.dumps([{
+            'code': 200,
+            'body': json.dumps({'message_id': 'MESSAGE_ID'}),
+        }])))
+        msg = yield d
+        yield self.assert_outbound_success(msg['message_id'], 'MESSAGE_ID')
+        self.assertFalse(transport.messaging_window_warm)
+        self.tx_helper.clear_dispatched_events()
+        self.tx_helper.clear_dispatched_statuses()
+
+        self.clock.advance(1)
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID', content='Hello, world!')
+        yield self.assert_outbound_failure(
+            msg['message_id'],
+            'Outside of the messaging window and no tag given',
+            'outside_messaging_window')
+        self.assertTrue(transport.messaging_window_warm)
+
+    @inlineCallbacks
+    def test_outbound_inside_messaging_window(self):
+        transport = yield self.mk_transport(
+            access_token='TOKEN', messaging_window=86400)
+
+        yield self.tx_helper.mk_request_raw(
+            method='POST', data=self.mk_text_event('mid.1', 'hi'))
+        self.assertEqual(
+            (yield transport.redis.ttl(
+                transport.messaging_window_key('USER_ID'))),
+            86400)
+        self.tx_helper.clear_dispatched_statuses()
+
+        d = self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID', content='Hello, world!')
+        request_d, args, kwargs = yield transport.request_queue.get()
+        request_d.callback(DummyResponse(200, json.dumps([{
+            'code': 200,
+            'body': json.dumps({'message_id': 'MESSAGE_ID'}),
+        }])))
+
+        msg = yield d
+        yield self.assert_outbound_success(msg['message_id'], 'MESSAGE_ID')
+
+    @inlineCallbacks
+    def test_outbound_tagged_outside_messaging_window(self):
+        transport = yield self.mk_transport(
+            access_token='TOKEN', messaging_window=86400)
+
+        d = self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID',
+            content='Hello, world!',
+            helper_metadata={'messenger': {
+                'messaging_type': 'MESSAGE_TAG',
+                'tag': 'ACCOUNT_UPDATE',
+            }})
+        request_d, args, kwargs = yield transport.request_queue.get()
+        method, url, data = args
+        req_body = parse_qs(json.loads(data['batch'])[0]['body'])
+        self.assertEqual(req_body['messaging_type'], ['MESSAGE_TAG'])
+        self.assertEqual(req_body['tag'], ['ACCOUNT_UPDATE'])
+
+        request_d.callback(DummyResponse(200, json.dumps([{
+            'code': 200,
+            'body': json.dumps({'message_id': 'MESSAGE_ID'}),
+        }])))
+
+        msg = yield d
+        yield self.assert_outbound_success(msg['message_id'], 'MESSAGE_ID')
+
+    @inlineCallbacks
+    def test_outbound_invalid_message(self):
+        transport = yield self.mk_transport(access_token='TOKEN')
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            to_addr='USER_ID',
+            content='Hello, world!',
+            helper_metadata={'messenger': {
+                'quick_replies': [{
+                    'content_type': 'text',
+                    'title': 'A very long quick reply title',
+                    'payload': 'PAYLOAD',
+                }],
+            }})
+        yield self.assert_outbound_failure(
+            msg['message_id'],
+            'Invalid message: message.quick_replies[0].title: '
+            'must be at most 20 characters',
+            'invalid_message')
+        self.assertEqual(transport.queue_len, 0)
+        self.assertEqual(transport.invalid_messages, 1)
+
     @inlineCallbacks
     def test_sender_action(self):
         transport = yield self.mk_transport(access_token='access_token')
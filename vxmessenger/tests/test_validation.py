@@ -0,0 +1,114 @@
+from twisted.trial.unittest import TestCase
+
+from vxmessenger.validation import validate_message, ValidationError
+
+
+class TestValidateMessage(TestCase):
+
+    def mk_message(self, **message):
+        return {'recipient': {'id': 'USER_ID'}, 'message': message}
+
+    def mk_template(self, **payload):
+        return self.mk_message(attachment={
+            'type': 'template',
+            'payload': payload,
+        })
+
+    def assert_invalid(self, msg, reason):
+        err = self.assertRaises(ValidationError, validate_message, msg)
+        self.assertEqual(str(err), reason)
+
+    def test_text(self):
+        validate_message(self.mk_message(text=u'Hello \u2603'))
+
+    def test_text_too_long(self):
+        self.assert_invalid(
+            self.mk_message(text='a' * 2001),
+            'message.text: must be at most 2000 characters')
+
+    def test_no_content(self):
+        self.assert_invalid(
+            self.mk_message(metadata='META'),
+            'message: must have one of text, attachment')
+
+    def test_no_recipient(self):
+        self.assert_invalid(
+            {'message': {'text': 'hi'}}, 'recipient: is required')
+
+    def test_quick_replies(self):
+        validate_message(self.mk_message(text='hi', quick_replies=[
+            {'content_type': 'text', 'title': 'Yes', 'payload': 'YES'},
+            {'content_type': 'location'},
+        ]))
+
+    def test_too_many_quick_replies(self):
+        self.assert_invalid(
+            self.mk_message(text='hi', quick_replies=[
+                {'content_type': 'location'}] * 12),
+            'message.quick_replies: must have at most 11 items')
+
+    def test_quick_reply_title_too_long(self):
+        self.assert_invalid(
+            self.mk_message(text='hi', quick_replies=[
+                {'content_type': 'text', 'title': 'a' * 21, 'payload': 'A'}]),
+            'message.quick_replies[0].title: must be at most 20 characters')
+
+    def test_media_attachment(self):
+        validate_message(self.mk_message(attachment={
+            'type': 'image',
+            'payload': {'url': 'https://example.com/image.jpg'},
+        }))
+        validate_message(self.mk_message(attachment={
+            'type': 'video',
+            'payload': {'attachment_id': '1234'},
+        }))
+
+    def test_bad_attachment_type(self):
+        self.assert_invalid(
+            self.mk_message(attachment={
+                'type': 'gif', 'payload': {'url': 'http://a.com/a.gif'}}),
+            'message.attachment.type: must be one of '
+            'audio, file, image, video')
+
+    def test_button_template(self):
+        validate_message(self.mk_template(
+            template_type='button', text='Pick', buttons=[
+                {'type': 'postback', 'title': 'A', 'payload': 'A'},
+                {'type': 'web_url', 'title': 'B', 'url': 'http://b.com'},
+                {'type': 'phone_number', 'title': 'C', 'payload': '+271'},
+            ]))
+
+    def test_bad_button_type(self):
+        self.assert_invalid(
+            self.mk_template(template_type='button', text='Pick', buttons=[
+                {'type': 'postbak', 'title': 'A', 'payload': 'A'}]),
+            'message.attachment.payload.buttons[0].type: must be one of '
+            'account_link, account_unlink, element_share, payment, '
+            'phone_number, postback, web_url')
+
+    def test_too_many_buttons(self):
+        self.assert_invalid(
+            self.mk_template(template_type='button', text='Pick', buttons=[
+                {'type': 'postback', 'title': 'A', 'payload': 'A'}] * 4),
+            'message.attachment.payload.buttons: must have at most 3 items')
+
+    def test_generic_template_missing_title(self):
+        self.assert_invalid(
+            self.mk_template(template_type='generic', elements=[{
+                'subtitle': 'No title',
+            }]),
+            'message.attachment.payload.elements[0].title: is required')
+
+    def test_unknown_template_type(self):
+        validate_message(self.mk_template(
+            template_type='airline_boardingpass', intro_message='Hi'))
+
+    def test_sender_action(self):
+        validate_message({
+            'recipient': {'id': 'USER_ID'},
+            'sender_action': 'typing_on',
+        })
+        self.assert_invalid({
+            'recipient': {'id': 'USER_ID'},
+            'sender_action': 'typing',
+        }, 'sender_action: must be one of mark_seen, typing_off, typing_on')
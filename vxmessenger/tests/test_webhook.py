@@ -1,15 +1,24 @@
+import hashlib
+import hmac
+import json
+import os
 from urllib import urlencode
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.endpoints import serverFromString
 from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
 from twisted.web.client import HTTPConnectionPool
 from twisted.web.server import Site
 
 import treq
 
-from vxmessenger.webhook import WebhookService
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+import vxmessenger
+from vxmessenger.webhook import (
+    WebhookService, WorkerPool, listen_socket, worker_args)
 
 
 class TestWebhookService(TestCase):
@@ -55,3 +64,308 @@ class TestWebhookService(TestCase):
             'hub.verify_token': 'token',
         })), pool=self.pool)
         self.assertEqual((yield response.content()), 'Bad Request')
+
+
+class TestWebhookIngress(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.clock.advance(1000)
+
+        # cleanup stuff for treq's global http request pool
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.add_cleanup(self.pool.closeCachedConnections)
+
+    @inlineCallbacks
+    def start_service(self, **kw):
+        self.ws = WebhookService(
+            'token', redis=self.redis, clock=self.clock, **kw)
+        endpoint = serverFromString(reactor, 'tcp:0')
+        listener = yield endpoint.listen(Site(self.ws.app.resource()))
+        self.url = 'http://127.0.0.1:%s/' % (listener.getHost().port,)
+        self.add_cleanup(listener.loseConnection)
+
+    def mk_body(self, *page_ids):
+        return json.dumps({
+            'object': 'page',
+            'entry': [{
+                'id': page_id,
+                'time': 1457764198246,
+                'messaging': [{
+                    'sender': {'id': 'USER_ID'},
+                    'recipient': {'id': page_id},
+                    'timestamp': 1457764197627,
+                    'message': {'mid': 'mid.%s' % (i,), 'text': 'hi'},
+                }],
+            } for i, page_id in enumerate(page_ids)],
+        })
+
+    def sign(self, body, secret='secret'):
+        return 'sha1=%s' % (
+            hmac.new(secret, body, hashlib.sha1).hexdigest(),)
+
+    def post(self, body, headers=None):
+        return treq.post(self.url, body, headers=headers, pool=self.pool)
+
+    @inlineCallbacks
+    def get_buffered(self, page_id):
+        records = yield self.redis.lrange('ingress:%s' % (page_id,), 0, -1)
+        returnValue([json.loads(r) for r in records])
+
+    @inlineCallbacks
+    def test_buffered(self):
+        yield self.start_service()
+        body = self.mk_body('PAGE_ID')
+        response = yield self.post(body)
+        self.assertEqual(response.code, 200)
+        yield response.content()
+
+        [record] = yield self.get_buffered('PAGE_ID')
+        self.assertEqual(record['body'], body)
+        self.assertEqual(record['timestamp'], 1000)
+        self.assertTrue(record['message_id'])
+
+    @inlineCallbacks
+    def test_partitioned_by_page(self):
+        yield self.start_service()
+        response = yield self.post(self.mk_body('PAGE_1', 'PAGE_2', 'PAGE_1'))
+        self.assertEqual(response.code, 200)
+        yield response.content()
+
+        [record] = yield self.get_buffered('PAGE_1')
+        entries = json.loads(record['body'])['entry']
+        self.assertEqual([e['id'] for e in entries], ['PAGE_1', 'PAGE_1'])
+        [record] = yield self.get_buffered('PAGE_2')
+        entries = json.loads(record['body'])['entry']
+        self.assertEqual([e['id'] for e in entries], ['PAGE_2'])
+        self.assertEqual(self.ws.stats['pages'], 2)
+
+    @inlineCallbacks
+    def test_signature(self):
+        yield self.start_service(app_secret='secret')
+        body = self.mk_body('PAGE_ID')
+        response = yield self.post(
+            body, headers={'X-Hub-Signature': [self.sign(body)]})
+        self.assertEqual(response.code, 200)
+        yield response.content()
+        self.assertEqual(len((yield self.get_buffered('PAGE_ID'))), 1)
+
+    @inlineCallbacks
+    def test_signature_invalid(self):
+        yield self.start_service(app_secret='secret')
+        body = self.mk_body('PAGE_ID')
+        for headers in [None, {'X-Hub-Signature': [self.sign(body, 'foo')]}]:
+            response = yield self.post(body, headers=headers)
+            self.assertEqual(response.code, 403)
+            yield response.content()
+        self.assertEqual((yield self.get_buffered('PAGE_ID')), [])
+        self.assertEqual(self.ws.stats['invalid_signature'], 2)
+
+    @inlineCallbacks
+    def test_invalid_body(self):
+        yield self.start_service()
+        for body in ['foo', '{}', '{"entry": [{}]}']:
+            response = yield self.post(body)
+            self.assertEqual(response.code, 400)
+            yield response.content()
+        self.assertEqual(self.ws.stats['invalid_body'], 3)
+
+    @inlineCallbacks
+    def test_no_redis(self):
+        ws = WebhookService('token')
+        endpoint = serverFromString(reactor, 'tcp:0')
+        listener = yield endpoint.listen(Site(ws.app.resource()))
+        self.add_cleanup(listener.loseConnection)
+        response = yield treq.post(
+            'http://127.0.0.1:%s/' % (listener.getHost().port,),
+            self.mk_body('PAGE_ID'), pool=self.pool)
+        self.assertEqual(response.code, 404)
+        yield response.content()
+
+    @inlineCallbacks
+    def test_redis_pending(self):
+        redis = self.redis
+        self.redis = None
+        yield self.start_service(redis_pending=True)
+        response = yield self.post(self.mk_body('PAGE_ID'))
+        self.assertEqual(response.code, 503)
+        yield response.content()
+        self.assertEqual(self.ws.stats['unavailable'], 1)
+
+        self.ws.redis = self.redis = redis
+        response = yield self.post(self.mk_body('PAGE_ID'))
+        self.assertEqual(response.code, 200)
+        yield response.content()
+        self.assertEqual(len((yield self.get_buffered('PAGE_ID'))), 1)
+
+    @inlineCallbacks
+    def test_redis_failed(self):
+        yield self.start_service()
+
+        def lpush(key, value):
+            raise Exception('Redis is down')
+
+        self.patch(self.redis, 'lpush', lpush)
+        response = yield self.post(self.mk_body('PAGE_ID'))
+        self.assertEqual(response.code, 503)
+        yield response.content()
+        self.assertEqual(self.ws.stats['unavailable'], 1)
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), 'Redis is down')
+
+    def test_wait_until_idle(self):
+        ws = WebhookService('token', clock=self.clock)
+        self.assertTrue(ws.wait_until_idle(10).called)
+
+        ws.active = 2
+        d = ws.wait_until_idle(10)
+        ws.request_finished()
+        self.assertFalse(d.called)
+        ws.request_finished()
+        self.assertTrue(d.called)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_wait_until_idle_timeout(self):
+        ws = WebhookService('token', clock=self.clock)
+        ws.active = 1
+        d = ws.wait_until_idle(10)
+        self.clock.advance(9)
+        self.assertFalse(d.called)
+        self.clock.advance(1)
+        self.assertTrue(d.called)
+
+
+class TestWorkerPool(TestCase):
+
+    timeout = 60
+
+    def setUp(self):
+        self.sock = listen_socket('127.0.0.1', 0)
+        self.addCleanup(self.sock.close)
+        self.url = 'http://127.0.0.1:%s/' % (self.sock.getsockname()[1],)
+        self.pool = self.mk_pool(['--token', 'token'])
+
+        # cleanup stuff for treq's global http request pool
+        self.http_pool = HTTPConnectionPool(reactor, persistent=False)
+        self.addCleanup(self.http_pool.closeCachedConnections)
+
+    def mk_pool(self, args):
+        root = os.path.dirname(os.path.dirname(
+            os.path.abspath(vxmessenger.__file__)))
+        pool = WorkerPool(
+            2, self.sock.fileno(), args,
+            env=dict(os.environ, PYTHONPATH=root), respawn_delay=0,
+            child_fds={0: 'w', 1: 'r', 2: 'r'})
+        self.addCleanup(pool.stop)
+        return pool
+
+    def pids(self):
+        return set(p.transport.pid for p in self.pool.processes.values())
+
+    @inlineCallbacks
+    def wait_for(self, condition):
+        while not condition():
+            yield deferLater(reactor, 0.05, lambda: None)
+
+    @inlineCallbacks
+    def assert_verifies(self):
+        response = yield treq.get('%s?%s' % (self.url, urlencode({
+            'hub.mode': 'subscribe',
+            'hub.challenge': 'challenge',
+            'hub.verify_token': 'token',
+        })), pool=self.http_pool)
+        self.assertEqual((yield response.content()), 'challenge')
+
+    @inlineCallbacks
+    def test_workers(self):
+        self.pool.start()
+        self.assertEqual(len(self.pids()), 2)
+        for i in range(4):
+            yield self.assert_verifies()
+
+        yield self.pool.stop()
+        self.assertEqual(self.pool.processes, {})
+
+    @inlineCallbacks
+    def test_restart(self):
+        self.pool.start()
+        old = self.pids()
+        yield self.assert_verifies()
+
+        self.pool.restart()
+        self.assertEqual(len(self.pool.retiring), 2)
+        self.assertEqual(len(self.pool.replaced), 2)
+        self.assertEqual(len(self.pids()), 2)
+        self.assertEqual(self.pids() & old, set())
+        yield self.wait_for(lambda: not self.pool.replaced)
+        self.assertTrue(
+            all(p.ready for p in self.pool.processes.values()))
+        yield self.wait_for(lambda: not self.pool.retiring)
+        yield self.assert_verifies()
+
+    def test_restart_waits_for_ready(self):
+        class FakeWorker(object):
+            def __init__(self, number):
+                self.number = number
+                self.ready = False
+                self.transport = type('FakeTransport', (), {'pid': number})
+                self.signals = []
+
+            def signal(self, name):
+                self.signals.append(name)
+
+        old = [FakeWorker(0), FakeWorker(1)]
+        new = [FakeWorker(0), FakeWorker(1)]
+        self.pool.processes = dict(enumerate(new))
+        self.pool.retiring.update(old)
+        self.pool.replaced.extend(old)
+
+        new[1].ready = True
+        self.pool.worker_ready(new[1])
+        self.assertEqual([w.signals for w in old], [[], []])
+
+        new[0].ready = True
+        self.pool.worker_ready(new[0])
+        self.assertEqual([w.signals for w in old], [['TERM'], ['TERM']])
+        self.assertEqual(self.pool.replaced, [])
+        self.pool.processes = {}
+        self.pool.retiring.clear()
+
+    @inlineCallbacks
+    def test_respawn(self):
+        self.pool.start()
+        yield self.assert_verifies()
+        old = self.pool.processes[0]
+        old.signal('KILL')
+        yield self.wait_for(
+            lambda: self.pool.processes.get(0) not in (None, old))
+        self.assertEqual(len(self.pids()), 2)
+        yield self.assert_verifies()
+
+    @inlineCallbacks
+    def test_without_token(self):
+        self.pool = self.mk_pool(worker_args(
+            None, None, None, 'ingress', 10, 60))
+        self.pool.start()
+        self.assertEqual(len(self.pids()), 2)
+        response = yield treq.get('%s?%s' % (self.url, urlencode({
+            'hub.mode': 'subscribe',
+            'hub.challenge': 'challenge',
+            'hub.verify_token': 'token',
+        })), pool=self.http_pool)
+        self.assertEqual(response.code, 404)
+        yield response.content()
+
+    def test_worker_args(self):
+        self.assertEqual(
+            worker_args(None, None, None, 'ingress', 10, 60),
+            ['--key-prefix', 'ingress', '--grace', '10',
+             '--stats-interval', '60'])
+        self.assertEqual(
+            worker_args('token', 'secret', '{}', 'ingress', 10.0, 60.0),
+            ['--key-prefix', 'ingress', '--grace', '10.0',
+             '--stats-interval', '60.0', '--token', 'token',
+             '--app-secret', 'secret', '--redis', '{}'])
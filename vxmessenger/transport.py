@@ -1,13 +1,22 @@
-import json
+import hashlib
+import random
+import tempfile
+import uuid
+from collections import Counter, OrderedDict
 from datetime import datetime
+from StringIO import StringIO
 from urllib import urlencode
 from urlparse import parse_qs, urlsplit, urlunsplit
 
 import treq
 from confmodel.fallbacks import SingleFieldFallback
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredLock
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredLock, Deferred, DeferredSemaphore,
+    gatherResults, succeed)
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 from twisted.web import http
 from twisted.web.client import HTTPConnectionPool
 
@@ -16,6 +25,18 @@ from vumi.config import (ConfigText, ConfigDict, ConfigBool, ConfigInt,
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.transports.httprpc import HttpRpcTransport
 
+from vxmessenger import codec
+from vxmessenger.attachments import (
+    AttachmentStore, AttachmentResource, AttachmentTooLarge, read_body)
+from vxmessenger.cache import LRUCache, BloomFilter
+from vxmessenger.capture import CaptureWriter
+from vxmessenger.metrics import MetricsRegistry, MetricsResource
+from vxmessenger.monitor import Profiler, ProfileResource, ReactorLagMonitor
+from vxmessenger.validation import validate_message, ValidationError
+
+
+PAYLOAD_TOKEN_PREFIX = 'vxpayload:'
+
 
 class MessengerTransportConfig(HttpRpcTransport.CONFIG_CLASS):
 
@@ -44,13 +65,223 @@ class MessengerTransportConfig(HttpRpcTransport.CONFIG_CLASS):
     redis_manager = ConfigDict(
         "Parameters to connect to Redis with",
         required=False, default={}, static=True)
+    inbound_buffer = ConfigBool(
+        "Set to true to store inbound webhook requests in a Redis buffer "
+        "and respond immediately, rather than responding once the "
+        "messages have been published",
+        required=False, default=False, static=True)
+    inbound_buffer_key = ConfigText(
+        "The Redis key of the inbound buffer, defaults to "
+        "inboundbuffer:<transport_name>",
+        required=False, static=True)
+    inbound_buffer_workers = ConfigInt(
+        "The number of workers draining the inbound buffer. Messages from "
+        "a single user may be published out of order if this is more "
+        "than 1.",
+        required=False, default=1, static=True)
+    inbound_buffer_wait_time = ConfigFloat(
+        "The time to wait between checks of an empty inbound buffer "
+        "(in seconds)",
+        required=False, default=0.1, static=True)
+    inbound_buffer_max_attempts = ConfigInt(
+        "The number of times to try publishing a buffered webhook request "
+        "before moving it to the <inbound_buffer_key>:failed list",
+        required=False, default=5, static=True)
+    inbound_buffer_lease_ttl = ConfigInt(
+        "The number of seconds a transport's claim on the buffered requests "
+        "it is processing lasts without being renewed. Requests claimed by "
+        "a transport whose claim has run out are returned to the buffer.",
+        required=False, default=30, static=True)
+    sent_message_retention = ConfigInt(
+        "The number of seconds to remember sent messages for, to match "
+        "them to delivery and read receipts. Set to 0 to disable delivery "
+        "reports.",
+        required=False, default=86400, static=True)
+    unsupported_events = ConfigDict(
+        "What to do with inbound events of unsupported types, such as "
+        "message echoes and reactions. Maps the event type (``echo``, "
+        "``reaction`` or the event's key) to ``drop``, ``count`` or "
+        "``forward``. The policy for types not listed is given by "
+        "``default``, which defaults to ``count``.",
+        required=False, default={}, static=True)
+    log_levels = ConfigDict(
+        "The level to log messages at on each of the message paths: "
+        "``inbound`` for published inbound messages, ``outbound`` for "
+        "outbound messages and ``reply`` for the requests built from them. "
+        "Levels are ``debug``, ``info``, ``warning``, ``error`` or ``off``, "
+        "paths default to ``info``.",
+        required=False, default={}, static=True)
+    log_sample_rate = ConfigInt(
+        "Only log 1 in every N messages on each of the message paths",
+        required=False, default=1, static=True)
+    log_redact_content = ConfigBool(
+        "Set to true to leave message content out of the logs",
+        required=False, default=False, static=True)
+    inbound_debounce_window = ConfigFloat(
+        "The time to wait for further text messages from a sender before "
+        "publishing them as a single message (in seconds). Set to 0 to "
+        "publish every message as it arrives. Can't be used with "
+        "inbound_buffer.",
+        required=False, default=0, static=True)
+    inbound_debounce_max_messages = ConfigInt(
+        "The maximum number of messages to merge into a single message",
+        required=False, default=10, static=True)
+    inbound_debounce_max_senders = ConfigInt(
+        "The maximum number of senders to hold messages back for at once",
+        required=False, default=1000, static=True)
+    payload_store_threshold = ConfigInt(
+        "Postback and quick reply payloads longer than this many characters "
+        "are stored in Redis and replaced with a short token in outbound "
+        "messages. Set to 0 to send all payloads as they are.",
+        required=False, default=0, static=True)
+    payload_store_ttl = ConfigInt(
+        "The number of seconds to store payloads for",
+        required=False, default=604800, static=True)
+    attachment_store_path = ConfigText(
+        "The directory to store copies of inbound attachments in. If set, "
+        "attachment URLs in inbound messages are replaced with URLs "
+        "served by the transport.",
+        required=False, static=True)
+    attachment_url = ConfigText(
+        "The public URL the attachment store is served at, usually the "
+        "transport's public URL followed by ``attachment_web_path``",
+        required=False, static=True)
+    attachment_web_path = ConfigText(
+        "The path to serve stored attachments on",
+        required=False, default='attachments', static=True)
+    attachment_store_max_bytes = ConfigInt(
+        "The maximum size of the attachment store, least recently used "
+        "attachments are removed when it is full",
+        required=False, default=1024 * 1024 * 1024, static=True)
+    attachment_max_bytes = ConfigInt(
+        "The maximum size of an attachment to store",
+        required=False, default=25 * 1024 * 1024, static=True)
+    attachment_fetch_concurrency = ConfigInt(
+        "The maximum number of attachments to fetch at once",
+        required=False, default=4, static=True)
+    attachment_fetch_timeout = ConfigFloat(
+        "The time to give up fetching an attachment after (in seconds), "
+        "set to 0 to wait for as long as it takes",
+        required=False, default=60, static=True)
+    dedupe_ttl = ConfigInt(
+        "The number of seconds to remember inbound events for, to drop "
+        "events that Facebook delivers more than once. Set to 0 to disable.",
+        required=False, default=3600, static=True)
+    dedupe_bloom_filter = ConfigBool(
+        "Set to true to check inbound events against an in-process Bloom "
+        "filter before checking Redis. Only use this if a single transport "
+        "process receives all the webhooks for the page.",
+        required=False, default=False, static=True)
+    dedupe_bloom_filter_capacity = ConfigInt(
+        "The number of inbound events the Bloom filter is sized for",
+        required=False, default=100000, static=True)
+    messaging_window = ConfigInt(
+        "The length of Facebook's standard messaging window (in seconds). "
+        "Outbound messages without a ``tag`` to users that haven't "
+        "messaged the page within the window are failed without sending "
+        "them. Set to 0 to disable.",
+        required=False, default=0, static=True)
+    capture_path = ConfigText(
+        "The gzipped file to record inbound webhook requests and outbound "
+        "messages to, for replaying later. Leave unset to not record them",
+        required=False, static=True)
+    reactor_lag_interval = ConfigFloat(
+        "How often to measure how late the reactor is running scheduled "
+        "calls, in seconds. Set to 0 to disable",
+        required=False, default=0, static=True)
+    reactor_stall_threshold = ConfigFloat(
+        "Log the call in progress when the reactor is at least this many "
+        "seconds late. Set to 0 to disable",
+        required=False, default=1.0, static=True)
+    profile_web_path = ConfigText(
+        "The path to POST to to capture a CPU profile of the transport, "
+        "leave unset to disable. Requires web_username and web_password.",
+        required=False, static=True)
+    profile_dir = ConfigText(
+        "The directory to write CPU profiles to, defaults to the system's "
+        "temporary directory",
+        required=False, static=True)
+    metrics_web_path = ConfigText(
+        "The path to serve metrics on in the Prometheus text format, "
+        "leave unset to not serve them",
+        required=False, static=True)
+    trace_slow_threshold = ConfigFloat(
+        "Log a trace of the time spent in each stage of handling for "
+        "messages that take at least this many seconds end to end. Set to "
+        "0 to disable",
+        required=False, default=0, static=True)
+    trace_sample_rate = ConfigFloat(
+        "The fraction of slow messages to log traces for",
+        required=False, default=1.0, static=True)
+    validate_outbound = ConfigBool(
+        "Set to false to send outbound messages to Facebook without "
+        "checking them against the Send API's limits first",
+        required=False, default=True, static=True)
+    unreachable_recipient_ttl = ConfigInt(
+        "The number of seconds to remember recipients that Facebook "
+        "reported as unreachable for. Outbound messages to them are failed "
+        "without sending them. Set to 0 to disable.",
+        required=False, default=0, static=True)
+    profile_cache_size = ConfigInt(
+        "The maximum number of user profiles to keep in memory",
+        required=False, default=1000, static=True)
+    profile_cache_ttl = ConfigInt(
+        "The number of seconds to cache retrieved user profiles for, "
+        "set to 0 to disable caching",
+        required=False, default=3600, static=True)
+    profile_cache_error_ttl = ConfigInt(
+        "The number of seconds to cache failed user profile lookups for",
+        required=False, default=60, static=True)
+    profile_lookup_timeout = ConfigFloat(
+        "The maximum time to wait for a user profile lookup before "
+        "publishing the message without it (in seconds), the lookup "
+        "continues in the background. Set to 0 to always wait.",
+        required=False, default=0, static=True)
+    profile_batch_wait_time = ConfigFloat(
+        "The time to collect user profile lookups for before sending them "
+        "as a single batch API call (in seconds), set to 0 to look up "
+        "each profile individually",
+        required=False, default=0, static=True)
+
+    LOG_LEVELS = ('debug', 'info', 'warning', 'error', 'off')
+    UNSUPPORTED_EVENT_POLICIES = ('drop', 'count', 'forward')
+
+    def post_validate(self):
+        super(MessengerTransportConfig, self).post_validate()
+        if self.attachment_store_path and not self.attachment_url:
+            self.raise_config_error(
+                "attachment_url is required with attachment_store_path")
+        if self.profile_web_path and not (
+                self.web_username and self.web_password):
+            # Anyone who can reach the webhook could profile the transport
+            self.raise_config_error(
+                "web_username and web_password are required with "
+                "profile_web_path")
+        if self.inbound_buffer and self.inbound_debounce_window > 0:
+            # Held back messages are only kept in memory, and would be lost
+            # if the transport stopped after removing them from the buffer.
+            self.raise_config_error(
+                "inbound_debounce_window can't be used with inbound_buffer")
+        for path, level in self.log_levels.iteritems():
+            if level not in self.LOG_LEVELS:
+                self.raise_config_error(
+                    "log_levels for %s must be one of %s, not %r" % (
+                        path, ', '.join(self.LOG_LEVELS), level))
+        for event_type, policy in self.unsupported_events.iteritems():
+            if policy not in self.UNSUPPORTED_EVENT_POLICIES:
+                self.raise_config_error(
+                    "unsupported_events for %s must be one of %s, not %r" % (
+                        event_type, ', '.join(self.UNSUPPORTED_EVENT_POLICIES),
+                        policy))
 
 
 class Page(object):
     """A thing that parses "Page" objects as received from Messenger"""
 
     def __init__(self, to_addr, from_addr,
-                 mid, content, timestamp, in_reply_to=None, extra=None):
+                 mid, content, timestamp, in_reply_to=None, extra=None,
+                 event_type='message'):
+        self.event_type = event_type
         self.to_addr = to_addr
         self.from_addr = from_addr
         self.in_reply_to = in_reply_to
@@ -58,6 +289,7 @@ class Page(object):
         self.content = content
         self.timestamp = timestamp
         self.extra = extra if extra else {}
+        self.trace = {}
 
     def __str__(self):
         return ("<Page to_addr: %s, from_addr: %s, in_reply_to: %s, "
@@ -68,27 +300,78 @@ class Page(object):
             self.content,
             self.mid,
             self.timestamp,
-            json.dumps(self.extra, separators=(',', ':'))
+            codec.dumps(self.extra)
         )
 
-    @classmethod
-    def from_fp(cls, fp):
-
-        def fb_timestamp(timestamp):
-            return datetime.fromtimestamp(timestamp / 1000)
+    @property
+    def dedupe_key(self):
+        """
+        A key identifying the webhook event this page was parsed from, for
+        detecting redelivered events. Events without a message id are
+        identified by their sender, timestamp and type.
+        """
+        if self.mid is not None:
+            return self.mid
+        return '%s:%s:%s' % (
+            self.from_addr, self.timestamp.isoformat(), self.event_type)
 
+    @classmethod
+    def load(cls, fp):
         try:
-            data = json.load(fp)
+            return codec.load(fp)
         except (ValueError, KeyError), e:
             raise UnsupportedMessage('Unable to parse message: %s' % (e,))
 
+    @classmethod
+    def from_fp(cls, fp, unsupported=None):
+        return cls.from_data(cls.load(fp), unsupported)
+
+    @classmethod
+    def from_data(cls, data, unsupported=None):
+        """
+        Parse the pages in a webhook request. Events that aren't supported
+        are reported in the list of errors, unless an ``unsupported``
+        callback is given. It is called with the type of the event and the
+        event and should return ``True`` if the event should be parsed into
+        a page regardless.
+        """
+
+        def fb_timestamp(timestamp):
+            return datetime.fromtimestamp(timestamp / 1000.0)
+
         messages = []
         errors = []
 
+        def unsupported_event(msg):
+            if msg.get('message', {}).get('is_echo'):
+                return 'echo', msg['message']
+            for key, value in msg.iteritems():
+                if key not in ('sender', 'recipient', 'timestamp'):
+                    return key, value
+            return 'unknown', msg
+
+        def add_unsupported(msg):
+            if unsupported is None:
+                errors.append('Not supporting: %s' % (msg,))
+                return
+            event_type, event = unsupported_event(msg)
+            if unsupported(event_type, msg):
+                messages.append(cls(
+                    event_type=event_type,
+                    to_addr=msg['recipient']['id'],
+                    from_addr=msg['sender']['id'],
+                    mid=msg.get('message', {}).get('mid'),
+                    content='',
+                    extra={event_type: event},
+                    timestamp=fb_timestamp(msg.get('timestamp', 0)),
+                ))
+
         for entry in data.get('entry', []):
             for msg in entry.get('messaging', []):
-                if ('message' in msg) and ('quick_reply' in msg['message']):
-                    payload = json.loads(
+                if ('message' in msg) and msg['message'].get('is_echo'):
+                    add_unsupported(msg)
+                elif ('message' in msg) and ('quick_reply' in msg['message']):
+                    payload = codec.loads(
                         msg['message']['quick_reply']['payload']
                     )
                     in_reply_to = payload.get('in_reply_to')
@@ -97,6 +380,7 @@ class Page(object):
                     except KeyError:
                         pass
                     messages.append(cls(
+                        event_type='message',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=msg['message']['mid'],
@@ -107,6 +391,7 @@ class Page(object):
                     ))
                 elif ('message' in msg) and ('text' in msg['message']):
                     messages.append(cls(
+                        event_type='message',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=msg['message']['mid'],
@@ -115,6 +400,7 @@ class Page(object):
                     ))
                 elif ('message' in msg) and ('attachments' in msg['message']):
                     messages.append(cls(
+                        event_type='message',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=msg['message']['mid'],
@@ -124,6 +410,7 @@ class Page(object):
                     ))
                 elif 'optin' in msg:
                     messages.append(cls(
+                        event_type='optin',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=None,
@@ -131,11 +418,20 @@ class Page(object):
                         extra={'optin': msg['optin']},
                         timestamp=fb_timestamp(msg['timestamp'])
                     ))
-                elif 'delivery' in msg:
-                    errors.append('Not supporting delivery messages yet: %s.'
-                                  % (msg,))
+                elif 'delivery' in msg or 'read' in msg:
+                    event_type = 'delivery' if 'delivery' in msg else 'read'
+                    messages.append(cls(
+                        event_type=event_type,
+                        to_addr=msg['recipient']['id'],
+                        from_addr=msg['sender']['id'],
+                        mid=None,
+                        content='',
+                        extra={event_type: msg[event_type]},
+                        timestamp=fb_timestamp(msg.get(
+                            'timestamp', msg[event_type]['watermark'])),
+                    ))
                 elif 'postback' in msg:
-                    payload = json.loads(msg['postback']['payload'])
+                    payload = codec.loads(msg['postback']['payload'])
                     content = payload.get('content', '')
                     in_reply_to = payload.get('in_reply_to')
                     try:
@@ -147,6 +443,7 @@ class Page(object):
                     except KeyError:
                         pass
                     messages.append(cls(
+                        event_type='postback',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=None,
@@ -157,6 +454,7 @@ class Page(object):
                     ))
                     if 'referral' in msg['postback']:
                         messages.append(cls(
+                            event_type='referral',
                             to_addr=msg['recipient']['id'],
                             from_addr=msg['sender']['id'],
                             mid=None,
@@ -176,6 +474,7 @@ class Page(object):
                     if source == 'ADS':
                         extra['referral']['ad_id'] = msg['referral']['ad_id']
                     messages.append(cls(
+                        event_type='referral',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=None,
@@ -185,6 +484,7 @@ class Page(object):
                     ))
                 elif 'account_linking' in msg:
                     messages.append(cls(
+                        event_type='account_linking',
                         to_addr=msg['recipient']['id'],
                         from_addr=msg['sender']['id'],
                         mid=None,
@@ -193,7 +493,7 @@ class Page(object):
                         timestamp=fb_timestamp(msg['timestamp']),
                     ))
                 else:
-                    errors.append('Not supporting: %s' % (msg,))
+                    add_unsupported(msg)
         return messages, errors
 
 
@@ -215,10 +515,45 @@ class MessengerTransport(HttpRpcTransport):
         100: 'no_matching_user_found',
         10: 'application_does_not_have_permissions',
         2: 'internal_server_error',
+        551: 'user_unavailable',
     }
 
+    # Errors for which messages to the recipient will keep failing, as
+    # (code, subcode) pairs. A subcode of None matches errors without one.
+    UNREACHABLE_ERRORS = (
+        (100, 2018001),
+        (551, None),
+        (551, 1545041),
+    )
+
+    # Events from the user that open the standard messaging window
+    MESSAGING_WINDOW_EVENTS = (
+        'message', 'postback', 'optin', 'referral', 'account_linking')
+
+    # The stages of handling each message is stamped at, in order
+    OUTBOUND_TRACE_STAGES = (
+        'received', 'queued', 'dequeued', 'sent', 'responded', 'acked',
+        'nacked')
+    INBOUND_TRACE_STAGES = (
+        'received', 'dequeued', 'parsed', 'published')
+
     @inlineCallbacks
     def setup_transport(self):
+        static_config = self.get_static_config()
+        self.setup_metrics()
+        self.setup_monitoring()
+        self.attachment_store = None
+        if static_config.attachment_store_path:
+            self.attachment_store = AttachmentStore(
+                static_config.attachment_store_path,
+                static_config.attachment_store_max_bytes,
+                static_config.attachment_max_bytes)
+        self.attachment_url = static_config.attachment_url
+        self.attachment_fetches = DeferredSemaphore(
+            static_config.attachment_fetch_concurrency)
+        self.attachment_fetch_timeout = static_config.attachment_fetch_timeout
+        self.attachment_stats = Counter()
+
         yield super(MessengerTransport, self).setup_transport()
         self.pool = HTTPConnectionPool(self.clock, persistent=False)
 
@@ -234,6 +569,19 @@ class MessengerTransport(HttpRpcTransport):
         self.redis = yield TxRedisManager.from_config(
             static_config.redis_manager)
 
+        self.profile_cache_ttl = static_config.profile_cache_ttl
+        self.profile_cache_error_ttl = static_config.profile_cache_error_ttl
+        self.profile_cache = LRUCache(
+            static_config.profile_cache_size, self.clock)
+        self.profile_redis_hits = 0
+        self.profile_redis_misses = 0
+        self.profile_batch_time = static_config.profile_batch_wait_time
+        self.profile_lookup_timeout = static_config.profile_lookup_timeout
+        self.profile_lookup_timeouts = 0
+        self._profile_lookups = {}
+        self._profile_batch = []
+        self._profile_batch_call = None
+
         if self.config.get('welcome_message'):
             if not self.config.get('page_id'):
                 self.log.error('page_id is required for welcome_message')
@@ -254,14 +602,292 @@ class MessengerTransport(HttpRpcTransport):
 
         self.REQ_QUEUE_KEY = 'batchqueue:%s' % self.transport_name
 
+        self.sent_message_retention = static_config.sent_message_retention
+        self.log_levels = static_config.log_levels
+        self.log_sample_rate = max(1, static_config.log_sample_rate)
+        self.log_redact_content = static_config.log_redact_content
+        self._log_counts = Counter()
+
+        self.unsupported_events = static_config.unsupported_events
+        self.unsupported_event_counts = Counter()
+        self.debounce_window = static_config.inbound_debounce_window
+        self.debounce_max_messages = (
+            static_config.inbound_debounce_max_messages)
+        self.debounce_max_senders = static_config.inbound_debounce_max_senders
+        self._debounced = OrderedDict()
+
+        self.payload_store_threshold = static_config.payload_store_threshold
+        self.payload_store_ttl = static_config.payload_store_ttl
+        self.dedupe_ttl = static_config.dedupe_ttl
+        self.dedupe_filter = None
+        if self.dedupe_ttl and static_config.dedupe_bloom_filter:
+            self.dedupe_filter = BloomFilter(
+                static_config.dedupe_bloom_filter_capacity, self.dedupe_ttl,
+                self.clock)
+        self.inbound_duplicates = 0
+        self.messaging_window = static_config.messaging_window
+        self.messaging_window_rejections = 0
+        self.messaging_window_warm = False
+        if self.messaging_window:
+            yield self.redis.setnx(
+                self.messaging_window_started_key(),
+                int(self.clock.seconds()))
+        self.unreachable_recipient_ttl = (
+            static_config.unreachable_recipient_ttl)
+        self.unreachable_recipient_hits = 0
+        self.validate_outbound = static_config.validate_outbound
+        self.trace_slow_threshold = static_config.trace_slow_threshold
+        self.trace_sample_rate = static_config.trace_sample_rate
+        self.invalid_messages = 0
+
+        self.inbound_buffer = static_config.inbound_buffer
+        self.INBOUND_BUFFER_KEY = static_config.inbound_buffer_key
+        if self.INBOUND_BUFFER_KEY is None:
+            self.INBOUND_BUFFER_KEY = 'inboundbuffer:%s' % (
+                self.transport_name,)
+        self.INBOUND_WORKERS_KEY = '%s:workers' % (self.INBOUND_BUFFER_KEY,)
+        self.INBOUND_FAILED_KEY = '%s:failed' % (self.INBOUND_BUFFER_KEY,)
+        self.inbound_worker_id = uuid.uuid4().hex
+        self.INBOUND_PROCESSING_KEY = self.inbound_processing_key(
+            self.inbound_worker_id)
+        self.inbound_buffer_max_attempts = (
+            static_config.inbound_buffer_max_attempts)
+        self.inbound_buffer_lease_ttl = static_config.inbound_buffer_lease_ttl
+        self._inbound_workers = []
+        if self.inbound_buffer:
+            yield self.renew_inbound_lease()
+            loop = LoopingCall(self.renew_inbound_lease)
+            self._inbound_workers.append(loop)
+            self._start_inbound_worker(
+                loop, self.inbound_buffer_lease_ttl / 3.0)
+            for i in range(static_config.inbound_buffer_workers):
+                loop = LoopingCall(self.drain_inbound_buffer)
+                self._inbound_workers.append(loop)
+                self._start_inbound_worker(
+                    loop, static_config.inbound_buffer_wait_time)
+
     @inlineCallbacks
     def teardown_transport(self):
+        yield self.flush_all_debounced()
         if hasattr(self, 'web_resource'):
             yield self.web_resource.loseConnection()
             if self.request_gc.running:
                 self.request_gc.stop()
         if self._request_loop.running:
             self._request_loop.stop()
+        call = self._profile_batch_call
+        if call is not None and call.active():
+            call.cancel()
+        for loop in self._inbound_workers:
+            if loop.running:
+                loop.stop()
+        if self.inbound_buffer:
+            # Let the other transports pick up anything we were still
+            # processing without waiting for our lease to run out.
+            yield self.redis.delete(
+                self.inbound_lease_key(self.inbound_worker_id))
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+        if self.capture is not None:
+            self.capture.close()
+
+    def start_web_resources(self, resources, port, *args, **kw):
+        metrics_web_path = self.get_static_config().metrics_web_path
+        if metrics_web_path:
+            resources = resources + [(
+                self.get_authenticated_resource(
+                    MetricsResource(self.metrics)),
+                metrics_web_path)]
+        profile_web_path = self.get_static_config().profile_web_path
+        if profile_web_path:
+            resources = resources + [(
+                self.get_authenticated_resource(
+                    ProfileResource(self.profiler)),
+                profile_web_path)]
+        if self.attachment_store is not None:
+            resources = resources + [(
+                AttachmentResource(self.attachment_store),
+                self.get_static_config().attachment_web_path)]
+        return super(MessengerTransport, self).start_web_resources(
+            resources, port, *args, **kw)
+
+    def setup_metrics(self):
+        m = self.metrics = MetricsRegistry(
+            'vxmessenger_', {'transport': self.transport_name})
+        self.metric_queue_depth = m.gauge(
+            'outbound_queue_depth',
+            'Requests waiting in the outbound request queue')
+        self.metric_queue_age = m.gauge(
+            'outbound_queue_oldest_age_seconds',
+            'How long the oldest queued request has been waiting')
+        self.metric_batch_fill = m.histogram(
+            'batch_fill_ratio',
+            'Requests sent per batch as a fraction of request_batch_size',
+            [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
+        self.metric_batch_rtt = m.histogram(
+            'batch_rtt_seconds', 'Batch API round trip time',
+            [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+        self.metric_batch_responses = m.counter(
+            'batch_responses_total', 'Batch API responses by HTTP status',
+            ['status'])
+        self.metric_batch_results = m.counter(
+            'batch_results_total',
+            'Results of batched requests by code, or none if the request '
+            'was not completed', ['code'])
+        self.metric_graph_errors = m.counter(
+            'graph_errors_total',
+            'Errors returned for batched requests by code and subcode',
+            ['code', 'subcode'])
+        self.metric_acks = m.counter('acks_total', 'Acks published')
+        self.metric_nacks = m.counter(
+            'nacks_total', 'Nacks published by status type', ['type'])
+        self.metric_inbound_events = m.counter(
+            'inbound_events_total', 'Inbound events by type', ['type'])
+        self.metric_trace_stages = m.histogram(
+            'stage_seconds',
+            'Time taken for messages to reach each stage of handling from '
+            'the one before', [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1,
+                               2.5, 5, 10, 30],
+            ['direction', 'stage'])
+        self.metric_webhook_latency = m.histogram(
+            'webhook_latency_seconds',
+            'Time taken to handle a webhook request',
+            [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5])
+        m.counter(
+            'inbound_duplicates_total', 'Duplicate inbound events dropped',
+            func=lambda: self.inbound_duplicates)
+        m.counter(
+            'unsupported_events_total', 'Unsupported inbound events by type',
+            ['type'], func=lambda: dict(
+                ((k,), v) for k, v in self.unsupported_event_counts.items()))
+        m.counter(
+            'profile_lookups_total',
+            'User profile lookups by the cache that answered them',
+            ['result'], func=self._profile_lookup_metrics)
+        m.counter(
+            'profile_lookup_timeouts_total',
+            'Inbound messages published without waiting for a slow user '
+            'profile lookup', func=lambda: self.profile_lookup_timeouts)
+        m.counter(
+            'messaging_window_rejections_total',
+            'Outbound messages failed for being outside the messaging window',
+            func=lambda: self.messaging_window_rejections)
+        m.counter(
+            'unreachable_recipient_hits_total',
+            'Outbound messages failed for unreachable recipients',
+            func=lambda: self.unreachable_recipient_hits)
+        m.counter(
+            'invalid_messages_total', 'Outbound messages failed validation',
+            func=lambda: self.invalid_messages)
+        m.counter(
+            'attachments_total', 'Attachments fetched by result', ['result'],
+            func=lambda: dict(
+                ((k,), v) for k, v in self.attachment_stats.items()))
+        self.metric_inbound_buffer_depth = m.gauge(
+            'inbound_buffer_depth', 'Webhook requests waiting in the buffer')
+        self.metric_inbound_buffer_age = m.gauge(
+            'inbound_buffer_oldest_age_seconds',
+            'How long the oldest buffered webhook request has been waiting')
+        m.add_collector(self.collect_queue_metrics)
+
+    def setup_monitoring(self):
+        static_config = self.get_static_config()
+        self.profiler = Profiler(
+            static_config.profile_dir or tempfile.gettempdir(),
+            name=self.transport_name, clock=self.clock)
+
+        self.metric_reactor_lag = self.metrics.histogram(
+            'reactor_lag_seconds',
+            'How late the reactor ran a call scheduled at a fixed interval',
+            [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5])
+        self.metric_reactor_stalls = self.metrics.counter(
+            'reactor_stalls_total',
+            'Times the reactor was at least reactor_stall_threshold late')
+        self.capture = None
+        if static_config.capture_path:
+            self.capture = CaptureWriter(
+                static_config.capture_path, self.clock)
+
+        self.lag_monitor = None
+        if static_config.reactor_lag_interval:
+            self.lag_monitor = ReactorLagMonitor(
+                static_config.reactor_lag_interval,
+                static_config.reactor_stall_threshold,
+                self.metric_reactor_lag.observe, self.reactor_stalled)
+            self.lag_monitor.start()
+
+    def reactor_stalled(self, lag, stack):
+        self.metric_reactor_stalls.inc()
+        self.log.warning('Reactor stalled for %.3f seconds in:\n%s' % (
+            lag, stack))
+
+    def _profile_lookup_metrics(self):
+        stats = self.profile_cache_stats()
+        return {
+            ('memory_hit',): stats['hits'],
+            ('memory_miss',): stats['misses'],
+            ('redis_hit',): stats['redis_hits'],
+            ('redis_miss',): stats['redis_misses'],
+        }
+
+    @inlineCallbacks
+    def collect_queue_metrics(self):
+        stats = yield self.get_request_queue_stats()
+        self.metric_queue_depth.set(stats['depth'])
+        self.metric_queue_age.set(stats['age'])
+        if self.inbound_buffer:
+            stats = yield self.get_inbound_buffer_stats()
+            self.metric_inbound_buffer_depth.set(stats['depth'])
+            self.metric_inbound_buffer_age.set(stats['age'])
+
+    @inlineCallbacks
+    def get_request_queue_stats(self):
+        depth = yield self.redis.llen(self.REQ_QUEUE_KEY)
+        oldest = yield self.redis.lrange(self.REQ_QUEUE_KEY, 0, 0)
+        age = 0
+        if oldest:
+            trace = codec.loads(oldest[0]).get('trace', {})
+            timestamp = trace.get('queued')
+            if timestamp is not None:
+                age = self.clock.seconds() - timestamp
+        returnValue({
+            'depth': depth,
+            'age': age,
+        })
+
+    def stamp_trace(self, trace, stage):
+        if trace is not None:
+            trace[stage] = self.clock.seconds()
+
+    def finish_trace(self, direction, message_id, trace, stages):
+        """
+        Record the time ``message_id`` took to reach each stage of handling
+        stamped in ``trace``, and log the trace if it was slow.
+        """
+        if not trace:
+            return
+        durations = OrderedDict()
+        previous = None
+        for stage in stages:
+            if stage not in trace:
+                continue
+            if previous is not None:
+                durations[stage] = trace[stage] - trace[previous]
+                self.metric_trace_stages.observe(
+                    durations[stage], direction=direction, stage=stage)
+            previous = stage
+        total = trace[previous] - trace[stages[0]]
+        self.metric_trace_stages.observe(
+            total, direction=direction, stage='total')
+
+        if not self.trace_slow_threshold or total < self.trace_slow_threshold:
+            return
+        if random.random() < self.trace_sample_rate:
+            self.log.warning('Slow %s message: %s' % (direction, codec.dumps({
+                'message_id': message_id,
+                'total': total,
+                'stages': durations,
+            })))
 
     def _start_request_loop(self, loop):
         if not loop.running:
@@ -272,9 +898,19 @@ class MessengerTransport(HttpRpcTransport):
         self.log.info('Restarting request_loop...')
         self._start_request_loop(self._request_loop)
 
+    def _start_inbound_worker(self, loop, interval):
+        if not loop.running:
+            loop.start(interval).addErrback(
+                self._inbound_worker_error, loop, interval)
+
+    def _inbound_worker_error(self, failure, loop, interval):
+        self.log.info('Error in inbound worker: %s' % failure.value)
+        self.log.info('Restarting inbound worker...')
+        self._start_inbound_worker(loop, interval)
+
     @inlineCallbacks
     def add_request(self, request):
-        req_string = json.dumps(request, separators=(',', ':'))
+        req_string = codec.dumps(request)
         self.queue_len = yield self.redis.rpush(self.REQ_QUEUE_KEY, req_string)
 
     @inlineCallbacks
@@ -292,24 +928,23 @@ class MessengerTransport(HttpRpcTransport):
         if batch_size == 0:
             return
 
-        data = {
-            'access_token': self.config['access_token'],
-            'include_headers': 'false',
-            'batch': [],
-        }
+        batch = []
         recps = set()
         wait_queue = []
         for i in range(0, batch_size):
             req_string = yield self.redis.lpop(self.REQ_QUEUE_KEY)
-            recp = parse_qs(json.loads(req_string)['body'])['recipient'][0]
+            if req_string is None:
+                # Another worker sharing the queue got to our requests first
+                self.queue_len = 0
+                break
+            request = codec.loads(req_string)
+            recp = parse_qs(request['body'])['recipient'][0]
             if recp not in recps:
                 recps.add(recp)
                 self.queue_len -= 1
-                if req_string is None:
-                    continue
-                request = json.loads(req_string)
+                self.stamp_trace(request.get('trace'), 'dequeued')
                 self.pending_requests.append(request)
-                data['batch'].append({
+                batch.append({
                     'method': request['method'],
                     'relative_url': request['relative_url'],
                     'body': request.get('body', ''),
@@ -319,40 +954,111 @@ class MessengerTransport(HttpRpcTransport):
 
         for req_string in reversed(wait_queue):
             yield self.redis.lpush(self.REQ_QUEUE_KEY, req_string)
+        if not batch:
+            return
 
-        data['batch'] = json.dumps(data['batch'], separators=(',', ':'))
-        response = yield self.request('POST', self.BATCH_API_URL, data,
-                                      pool=self.pool)
+        self.metric_batch_fill.observe(len(batch) / float(self.batch_size))
+        for request in self.pending_requests:
+            self.stamp_trace(request.get('trace'), 'sent')
+        start = self.clock.seconds()
+        response = yield self.send_batch(batch)
+        self.metric_batch_rtt.observe(self.clock.seconds() - start)
+        for request in self.pending_requests:
+            self.stamp_trace(request.get('trace'), 'responded')
+        self.metric_batch_responses.inc(status=response.code)
         if response.code == http.OK:
-            yield self.handle_batch_response(response)
+            yield self.handle_batch_response(response, sent_at=start)
         else:
             yield self.handle_batch_error(response)
 
+    def send_batch(self, batch):
+        data = {
+            'access_token': self.config['access_token'],
+            'include_headers': 'false',
+            'batch': codec.dumps(batch),
+        }
+        return self.request('POST', self.BATCH_API_URL, data, pool=self.pool)
+
     @inlineCallbacks
-    def handle_batch_response(self, response):
-        content = yield response.json()
+    def read_json(self, response):
+        body = yield response.content()
+        returnValue(codec.loads(body))
+
+    @inlineCallbacks
+    def handle_batch_response(self, response, sent_at=None):
+        content = yield self.read_json(response)
         for i, res in enumerate(content):
             req = self.pending_requests[i]
+            self.metric_batch_results.inc(
+                code=res.get('code') if res is not None else 'none')
             if res is None:
                 # Request was not completed, add to queue again
+                self.stamp_trace(req.get('trace'), 'queued')
                 yield self.add_request(req)
             elif res.get('code') == http.OK:
-                body = json.loads(res['body'])
+                body = codec.loads(res['body'])
                 if body.get('message_id') is None:
                     # TODO: acknowledge success of non-message requests
                     continue
                 yield self.handle_outbound_success(
-                    req['message_id'], body['message_id'])
+                    req['message_id'], body['message_id'],
+                    req.get('recipient'), sent_at)
+                self.finish_request_trace(req, 'acked')
             else:
-                body = json.loads(res['body'])
-                self.log.error('Message rejected: %s' % (json.dumps(body),))
+                body = codec.loads(res['body'])
+                self.log.error('Message rejected: %s' % (codec.dumps(body),))
+                self.metric_graph_errors.inc(
+                    code=body['error'].get('code'),
+                    subcode=body['error'].get('error_subcode', ''))
                 fail_type = self.SEND_FAIL_TYPES.get(
                     body['error']['code'], 'request_fail_unknown')
+                if self.is_unreachable_error(body['error']):
+                    yield self.add_unreachable_recipient(
+                        req.get('recipient'), body['error']['message'],
+                        fail_type)
                 yield self.handle_outbound_failure(
                     req['message_id'], body['error']['message'], fail_type)
+                self.finish_request_trace(req, 'nacked')
 
         self.pending_requests = []
 
+    def finish_request_trace(self, request, stage):
+        trace = request.get('trace')
+        self.stamp_trace(trace, stage)
+        self.finish_trace(
+            'outbound', request['message_id'], trace,
+            self.OUTBOUND_TRACE_STAGES)
+
+    def is_unreachable_error(self, error):
+        return (error.get('code'), error.get('error_subcode')) in (
+            self.UNREACHABLE_ERRORS)
+
+    def unreachable_recipient_key(self, recipient):
+        return 'unreachable:%s:%s' % (self.transport_name, recipient)
+
+    @inlineCallbacks
+    def add_unreachable_recipient(self, recipient, reason, fail_type):
+        if recipient is None or not self.unreachable_recipient_ttl:
+            return
+        yield self.redis.setex(
+            self.unreachable_recipient_key(recipient),
+            self.unreachable_recipient_ttl,
+            codec.dumps({'reason': reason, 'fail_type': fail_type}))
+
+    @inlineCallbacks
+    def get_unreachable_recipient(self, recipient):
+        """
+        Return the reason and failure type of the last failed message to
+        ``recipient`` if they were unreachable, or ``None``.
+        """
+        if not self.unreachable_recipient_ttl:
+            returnValue(None)
+        value = yield self.redis.get(
+            self.unreachable_recipient_key(recipient))
+        if value is None:
+            returnValue(None)
+        returnValue(codec.loads(value))
+
     @inlineCallbacks
     def handle_batch_error(self, response):
         # It's possible that some requests might still have been completed
@@ -366,9 +1072,20 @@ class MessengerTransport(HttpRpcTransport):
             yield self.handle_outbound_failure(
                 req['message_id'], 'Batch request failed (%s)' % code,
                 'batch_request_fail')
+            self.finish_request_trace(req, 'nacked')
 
     @inlineCallbacks
-    def handle_outbound_success(self, user_message_id, sent_message_id):
+    def handle_outbound_success(self, user_message_id, sent_message_id,
+                                recipient=None, sent_at=None):
+        if recipient is not None and self.sent_message_retention:
+            # Don't hold up the batch waiting for Redis, a receipt handled
+            # later is still only looked up after these writes.
+            d = self.add_sent_message(
+                recipient, user_message_id, sent_message_id, sent_at)
+            d.addErrback(lambda f: self.log.error(
+                'Failed to record sent message %s: %s' % (
+                    sent_message_id, f.getErrorMessage())))
+        self.metric_acks.inc()
         yield self.publish_ack(
             user_message_id=user_message_id,
             sent_message_id=sent_message_id)
@@ -378,8 +1095,94 @@ class MessengerTransport(HttpRpcTransport):
             type='request_success',
             message='Request successful')
 
+    def sent_messages_key(self, recipient):
+        return 'sent:%s:%s' % (self.transport_name, recipient)
+
+    def add_sent_message(self, recipient, user_message_id, sent_message_id,
+                         sent_at=None):
+        """
+        Remember when a message was sent to ``recipient``, so that it can be
+        matched to the watermark of a later delivery or read receipt.
+
+        ``sent_at`` should be the time the message was sent, rather than when
+        Facebook's response arrived, as Facebook's watermarks are from when
+        it accepted the message.
+        """
+        if sent_at is None:
+            sent_at = self.clock.seconds()
+        key = self.sent_messages_key(recipient)
+        # Messages to an active recipient keep the key alive, so drop those
+        # sent longer ago than the retention period as well. vumi's Redis
+        # manager has no ZREMRANGEBYSCORE, so count them and remove them by
+        # rank, which only takes a second round trip when there are some.
+        cutoff = int(
+            (self.clock.seconds() - self.sent_message_retention) * 1000)
+        d = gatherResults([
+            self.redis.zadd(key, **{
+                '%s:%s' % (user_message_id, sent_message_id):
+                    int(sent_at * 1000),
+            }),
+            self.redis.expire(key, self.sent_message_retention),
+            self.redis.zcount(key, '-inf', cutoff),
+        ], consumeErrors=True)
+
+        def trim(results):
+            expired = results[-1]
+            if expired:
+                return self.redis.zremrangebyrank(key, 0, expired - 1)
+
+        return d.addCallback(trim)
+
+    @inlineCallbacks
+    def handle_receipt(self, page):
+        """
+        Publish delivery reports for all the messages sent to the user
+        before the watermark of a delivery or read receipt, and for those
+        listed in a delivery receipt's ``mids``. Each message is only
+        reported once.
+        """
+        if not self.sent_message_retention:
+            return
+
+        receipt = page.extra[page.event_type]
+        key = self.sent_messages_key(page.from_addr)
+        mids = set(receipt.get('mids') or [])
+        if mids:
+            sent = []
+            members = yield self.redis.zrange(key, 0, -1, withscores=True)
+            for member, score in members:
+                if score <= receipt['watermark']:
+                    sent.append(member)
+                elif member.partition(':')[2] in mids:
+                    sent.append(member)
+        else:
+            sent = yield self.redis.zrangebyscore(
+                key, '-inf', receipt['watermark'])
+        if not sent:
+            return
+
+        for member in sent:
+            user_message_id, _, sent_message_id = member.partition(':')
+            yield self.publish_delivery_report(
+                user_message_id=user_message_id,
+                delivery_status='delivered',
+                transport_metadata={
+                    'messenger': {
+                        'mid': sent_message_id,
+                        'receipt': page.event_type,
+                        'watermark': receipt['watermark'],
+                    },
+                })
+        # Removing by rank could take a message sent just before the
+        # watermark that was acked since we looked, so remove each one, but
+        # all at once.
+        yield gatherResults(
+            [self.redis.zrem(key, member) for member in sent],
+            consumeErrors=True)
+
     @inlineCallbacks
     def handle_outbound_failure(self, message_id, reason, status_type):
+        self.metric_nacks.inc(type=status_type)
         yield self.publish_nack(
             user_message_id=message_id,
             sent_message_id=message_id,
@@ -394,32 +1197,56 @@ class MessengerTransport(HttpRpcTransport):
     def setup_welcome_message(self, welcome_message_payload, page_id):
         response = yield self.request(
             'POST',
-            "https://graph.facebook.com/v2.6/%s/thread_settings?%s" % (
-                page_id,
+            "%s/v2.6/%s/thread_settings?%s" % (
+                self.BATCH_API_URL, page_id,
                 urlencode({
                     'access_token': self.config['access_token'],
                 })),
-            data=json.dumps({
+            data=codec.dumps({
                 'setting_type': 'call_to_actions',
                 'thread_state': 'new_thread',
                 'call_to_actions': welcome_message_payload
-            }, separators=(',', ':')),
+            }),
             headers={
                 'Content-Type': ['application/json']
             })
 
-        data = yield response.json()
+        data = yield self.read_json(response)
         if response.code == http.OK:
             returnValue(data)
 
         raise MessengerTransportException(data)
 
+    def log_path(self, path, describe):
+        """
+        Log a message on one of the message paths, subject to the path's
+        log level and the sample rate. ``describe`` is only called if the
+        message is logged, and returns a dict of fields to log.
+        """
+        level = self.log_levels.get(path, 'info')
+        if level == 'off':
+            return
+        count = self._log_counts[path]
+        self._log_counts[path] += 1
+        if count % self.log_sample_rate:
+            return
+        fields = describe()
+        getattr(self.log, level)('MessengerTransport %s %s' % (
+            path, ' '.join(
+                '%s=%s' % (k, codec.dumps(fields[k]))
+                for k in sorted(fields))))
+
+    def redact(self, content):
+        if self.log_redact_content and content is not None:
+            return '<redacted %d chars>' % (len(content),)
+        return content
+
     def respond(self, message_id, code, body=None):
         if body is None:
             body = {}
 
         self.finish_request(message_id,
-                            json.dumps(body, separators=(',', ':')),
+                            codec.dumps(body),
                             code=code)
 
     def request(self, method, url, data, **kwargs):
@@ -433,8 +1260,18 @@ class MessengerTransport(HttpRpcTransport):
                                 code=http.OK)
             return
 
+        start = self.clock.seconds()
+        if self.capture is not None:
+            self.capture.inbound(request.content.read())
+            request.content.seek(0)
+        if self.inbound_buffer:
+            yield self.buffer_inbound(message_id, request.content.read())
+            self.respond(message_id, http.OK, {})
+            self.metric_webhook_latency.observe(self.clock.seconds() - start)
+            return
+
         try:
-            pages, errors = Page.from_fp(request.content)
+            pages, errors = yield self.parse_inbound(request.content)
         except (UnsupportedMessage,), e:
             self.respond(message_id, http.OK, {
                 'warning': 'Accepted unsuppported message: %s' % (e,)
@@ -442,36 +1279,199 @@ class MessengerTransport(HttpRpcTransport):
             self.log.error(e)
             return
 
-        if pages:
-            self.log.info("MessengerTransport inbound %r" % (pages,))
-        for error in errors:
-            self.log.error(error)
+        self.start_page_traces(pages, {'received': start})
+        yield self.publish_pages(message_id, pages, errors)
 
-        for page in pages:
-            if self.config.get('retrieve_profile'):
-                helper_metadata = yield self.get_user_profile(page.from_addr)
-            else:
-                helper_metadata = {}
-            transport_metadata = dict(page.extra, mid=page.mid)
-            helper_metadata.update(transport_metadata)
+        self.respond(message_id, http.OK, {})
+        self.metric_webhook_latency.observe(self.clock.seconds() - start)
 
-            yield self.publish_message(
-                message_id=message_id,
-                from_addr=page.from_addr,
-                from_addr_type='facebook_messenger',
-                to_addr=page.to_addr,
-                in_reply_to=page.in_reply_to,
-                content=page.content,
-                provider='facebook',
-                transport_type=self.transport_type,
-                transport_metadata={
-                    'messenger': transport_metadata
-                },
-                helper_metadata={
-                    'messenger': helper_metadata
-                })
+        yield self.add_status(
+            component='inbound',
+            status='ok',
+            type='request_success',
+            message='Request successful')
 
-        self.respond(message_id, http.OK, {})
+    @inlineCallbacks
+    def parse_inbound(self, fp):
+        data = Page.load(fp)
+        yield self.restore_payloads(data)
+        returnValue(Page.from_data(data, self.handle_unsupported_event))
+
+    def payload_key(self, token):
+        return 'payload:%s' % (token[len(PAYLOAD_TOKEN_PREFIX):],)
+
+    def store_payloads(self, msg):
+        """
+        Replace postback and quick reply payloads longer than
+        ``payload_store_threshold`` with short tokens. Returns a copy of
+        ``msg`` and a dict of the replaced payloads by token.
+        """
+        stored = {}
+
+        def swap(value, key=None):
+            if isinstance(value, list):
+                return [swap(v, key) for v in value]
+            if not isinstance(value, dict):
+                return value
+            swapped = dict((k, swap(v, k)) for k, v in value.iteritems())
+            # Other buttons, such as phone_number ones, also have a payload,
+            # but Facebook never sends it back to us.
+            if value.get('type') != 'postback' and key != 'quick_replies':
+                return swapped
+            payload = value.get('payload')
+            if not isinstance(payload, basestring):
+                return swapped
+            if len(payload) > self.payload_store_threshold:
+                raw = (payload.encode('utf-8') if isinstance(payload, unicode)
+                       else payload)
+                token = PAYLOAD_TOKEN_PREFIX + hashlib.sha1(raw).hexdigest()
+                stored[token] = payload
+                swapped['payload'] = token
+            return swapped
+
+        return swap(msg), stored
+
+    @inlineCallbacks
+    def restore_payloads(self, data):
+        """
+        Replace payload tokens in a webhook request with the payloads they
+        were swapped for.
+        """
+        for entry in data.get('entry', []):
+            for msg in entry.get('messaging', []):
+                for parent in (msg.get('postback'),
+                               msg.get('message', {}).get('quick_reply')):
+                    if parent is None:
+                        continue
+                    token = parent.get('payload')
+                    if not isinstance(token, basestring):
+                        continue
+                    if not token.startswith(PAYLOAD_TOKEN_PREFIX):
+                        continue
+                    payload = yield self.redis.get(self.payload_key(token))
+                    if payload is None:
+                        self.log.warning(
+                            'Payload for %s has expired' % (token,))
+                        payload = '{}'
+                    parent['payload'] = payload
+
+    def handle_unsupported_event(self, event_type, event):
+        """
+        Apply the configured policy to an unsupported inbound event without
+        formatting it. Returns ``True`` if the event should be published.
+        """
+        policy = self.unsupported_events.get(
+            event_type, self.unsupported_events.get('default', 'count'))
+        if policy == 'drop':
+            return False
+        self.unsupported_event_counts[event_type] += 1
+        return policy == 'forward'
+
+    def buffer_inbound(self, message_id, body):
+        record = codec.dumps({
+            'message_id': message_id,
+            'body': body,
+            'timestamp': self.clock.seconds(),
+        })
+        return self.redis.lpush(self.INBOUND_BUFFER_KEY, record)
+
+    def inbound_processing_key(self, worker_id):
+        return '%s:processing:%s' % (self.INBOUND_BUFFER_KEY, worker_id)
+
+    def inbound_lease_key(self, worker_id):
+        return '%s:lease:%s' % (self.INBOUND_BUFFER_KEY, worker_id)
+
+    @inlineCallbacks
+    def renew_inbound_lease(self):
+        """
+        Renew this transport's claim on the requests it is processing, and
+        return those claimed by transports that have stopped renewing theirs
+        to the inbound buffer.
+        """
+        yield self.redis.sadd(
+            self.INBOUND_WORKERS_KEY, self.inbound_worker_id)
+        yield self.redis.setex(
+            self.inbound_lease_key(self.inbound_worker_id),
+            self.inbound_buffer_lease_ttl, int(self.clock.seconds()))
+        yield self.recover_inbound_buffer()
+
+    @inlineCallbacks
+    def recover_inbound_buffer(self):
+        """
+        Return requests that were being processed by transports whose lease
+        has run out to the inbound buffer.
+        """
+        workers = yield self.redis.smembers(self.INBOUND_WORKERS_KEY)
+        for worker_id in sorted(workers):
+            if worker_id == self.inbound_worker_id:
+                continue
+            alive = yield self.redis.exists(self.inbound_lease_key(worker_id))
+            if alive:
+                continue
+            while True:
+                record = yield self.redis.rpoplpush(
+                    self.inbound_processing_key(worker_id),
+                    self.INBOUND_BUFFER_KEY)
+                if record is None:
+                    break
+            yield self.redis.srem(self.INBOUND_WORKERS_KEY, worker_id)
+
+    @inlineCallbacks
+    def drain_inbound_buffer(self):
+        while True:
+            record = yield self.redis.rpoplpush(
+                self.INBOUND_BUFFER_KEY, self.INBOUND_PROCESSING_KEY)
+            if record is None:
+                return
+            try:
+                yield self.process_buffered_inbound(record)
+            except Exception, e:
+                self.log.error(
+                    'Failed to process buffered inbound request: %s' % (e,))
+                yield self.retry_buffered_inbound(record)
+                yield self.redis.lrem(self.INBOUND_PROCESSING_KEY, record, 1)
+                # Leave the rest of the buffer until the next check, rather
+                # than failing on every request while something is down.
+                return
+            yield self.redis.lrem(self.INBOUND_PROCESSING_KEY, record, 1)
+
+    @inlineCallbacks
+    def retry_buffered_inbound(self, record):
+        """
+        Return a buffered request that failed to the back of the buffer, or
+        move it to the failed list once it has been tried
+        ``inbound_buffer_max_attempts`` times.
+        """
+        try:
+            data = codec.loads(record)
+        except ValueError:
+            yield self.redis.lpush(self.INBOUND_FAILED_KEY, record)
+            return
+        data['attempts'] = data.get('attempts', 0) + 1
+        if data['attempts'] < self.inbound_buffer_max_attempts:
+            yield self.redis.lpush(self.INBOUND_BUFFER_KEY, codec.dumps(data))
+        else:
+            self.log.error(
+                'Giving up on buffered inbound request %s after %d '
+                'attempts' % (data.get('message_id'), data['attempts']))
+            yield self.redis.lpush(self.INBOUND_FAILED_KEY, codec.dumps(data))
+
+    @inlineCallbacks
+    def process_buffered_inbound(self, record):
+        record = codec.loads(record)
+        trace = {
+            'received': record['timestamp'],
+            'dequeued': self.clock.seconds(),
+        }
+        try:
+            pages, errors = yield self.parse_inbound(
+                StringIO(record['body'].encode('utf-8')))
+        except (UnsupportedMessage,), e:
+            self.log.error(e)
+            return
+
+        self.start_page_traces(pages, trace)
+        yield self.publish_pages(record['message_id'], pages, errors)
 
         yield self.add_status(
             component='inbound',
@@ -479,28 +1479,594 @@ class MessengerTransport(HttpRpcTransport):
             type='request_success',
             message='Request successful')
 
+    def start_page_traces(self, pages, trace):
+        trace['parsed'] = self.clock.seconds()
+        for page in pages:
+            page.trace = dict(trace)
+
+    @inlineCallbacks
+    def get_inbound_buffer_stats(self):
+        depth = yield self.redis.llen(self.INBOUND_BUFFER_KEY)
+        oldest = yield self.redis.lrange(self.INBOUND_BUFFER_KEY, -1, -1)
+        if oldest:
+            age = self.clock.seconds() - codec.loads(oldest[0])['timestamp']
+        else:
+            age = 0
+        returnValue({
+            'depth': depth,
+            'age': age,
+        })
+
+    @inlineCallbacks
+    def is_duplicate(self, page):
+        """
+        Check whether the event ``page`` was parsed from has been seen
+        before, and remember it for ``dedupe_ttl`` seconds.
+        """
+        if not self.dedupe_ttl:
+            returnValue(False)
+
+        key = self.dedupe_redis_key(page)
+        if self.dedupe_filter is not None and key not in self.dedupe_filter:
+            # Definitely new, record it without waiting for Redis
+            self.dedupe_filter.add(key)
+            d = self.mark_seen(key)
+            d.addErrback(lambda f: self.log.error(
+                'Failed to record inbound event %s: %s' % (
+                    key, f.getErrorMessage())))
+            returnValue(False)
+
+        new = yield self.mark_seen(key)
+        if self.dedupe_filter is not None:
+            self.dedupe_filter.add(key)
+        if not new:
+            self.inbound_duplicates += 1
+        returnValue(not new)
+
+    def dedupe_redis_key(self, page):
+        return 'dedupe:%s:%s' % (self.transport_name, page.dedupe_key)
+
+    @inlineCallbacks
+    def mark_seen(self, key):
+        # vumi's Redis manager can't send SET NX EX, so the expiry is set
+        # separately. If that was lost the key would never expire, so set it
+        # again whenever we find a key without one.
+        new = yield self.redis.setnx(key, 1)
+        if new or (yield self.redis.ttl(key)) is None:
+            yield self.redis.expire(key, self.dedupe_ttl)
+        returnValue(new)
+
+    @inlineCallbacks
+    def forget_seen(self, pages):
+        """
+        Forget the events ``pages`` were parsed from, so that they aren't
+        dropped as duplicates when Facebook delivers them again.
+        """
+        if not self.dedupe_ttl:
+            return
+        for page in pages:
+            key = self.dedupe_redis_key(page)
+            try:
+                yield self.redis.delete(key)
+            except Exception, e:
+                self.log.error(
+                    'Failed to forget inbound event %s: %s' % (key, e))
+
+    def messaging_window_key(self, user_id):
+        return 'lastseen:%s:%s' % (self.transport_name, user_id)
+
+    @inlineCallbacks
+    def open_messaging_windows(self, pages):
+        """
+        Record that the senders of ``pages`` may be messaged for the next
+        ``messaging_window`` seconds.
+        """
+        users = set(page.from_addr for page in pages
+                    if page.event_type in self.MESSAGING_WINDOW_EVENTS)
+        for user_id in users:
+            yield self.redis.setex(
+                self.messaging_window_key(user_id), self.messaging_window,
+                int(self.clock.seconds()))
+
+    def messaging_window_started_key(self):
+        return 'lastseen_started:%s' % (self.transport_name,)
+
+    @inlineCallbacks
+    def in_messaging_window(self, user_id):
+        last_seen = yield self.redis.get(self.messaging_window_key(user_id))
+        if last_seen is not None:
+            returnValue(True)
+        if not self.messaging_window_warm:
+            # Until we've been recording inbound messages for a whole window
+            # a missing key doesn't mean the user hasn't messaged the page,
+            # so let the message through and leave it to Facebook.
+            started = yield self.redis.get(
+                self.messaging_window_started_key())
+            elapsed = self.clock.seconds() - int(started or 0)
+            if started is not None and elapsed < self.messaging_window:
+                returnValue(True)
+            self.messaging_window_warm = True
+        returnValue(False)
+
+    @inlineCallbacks
+    def publish_pages(self, message_id, pages, errors):
+        unique_pages = []
+        for page in pages:
+            duplicate = yield self.is_duplicate(page)
+            if not duplicate:
+                unique_pages.append(page)
+        handled = []
+        try:
+            yield self.publish_unique_pages(
+                message_id, unique_pages, errors, handled)
+        except Exception:
+            failure = Failure()
+            yield self.forget_seen(
+                [page for page in unique_pages if page not in handled])
+            failure.raiseException()
+
+    @inlineCallbacks
+    def publish_unique_pages(self, message_id, pages, errors, handled=None):
+        """
+        Publish ``pages``, adding each one to ``handled`` once it has been
+        published or held back for debouncing.
+        """
+        if handled is None:
+            handled = []
+        for page in pages:
+            self.metric_inbound_events.inc(type=page.event_type)
+
+        receipts = [page for page in pages
+                    if page.event_type in ('delivery', 'read')]
+        pages = [page for page in pages if page not in receipts]
+        for page in receipts:
+            yield self.handle_receipt(page)
+            handled.append(page)
+        if self.messaging_window:
+            yield self.open_messaging_windows(pages)
+
+        for page in pages:
+            self.log_path('inbound', lambda: {
+                'mid': page.mid,
+                'type': page.event_type,
+                'from_addr': page.from_addr,
+                'to_addr': page.to_addr,
+                'content': self.redact(page.content),
+            })
+        for error in errors:
+            self.log.error(error)
+
+        if self.debounce_window > 0:
+            pages = yield self.debounce_pages(message_id, pages, handled)
+        yield self.publish_with_profiles(message_id, pages, handled)
+
+    @inlineCallbacks
+    def publish_with_profiles(self, message_id, pages, handled=None):
+        # Start all the profile lookups up front so that they can be
+        # coalesced and batched, rather than waiting for each in turn.
+        if self.config.get('retrieve_profile'):
+            profiles = [
+                self.get_user_profile_within_budget(
+                    page.from_addr, page.to_addr)
+                for page in pages]
+        else:
+            profiles = [succeed({}) for page in pages]
+
+        for page, profile_d in zip(pages, profiles):
+            helper_metadata = yield profile_d
+            if helper_metadata is None:
+                helper_metadata = {'profile_pending': True}
+            yield self.publish_page(message_id, page, helper_metadata)
+            if handled is not None:
+                handled.append(page)
+
+    def is_debounceable(self, page):
+        return all([
+            page.event_type == 'message',
+            not page.extra,
+            page.in_reply_to is None,
+        ])
+
+    @inlineCallbacks
+    def debounce_pages(self, message_id, pages, handled=None):
+        """
+        Hold back plain text pages for ``inbound_debounce_window`` seconds
+        so that consecutive ones from the same sender can be published as a
+        single message. Returns the pages that should be published now, the
+        ones held back are added to ``handled``.
+        """
+        if handled is None:
+            handled = []
+        publish = []
+        for page in pages:
+            key = (page.to_addr, page.from_addr)
+            if not self.is_debounceable(page):
+                yield self.flush_debounced(key)
+                publish.append(page)
+                continue
+
+            pending = self._debounced.pop(key, None)
+            if pending is None:
+                pending = {'message_id': message_id, 'pages': []}
+            else:
+                pending['call'].cancel()
+            pending['pages'].append(page)
+            self._debounced[key] = pending
+            handled.append(page)
+
+            if len(pending['pages']) >= self.debounce_max_messages:
+                yield self.flush_debounced(key)
+            else:
+                pending['call'] = self.clock.callLater(
+                    self.debounce_window, self._flush_debounced_later, key)
+
+            while len(self._debounced) > self.debounce_max_senders:
+                oldest = next(iter(self._debounced))
+                yield self.flush_debounced(oldest)
+        returnValue(publish)
+
+    def _flush_debounced_later(self, key):
+        d = self.flush_debounced(key)
+        d.addErrback(lambda f: self.log.error(
+            'Failed to publish debounced messages: %s' % (
+                f.getErrorMessage(),)))
+
+    def flush_debounced(self, key):
+        pending = self._debounced.pop(key, None)
+        if pending is None:
+            return succeed(None)
+        call = pending.get('call')
+        if call is not None and call.active():
+            call.cancel()
+
+        pages = pending['pages']
+        page = pages[0]
+        if len(pages) > 1:
+            page = Page(
+                to_addr=page.to_addr,
+                from_addr=page.from_addr,
+                mid=page.mid,
+                content='\n'.join(p.content for p in pages),
+                timestamp=pages[-1].timestamp,
+                extra={'mids': [p.mid for p in pages]})
+            page.trace = pages[0].trace
+
+        def forget(failure):
+            # These were marked as seen when they were received, forget them
+            # so that they aren't dropped if Facebook delivers them again.
+            d = self.forget_seen(pages)
+            d.addCallback(lambda _: failure)
+            return d
+
+        d = self.publish_with_profiles(pending['message_id'], [page])
+        return d.addErrback(forget)
+
     @inlineCallbacks
-    def get_user_profile(self, user_id):
+    def flush_all_debounced(self):
+        while self._debounced:
+            yield self.flush_debounced(next(iter(self._debounced)))
+
+    @inlineCallbacks
+    def publish_page(self, message_id, page, helper_metadata):
+        if self.attachment_store is not None and 'attachments' in page.extra:
+            self.cache_attachments(page)
+        transport_metadata = dict(page.extra, mid=page.mid)
+        helper_metadata.update(transport_metadata)
+
+        msg = yield self.publish_message(
+            message_id=message_id,
+            from_addr=page.from_addr,
+            from_addr_type='facebook_messenger',
+            to_addr=page.to_addr,
+            in_reply_to=page.in_reply_to,
+            content=page.content,
+            provider='facebook',
+            transport_type=self.transport_type,
+            transport_metadata={
+                'messenger': transport_metadata
+            },
+            helper_metadata={
+                'messenger': helper_metadata
+            })
+        self.stamp_trace(page.trace, 'published')
+        self.finish_trace(
+            'inbound', message_id, page.trace, self.INBOUND_TRACE_STAGES)
+        returnValue(msg)
+
+    def get_user_profile_within_budget(self, user_id, page_id=None):
+        """
+        Look up a user profile, giving up after ``profile_lookup_timeout``
+        seconds. Fires with ``None`` if the budget was exceeded, in which
+        case the lookup carries on in the background to warm the cache.
+        """
+        d = self.get_user_profile(user_id, page_id)
+        if self.profile_lookup_timeout <= 0:
+            return d
+
+        result = Deferred()
+        timeout = self.clock.callLater(
+            self.profile_lookup_timeout, self._profile_lookup_timed_out,
+            result, user_id)
+
+        def finished(profile):
+            if timeout.active():
+                timeout.cancel()
+                result.callback(profile)
+            elif isinstance(profile, Failure):
+                self.log.error(
+                    'Background profile lookup failed for %s: %s' % (
+                        user_id, profile.getErrorMessage()))
+
+        d.addBoth(finished)
+        return result
+
+    def _profile_lookup_timed_out(self, d, user_id):
+        self.profile_lookup_timeouts += 1
+        self.log.warning(
+            'Profile lookup for %s exceeded %ss, publishing without it' % (
+                user_id, self.profile_lookup_timeout))
+        d.callback(None)
+
+    def profile_cache_key(self, user_id, page_id=None):
+        if page_id is None:
+            page_id = self.config.get('page_id')
+        return 'profile:%s:%s' % (page_id, user_id)
+
+    def profile_cache_stats(self):
+        stats = self.profile_cache.stats()
+        stats.update({
+            'redis_hits': self.profile_redis_hits,
+            'redis_misses': self.profile_redis_misses,
+        })
+        return stats
+
+    def get_user_profile(self, user_id, page_id=None):
+        """
+        Look up a user profile in the in-process cache, then in Redis and
+        only then on the Graph API. Lookups that the Graph API answered
+        with an error are cached as an empty profile for
+        ``profile_cache_error_ttl`` seconds, those that got no answer aren't
+        cached at all. Concurrent lookups for the same user share a single
+        request.
+        """
+        key = self.profile_cache_key(user_id, page_id)
+        if self.profile_cache_ttl:
+            profile = self.profile_cache.get(key)
+            if profile is not None:
+                return succeed(dict(profile))
+
+        d = Deferred()
+        d.addCallback(dict)
+        if key in self._profile_lookups:
+            self._profile_lookups[key].append(d)
+        else:
+            self._profile_lookups[key] = [d]
+            lookup_d = self._lookup_user_profile(key, user_id)
+            lookup_d.addBoth(self._finish_profile_lookup, key)
+        return d
+
+    def _finish_profile_lookup(self, result, key):
+        for d in self._profile_lookups.pop(key, []):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    @inlineCallbacks
+    def _lookup_user_profile(self, key, user_id):
+        if self.profile_cache_ttl:
+            cached = yield self.redis.get(key)
+            if cached is not None:
+                self.profile_redis_hits += 1
+                profile = codec.loads(cached)
+                ttl = (self.profile_cache_ttl if profile
+                       else self.profile_cache_error_ttl)
+                # Don't keep the profile in process for longer than Redis
+                # still would.
+                remaining = yield self.redis.ttl(key)
+                if remaining is not None and remaining >= 0:
+                    ttl = min(ttl, remaining)
+                self.profile_cache.set(key, profile, ttl)
+                returnValue(profile)
+            self.profile_redis_misses += 1
+
+        if self.profile_batch_time > 0:
+            profile, success = yield self.queue_user_profile(user_id)
+        else:
+            profile, success = yield self.fetch_user_profile(user_id)
+        if self.profile_cache_ttl:
+            yield self.cache_user_profile(key, profile, success)
+        returnValue(profile)
+
+    @inlineCallbacks
+    def cache_user_profile(self, key, profile, success):
+        """
+        Cache a looked up ``profile``. ``success`` is ``None`` if the lookup
+        got no answer, in which case nothing is cached.
+        """
+        if success is None:
+            return
+        ttl = (self.profile_cache_ttl if success
+               else self.profile_cache_error_ttl)
+        if ttl <= 0:
+            return
+        self.profile_cache.set(key, profile, ttl)
+        yield self.redis.setex(
+            key, ttl, codec.dumps(profile))
+
+    @inlineCallbacks
+    def fetch_user_profile(self, user_id):
         response = yield self.request(
             method='GET',
-            url='https://graph.facebook.com/v2.6/%s?%s' % (
-                user_id, urlencode({
+            url='%s/v2.6/%s?%s' % (
+                self.BATCH_API_URL, user_id, urlencode({
                     'fields': 'first_name,last_name,profile_pic',
                     'access_token': self.config['access_token'],
                 })
             ),
             data='')
-        data = yield response.json()
+        data = yield self.read_json(response)
         if response.code == http.OK:
-            returnValue(data)
+            returnValue((data, True))
         else:
             self.log.error('Unable to retrieve user profile: %s' % (data,))
-            returnValue({})
+            returnValue(({}, False))
+
+    def queue_user_profile(self, user_id):
+        """
+        Queue a user profile lookup to be sent with the next profile batch.
+        """
+        d = Deferred()
+        self._profile_batch.append((user_id, d))
+        if len(self._profile_batch) >= self.batch_size:
+            self.dispatch_profile_batch()
+        elif self._profile_batch_call is None:
+            self._profile_batch_call = self.clock.callLater(
+                self.profile_batch_time, self.dispatch_profile_batch)
+        return d
+
+    def dispatch_profile_batch(self):
+        call, self._profile_batch_call = self._profile_batch_call, None
+        if call is not None and call.active():
+            call.cancel()
+
+        lookups = self._profile_batch[:self.batch_size]
+        self._profile_batch = self._profile_batch[self.batch_size:]
+        if self._profile_batch:
+            self._profile_batch_call = self.clock.callLater(
+                self.profile_batch_time, self.dispatch_profile_batch)
+        if not lookups:
+            return
+
+        d = self._dispatch_profile_batch(lookups)
+        d.addErrback(self._profile_batch_error, lookups)
+        return d
+
+    @inlineCallbacks
+    def _dispatch_profile_batch(self, lookups):
+        response = yield self.send_batch([{
+            'method': 'GET',
+            'relative_url': 'v2.6/%s?%s' % (user_id, urlencode({
+                'fields': 'first_name,last_name,profile_pic',
+            })),
+        } for user_id, _ in lookups])
+
+        if response.code != http.OK:
+            self.log.error(
+                'Profile batch request failed (%s)' % (response.code,))
+            for _, d in lookups:
+                d.callback(({}, None))
+            return
+
+        content = yield self.read_json(response)
+        content += [None] * (len(lookups) - len(content))
+        for (user_id, d), res in zip(lookups, content):
+            if res is None:
+                # Facebook gave up on this request in the batch
+                self.log.error(
+                    'No response to profile lookup for %s' % (user_id,))
+                d.callback(({}, None))
+            elif res.get('code') == http.OK:
+                d.callback((codec.loads(res['body']), True))
+            else:
+                self.log.error(
+                    'Unable to retrieve user profile: %s' % (res,))
+                d.callback(({}, False))
+
+    def _profile_batch_error(self, failure, lookups):
+        for _, d in lookups:
+            if not d.called:
+                d.errback(failure)
+
+    def cache_attachments(self, page):
+        """
+        Point the attachments of ``page`` at the local attachment store and
+        fetch them into it in the background.
+        """
+        attachments = []
+        for i, attachment in enumerate(page.extra['attachments']):
+            payload = attachment.get('payload') or {}
+            url = payload.get('url')
+            if url is None or page.mid is None:
+                attachments.append(attachment)
+                continue
+            key = hashlib.sha1('%s:%s' % (page.mid, i)).hexdigest()
+            attachments.append(dict(attachment, payload=dict(
+                payload,
+                url='%s/%s' % (self.attachment_url.rstrip('/'), key),
+                source_url=url)))
+            d = self.attachment_fetches.run(self.fetch_attachment, key, url)
+            d.addErrback(self._attachment_fetch_failed, url)
+        page.extra['attachments'] = attachments
+
+    def cancel_after(self, d, deadline):
+        """
+        Cancel ``d`` if it hasn't fired by ``deadline``, or leave it be if
+        ``deadline`` is ``None``.
+        """
+        if deadline is None:
+            return d
+        call = self.clock.callLater(
+            max(0, deadline - self.clock.seconds()), d.cancel)
+
+        def finished(result):
+            if call.active():
+                call.cancel()
+            return result
+
+        return d.addBoth(finished)
+
+    @inlineCallbacks
+    def fetch_attachment(self, key, url):
+        deadline = None
+        if self.attachment_fetch_timeout > 0:
+            deadline = self.clock.seconds() + self.attachment_fetch_timeout
+        response = yield self.cancel_after(
+            self.request('GET', url, ''), deadline)
+        if response.code != http.OK:
+            self.attachment_stats['failed'] += 1
+            self.log.error('Unable to fetch attachment %s (%s)' % (
+                url, response.code))
+            return
+
+        length = getattr(response, 'length', None)
+        max_length = self.attachment_store.max_file_bytes
+        if isinstance(length, (int, long)) and length > max_length:
+            self.attachment_stats['too_large'] += 1
+            return
+
+        try:
+            content = yield self.cancel_after(
+                read_body(response, max_length), deadline)
+        except AttachmentTooLarge:
+            self.attachment_stats['too_large'] += 1
+            return
+        [content_type] = response.headers.getRawHeaders(
+            'Content-Type', [None])[:1]
+        digest = yield deferToThread(
+            self.attachment_store.put, key, content, content_type)
+        if digest is None:
+            self.attachment_stats['too_large'] += 1
+        else:
+            self.attachment_stats['fetched'] += 1
+
+    def _attachment_fetch_failed(self, failure, url):
+        self.attachment_stats['failed'] += 1
+        self.log.error('Unable to fetch attachment %s: %s' % (
+            url, failure.getErrorMessage()))
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
-        self.log.info('MessengerTransport outbound %r' % (message,))
+        trace = {'received': self.clock.seconds()}
+        if self.capture is not None:
+            self.capture.outbound(message)
         meta = message['helper_metadata'].get('messenger', {})
+        self.log_path('outbound', lambda: {
+            'message_id': message['message_id'],
+            'to_addr': message['to_addr'],
+            'content': self.redact(message['content']),
+            'helper_metadata': sorted(meta),
+        })
 
         if 'attachment' in meta:
             msg = self.construct_attachment_message(message)
@@ -521,20 +2087,66 @@ class MessengerTransport(HttpRpcTransport):
             msg['message']['metadata'] = meta['metadata']
         if 'notification_type' in meta:
             msg['notification_type'] = meta['notification_type']
+        if 'messaging_type' in meta:
+            msg['messaging_type'] = meta['messaging_type']
+        if 'tag' in meta:
+            msg['tag'] = meta['tag']
+
+        unreachable = yield self.get_unreachable_recipient(message['to_addr'])
+        if unreachable is not None:
+            self.unreachable_recipient_hits += 1
+            yield self.handle_outbound_failure(
+                message['message_id'], unreachable['reason'],
+                unreachable['fail_type'])
+            returnValue({})
+
+        if self.messaging_window and 'tag' not in meta:
+            in_window = yield self.in_messaging_window(message['to_addr'])
+            if not in_window:
+                self.messaging_window_rejections += 1
+                yield self.handle_outbound_failure(
+                    message['message_id'],
+                    'Outside of the messaging window and no tag given',
+                    'outside_messaging_window')
+                returnValue({})
+
+        if self.payload_store_threshold:
+            msg, payloads = self.store_payloads(msg)
+            for token, payload in payloads.iteritems():
+                yield self.redis.setex(
+                    self.payload_key(token), self.payload_store_ttl, payload)
+
+        if self.validate_outbound:
+            try:
+                validate_message(msg)
+            except ValidationError, e:
+                self.invalid_messages += 1
+                yield self.handle_outbound_failure(
+                    message['message_id'], 'Invalid message: %s' % (e,),
+                    'invalid_message')
+                returnValue({})
 
-        self.log.info('Reply: %s' % (msg,))
+        self.log_path('reply', lambda: {
+            'message_id': message['message_id'],
+            'recipient': message['to_addr'],
+            'body': (msg if not self.log_redact_content
+                     else sorted(msg.get('message', msg))),
+        })
 
         request = {
             'message_id': message['message_id'],
+            'recipient': message['to_addr'],
+            'trace': trace,
             'method': 'POST',
             'relative_url': self.MESSAGES_API_PATH,
             'body': urlencode({
-                k: json.dumps(v, separators=(',', ':'))
+                k: codec.dumps(v)
                 if isinstance(v, (list, dict)) else v
                 for k, v in msg.items()
             }),
         }
 
+        self.stamp_trace(trace, 'queued')
         yield self.add_request(request)
 
     def construct_sender_action(self, message):
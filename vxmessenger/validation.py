@@ -0,0 +1,252 @@
+"""
+Validation of outbound Send API messages before they are queued.
+
+Schemas are built once, at import time, out of small validator functions,
+so that validating a message is a walk over the message with no schema
+interpretation left to do. Only the limits documented for the Send API are
+checked and unknown fields are allowed, so that newer Send API features can
+be used without changes here.
+"""
+
+
+class ValidationError(Exception):
+    """Raised when a message does not match its schema."""
+
+    def __init__(self, path, message):
+        Exception.__init__(self, path, message)
+        self.path = path
+        self.message = message
+
+    def __str__(self):
+        return '%s: %s' % (self.path or 'message', self.message)
+
+
+def join(path, key):
+    return '%s.%s' % (path, key) if path else key
+
+
+def String(max_length=None, choices=None):
+    choices = frozenset(choices) if choices is not None else None
+
+    def validate(value, path):
+        if not isinstance(value, basestring):
+            raise ValidationError(path, 'must be a string')
+        if max_length is not None and len(value) > max_length:
+            raise ValidationError(
+                path, 'must be at most %d characters' % (max_length,))
+        if choices is not None and value not in choices:
+            raise ValidationError(
+                path, 'must be one of %s' % (', '.join(sorted(choices)),))
+    return validate
+
+
+def Number():
+    def validate(value, path):
+        if isinstance(value, bool) or not isinstance(
+                value, (int, long, float, basestring)):
+            raise ValidationError(path, 'must be a number')
+    return validate
+
+
+def Bool():
+    def validate(value, path):
+        if not isinstance(value, bool):
+            raise ValidationError(path, 'must be true or false')
+    return validate
+
+
+def List(item, min_items=0, max_items=None):
+    def validate(value, path):
+        if not isinstance(value, list):
+            raise ValidationError(path, 'must be a list')
+        if len(value) < min_items:
+            raise ValidationError(
+                path, 'must have at least %d items' % (min_items,))
+        if max_items is not None and len(value) > max_items:
+            raise ValidationError(
+                path, 'must have at most %d items' % (max_items,))
+        for i, v in enumerate(value):
+            item(v, '%s[%d]' % (path, i))
+    return validate
+
+
+def Object(required=None, optional=None, one_of=()):
+    """
+    A dict with ``required`` and ``optional`` fields, and at least one of the
+    fields in ``one_of``. Fields not listed are allowed.
+    """
+    required = sorted((required or {}).items())
+    optional = sorted((optional or {}).items())
+
+    def validate(value, path):
+        if not isinstance(value, dict):
+            raise ValidationError(path, 'must be an object')
+        for key, field in required:
+            if key not in value:
+                raise ValidationError(join(path, key), 'is required')
+            field(value[key], join(path, key))
+        for key, field in optional:
+            if key in value:
+                field(value[key], join(path, key))
+        if one_of and not any(key in value for key in one_of):
+            raise ValidationError(
+                path, 'must have one of %s' % (', '.join(one_of),))
+    return validate
+
+
+def Switch(key, schemas, default=None):
+    """
+    Validates a dict with the schema in ``schemas`` for its ``key`` field.
+    Dicts with other values for ``key`` are validated with ``default``, or
+    allowed if there is no default.
+    """
+    def validate(value, path):
+        if not isinstance(value, dict):
+            raise ValidationError(path, 'must be an object')
+        schema = schemas.get(value.get(key), default)
+        if schema is not None:
+            schema(value, path)
+    return validate
+
+
+def All(*validators):
+    def validate(value, path):
+        for validator in validators:
+            validator(value, path)
+    return validate
+
+
+PAYLOAD = String(max_length=1000)
+URL = String()
+
+BUTTON = All(
+    Object(required={'type': String()}),
+    Switch('type', {
+        'web_url': Object(
+            required={'title': String(max_length=20), 'url': URL},
+            optional={
+                'webview_height_ratio': String(
+                    choices=('compact', 'tall', 'full')),
+                'messenger_extensions': Bool(),
+                'fallback_url': URL,
+            }),
+        'postback': Object(
+            required={'title': String(max_length=20), 'payload': PAYLOAD}),
+        'phone_number': Object(
+            required={'title': String(max_length=20), 'payload': String()}),
+        'element_share': Object(),
+        'account_link': Object(required={'url': URL}),
+        'account_unlink': Object(),
+        'payment': Object(required={'title': String(), 'payload': PAYLOAD}),
+    }, default=Object(required={'type': String(choices=(
+        'web_url', 'postback', 'phone_number', 'element_share',
+        'account_link', 'account_unlink', 'payment'))})),
+)
+
+DEFAULT_ACTION = Object(
+    required={'type': String(choices=('web_url',)), 'url': URL},
+    optional={
+        'webview_height_ratio': String(choices=('compact', 'tall', 'full')),
+        'messenger_extensions': Bool(),
+        'fallback_url': URL,
+    })
+
+ELEMENT = Object(
+    required={'title': String(max_length=80)},
+    optional={
+        'subtitle': String(max_length=80),
+        'image_url': URL,
+        'item_url': URL,
+        'default_action': DEFAULT_ACTION,
+        'buttons': List(BUTTON, max_items=3),
+    })
+
+TEMPLATE_PAYLOAD = Switch('template_type', {
+    'button': Object(required={
+        'text': String(max_length=640),
+        'buttons': List(BUTTON, min_items=1, max_items=3),
+    }),
+    'generic': Object(
+        required={'elements': List(ELEMENT, min_items=1, max_items=10)},
+        optional={
+            'image_aspect_ratio': String(choices=('horizontal', 'square')),
+        }),
+    'list': Object(
+        required={'elements': List(ELEMENT, min_items=1, max_items=4)},
+        optional={
+            'top_element_style': String(choices=('large', 'compact')),
+            'buttons': List(BUTTON, max_items=1),
+        }),
+    'receipt': Object(
+        required={
+            'recipient_name': String(),
+            'order_number': String(),
+            'currency': String(),
+            'payment_method': String(),
+            'summary': Object(required={'total_cost': Number()}),
+        },
+        optional={
+            'elements': List(Object(
+                required={'title': String(), 'price': Number()}),
+                max_items=100),
+        }),
+})
+
+ATTACHMENT = Switch('type', {
+    'template': Object(required={
+        'payload': All(
+            Object(required={'template_type': String()}),
+            TEMPLATE_PAYLOAD),
+    }),
+}, default=Object(
+    required={
+        'type': String(choices=('image', 'audio', 'video', 'file')),
+        'payload': Object(
+            optional={'url': URL, 'is_reusable': Bool()},
+            one_of=('url', 'attachment_id')),
+    }))
+
+QUICK_REPLY = Switch('content_type', {
+    'text': Object(
+        required={'title': String(max_length=20), 'payload': PAYLOAD},
+        optional={'image_url': URL}),
+}, default=Object(required={'content_type': String(choices=(
+    'text', 'location', 'user_phone_number', 'user_email'))}))
+
+RECIPIENT = Object(one_of=('id', 'phone_number', 'user_ref'))
+
+MESSAGE = Object(
+    required={
+        'recipient': RECIPIENT,
+        'message': Object(
+            optional={
+                'text': String(max_length=2000),
+                'attachment': ATTACHMENT,
+                'quick_replies': List(QUICK_REPLY, min_items=1, max_items=11),
+                'metadata': String(max_length=1000),
+            },
+            one_of=('text', 'attachment')),
+    },
+    optional={
+        'notification_type': String(
+            choices=('REGULAR', 'SILENT_PUSH', 'NO_PUSH')),
+        'messaging_type': String(
+            choices=('RESPONSE', 'UPDATE', 'MESSAGE_TAG')),
+        'tag': String(),
+    })
+
+SENDER_ACTION = Object(required={
+    'recipient': RECIPIENT,
+    'sender_action': String(choices=('typing_on', 'typing_off', 'mark_seen')),
+})
+
+
+def validate_message(msg):
+    """
+    Check that ``msg`` is a valid Send API request body, raising
+    ``ValidationError`` naming the first problem found if it isn't.
+    """
+    if 'sender_action' in msg:
+        SENDER_ACTION(msg, '')
+    else:
+        MESSAGE(msg, '')
@@ -1,13 +1,58 @@
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socket
+import sys
+from collections import Counter, OrderedDict
+from uuid import uuid4
+
 from klein import Klein
 
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, maybeDeferred, returnValue, succeed)
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.error import ProcessExitedAlready, ReactorNotRunning
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.web import http
+from twisted.web.server import Site
+
+from vumi.persist.txredis_manager import TxRedisManager
+
 import click
 
 
 class WebhookService(object):
+    """
+    Answers Messenger's webhook verification and, given a Redis manager,
+    receives webhook requests for transports to consume.
+
+    The events in each request are split up by the page they are for, and
+    stored in the Redis list ``<key_prefix>:<page_id>`` in the same format
+    as a transport's inbound buffer, so that a transport with
+    ``inbound_buffer`` set and ``inbound_buffer_key`` set to that list
+    publishes them. If ``app_secret`` is given, requests without a valid
+    ``X-Hub-Signature`` are refused. With ``redis_pending`` set, requests
+    are answered with a 503 until ``redis`` is, as they are when storing
+    them fails, so that Messenger delivers them again later.
+    """
     app = Klein()
 
-    def __init__(self, verify_token):
+    def __init__(self, verify_token, redis=None, app_secret=None,
+                 key_prefix='ingress', clock=reactor, redis_pending=False):
         self.verify_token = verify_token
+        self.redis = redis
+        self.redis_pending = redis_pending
+        self.app_secret = app_secret
+        self.key_prefix = key_prefix
+        self.clock = clock
+        self.stats = Counter()
+        self.active = 0
+        self._idle_waiters = []
 
     @app.route('/', methods=['GET'])
     def items(self, request):
@@ -19,6 +64,303 @@ class WebhookService(object):
         request.setResponseCode(404)
         return 'Bad Request'
 
+    @app.route('/', methods=['POST'])
+    @inlineCallbacks
+    def receive(self, request):
+        if self.redis is None:
+            if self.redis_pending:
+                returnValue(self.unavailable(request))
+            request.setResponseCode(http.NOT_FOUND)
+            returnValue('Not Found')
+
+        self.active += 1
+        try:
+            result = yield self.store(request)
+        finally:
+            self.request_finished()
+        returnValue(result)
+
+    @inlineCallbacks
+    def store(self, request):
+        self.stats['requests'] += 1
+        body = request.content.read()
+        if not self.verify_signature(
+                body, request.getHeader('X-Hub-Signature')):
+            self.stats['invalid_signature'] += 1
+            request.setResponseCode(http.FORBIDDEN)
+            returnValue('Invalid signature')
+
+        try:
+            partitions = self.partition(body)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.stats['invalid_body'] += 1
+            request.setResponseCode(http.BAD_REQUEST)
+            returnValue('Bad Request')
+
+        try:
+            for page_id, page_body in partitions.iteritems():
+                yield self.redis.lpush(self.buffer_key(page_id), json.dumps({
+                    'message_id': uuid4().hex,
+                    'body': page_body,
+                    'timestamp': self.clock.seconds(),
+                }))
+                self.stats['pages'] += 1
+        except Exception:
+            log.err(None, 'Unable to store request')
+            returnValue(self.unavailable(request))
+        returnValue('')
+
+    def unavailable(self, request):
+        self.stats['unavailable'] += 1
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        return 'Service Unavailable'
+
+    def request_finished(self):
+        self.active -= 1
+        if not self.active:
+            waiters, self._idle_waiters = self._idle_waiters, []
+            for d in waiters:
+                if not d.called:
+                    d.callback(None)
+
+    def wait_until_idle(self, timeout):
+        """
+        Fire once no requests are being stored, or after ``timeout`` seconds
+        if some still are.
+        """
+        if not self.active:
+            return succeed(None)
+        d = Deferred()
+        timer = self.clock.callLater(timeout, d.callback, None)
+
+        def cancel_timer(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        d.addBoth(cancel_timer)
+        self._idle_waiters.append(d)
+        return d
+
+    def verify_signature(self, body, signature):
+        if self.app_secret is None:
+            return True
+        if signature is None or not signature.startswith('sha1='):
+            return False
+        expected = hmac.new(self.app_secret, body, hashlib.sha1).hexdigest()
+        return hmac.compare_digest(signature[len('sha1='):], expected)
+
+    def buffer_key(self, page_id):
+        return '%s:%s' % (self.key_prefix, page_id)
+
+    def partition(self, body):
+        """
+        Split a webhook request body into a body for each page that it
+        has events for.
+        """
+        data = json.loads(body)
+        entries = OrderedDict()
+        for entry in data['entry']:
+            entries.setdefault(str(entry['id']), []).append(entry)
+        if len(entries) == 1:
+            return {entries.keys()[0]: body}
+        return OrderedDict(
+            (page_id, json.dumps(dict(data, entry=page_entries)))
+            for page_id, page_entries in entries.iteritems())
+
+
+class WorkerProcess(ProcessProtocol):
+    """A worker process started by a ``WorkerPool``."""
+
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.number = number
+        self.ready = False
+
+    def childDataReceived(self, childFD, data):
+        if childFD != self.pool.READY_FD:
+            return ProcessProtocol.childDataReceived(self, childFD, data)
+        if not self.ready:
+            self.ready = True
+            self.pool.worker_ready(self)
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except ProcessExitedAlready:
+            pass
+
+    def processEnded(self, reason):
+        self.pool.worker_ended(self, reason)
+
+
+class WorkerPool(object):
+    """
+    Runs ``workers`` copies of the webhook service in separate processes,
+    all accepting connections on the listening socket ``fd``, which each
+    worker inherits as its file descriptor 3. ``args`` are the command line
+    options passed on to each worker.
+
+    Workers that exit are started again after ``respawn_delay`` seconds.
+    ``restart`` replaces every worker without closing the socket, so no
+    connections are refused while it happens. Each worker writes to its
+    file descriptor 4 once it is accepting connections, and the workers
+    being replaced are only stopped once all of their replacements have.
+    Workers share the pool's stdin, stdout and stderr unless other
+    ``child_fds`` are given.
+    """
+
+    WORKER_FD = 3
+    READY_FD = 4
+
+    def __init__(self, workers, fd, args, env=None, respawn_delay=1,
+                 child_fds=None, reactor=reactor):
+        self.workers = workers
+        self.fd = fd
+        self.args = args
+        self.env = os.environ if env is None else env
+        self.respawn_delay = respawn_delay
+        self.child_fds = {0: 0, 1: 1, 2: 2} if child_fds is None else child_fds
+        self.reactor = reactor
+        self.processes = {}
+        self.retiring = set()
+        self.replaced = []
+        self.stopping = False
+        self._respawns = {}
+        self._stopped = []
+
+    def start(self):
+        for number in range(self.workers):
+            self.spawn(number)
+
+    def spawn(self, number):
+        self._respawns.pop(number, None)
+        protocol = WorkerProcess(self, number)
+        argv = [
+            sys.executable, '-m', 'vxmessenger.webhook',
+            '--fd', str(self.WORKER_FD), '--ready-fd', str(self.READY_FD),
+            '--worker-number', str(number),
+        ] + list(self.args)
+        child_fds = dict(self.child_fds)
+        child_fds[self.WORKER_FD] = self.fd
+        child_fds[self.READY_FD] = 'r'
+        self.reactor.spawnProcess(
+            protocol, sys.executable, argv, env=self.env, childFDs=child_fds)
+        self.processes[number] = protocol
+        log.msg('Started worker %d (pid %s)' % (
+            number, protocol.transport.pid))
+
+    def restart(self):
+        """
+        Start a new set of workers, then once they are all accepting
+        connections ask the old ones to stop once they have finished the
+        requests they are handling.
+        """
+        if self.stopping:
+            return
+        log.msg('Restarting workers')
+        for call in self._respawns.values():
+            call.cancel()
+        self._respawns.clear()
+        old = self.processes.values()
+        self.processes = {}
+        self.retiring.update(old)
+        self.replaced.extend(old)
+        self.start()
+
+    def worker_ready(self, protocol):
+        log.msg('Worker %d (pid %s) is ready' % (
+            protocol.number, protocol.transport.pid))
+        if not self.replaced or len(self.processes) < self.workers:
+            return
+        if all(p.ready for p in self.processes.values()):
+            replaced, self.replaced = self.replaced, []
+            for old in replaced:
+                old.signal('TERM')
+
+    def stop(self):
+        """Stop every worker, firing once they have all exited."""
+        self.stopping = True
+        for call in self._respawns.values():
+            call.cancel()
+        self._respawns.clear()
+        self.replaced = []
+        for protocol in self.processes.values() + list(self.retiring):
+            protocol.signal('TERM')
+        d = Deferred()
+        self._stopped.append(d)
+        self._check_stopped()
+        return d
+
+    def worker_ended(self, protocol, reason):
+        self.retiring.discard(protocol)
+        if self.processes.get(protocol.number) is protocol:
+            del self.processes[protocol.number]
+            if not self.stopping:
+                log.msg('Worker %d exited unexpectedly: %s' % (
+                    protocol.number, reason.getErrorMessage()))
+                self._respawns[protocol.number] = self.reactor.callLater(
+                    self.respawn_delay, self.spawn, protocol.number)
+        self._check_stopped()
+
+    def _check_stopped(self):
+        if self.stopping and not self.processes and not self.retiring:
+            stopped, self._stopped = self._stopped, []
+            for d in stopped:
+                d.callback(None)
+
+
+def listen_socket(interface, port, backlog=128):
+    """
+    Create a listening socket for a ``WorkerPool`` to share between its
+    workers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def worker_args(token, app_secret, redis_config, key_prefix, grace,
+                stats_interval):
+    """
+    Build the command line options to pass on to each worker of a
+    ``WorkerPool``, leaving out those that weren't given.
+    """
+    args = ['--key-prefix', key_prefix, '--grace', str(grace),
+            '--stats-interval', str(stats_interval)]
+    for option, value in [('--token', token),
+                          ('--app-secret', app_secret),
+                          ('--redis', redis_config)]:
+        if value is not None:
+            args.extend([option, value])
+    return args
+
+
+def stop_reactor():
+    try:
+        reactor.stop()
+    except ReactorNotRunning:
+        pass
+
+
+def handle_stop_signals():
+    """
+    Stop the reactor on SIGINT or SIGTERM, without complaining when it is
+    asked more than once, as a worker is when both the terminal and its
+    pool stop it.
+    """
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(
+            signum, lambda signum, frame: reactor.callFromThread(stop_reactor))
+
+
+def log_stats(service, name):
+    log.msg('%s stats: %s' % (name, json.dumps(dict(
+        service.stats, active=service.active))))
+
 
 @click.command()
 @click.option('--interface', default='127.0.0.1',
@@ -27,9 +369,102 @@ class WebhookService(object):
               help='Which port to listen on.', type=int)
 @click.option('--token',
               help='The token to verify', type=str)
-def cli(interface, port, token):  # pragma: nocover
-    store = WebhookService(token)
-    store.app.run(interface, port)
+@click.option('--app-secret', default=None,
+              help='The app secret to check request signatures with.',
+              type=str)
+@click.option('--redis', 'redis_config', default=None,
+              help='The redis_manager config of the transports to store '
+                   'requests for, as JSON. Requests are only accepted if '
+                   'this is given.', type=str)
+@click.option('--key-prefix', default='ingress',
+              help='The prefix of the Redis list for each page.', type=str)
+@click.option('--workers', default=1,
+              help='How many processes to accept requests in. With more '
+                   'than one, SIGHUP restarts them all.', type=int)
+@click.option('--backlog', default=128,
+              help='How many connections to queue before refusing them.',
+              type=int)
+@click.option('--grace', default=10.0,
+              help='How long to wait for requests to finish when stopping.',
+              type=float)
+@click.option('--stats-interval', default=60.0,
+              help='How often to log request stats, in seconds.', type=float)
+@click.option('--fd', default=None, type=int, hidden=True)
+@click.option('--ready-fd', default=None, type=int, hidden=True)
+@click.option('--worker-number', default=None, type=int, hidden=True)
+def cli(interface, port, token, app_secret, redis_config, key_prefix,
+        workers, backlog, grace, stats_interval, fd, ready_fd,
+        worker_number):  # pragma: nocover
+    log.startLogging(sys.stdout)
+
+    if workers > 1 and fd is None:
+        sock = listen_socket(interface, port, backlog)
+        args = worker_args(
+            token, app_secret, redis_config, key_prefix, grace,
+            stats_interval)
+        pool = WorkerPool(workers, sock.fileno(), args)
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: reactor.callFromThread(pool.restart))
+        reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+
+        def start_pool():
+            try:
+                pool.start()
+            except Exception:
+                log.err(None, 'Unable to start workers')
+                reactor.stop()
+
+        reactor.callWhenRunning(handle_stop_signals)
+        reactor.callWhenRunning(start_pool)
+        reactor.run()
+        return
+
+    if worker_number is None:
+        name = 'Ingress'
+    else:
+        name = 'Worker %d (pid %d)' % (worker_number, os.getpid())
+
+    @inlineCallbacks
+    def start():
+        # Listen before connecting to Redis, which is retried until it
+        # succeeds, answering requests with a 503 until then.
+        service = WebhookService(
+            token, app_secret=app_secret, key_prefix=key_prefix,
+            redis_pending=redis_config is not None)
+        site = Site(service.app.resource())
+        if fd is None:
+            endpoint = serverFromString(
+                reactor, 'tcp:%d:interface=%s:backlog=%d' % (
+                    port, interface, backlog))
+            listener = yield endpoint.listen(site)
+        else:
+            listener = reactor.adoptStreamPort(fd, socket.AF_INET, site)
+            os.close(fd)
+        if ready_fd is not None:
+            os.write(ready_fd, 'ready\n')
+            os.close(ready_fd)
+
+        stats = LoopingCall(log_stats, service, name)
+        stats.start(stats_interval, now=False)
+
+        @inlineCallbacks
+        def stop():
+            yield maybeDeferred(listener.stopListening)
+            yield service.wait_until_idle(grace)
+            stats.stop()
+            log_stats(service, name)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', stop)
+
+        if redis_config is not None:
+            service.redis = yield TxRedisManager.from_config(
+                json.loads(redis_config))
+            log.msg('%s connected to Redis' % (name,))
+
+    reactor.callWhenRunning(handle_stop_signals)
+    reactor.callWhenRunning(start)
+    reactor.run()
 
 
 if __name__ == '__main__':  # pragma: nocover